@@ -54,15 +54,6 @@ def save_as_parquet(df, local_dest, gcs_dest, partitioned=False):
     if partitioned:
         print('- shape[partitioned]:', df.shape)
         df.to_parquet(local_dest, partition_cols=['year'])
-        for path in Path(local_dest).glob('*/*'):
-            _dest = f'{gcs_dest}/{path.parent.name}/{path.name}'
-            interface.save_to_gcp(
-                src=path,
-                gcs_dest=_dest,
-                table_name=None,
-                dataset_name=None,
-                remove_src=True,
-                dry_run=DRY_RUN)
     else:
         print('- shape:', df.shape)
         df.to_parquet(local_dest)
@@ -75,6 +66,14 @@ def save_as_parquet(df, local_dest, gcs_dest, partitioned=False):
             dry_run=DRY_RUN)
 
 
+def upload_partitions(local_dest, gcs_dest):
+    """ concurrently upload (and then remove) year-partitioned parquet files """
+    uris = gcp.upload_directory(local_dest, gcs_dest, pattern='*/*')
+    print(f'- uploaded to gcs [{len(uris)}]:', gcs_dest)
+    for path in Path(local_dest).glob('*/*'):
+        path.unlink()
+
+
 def process_folder(
         folder,
         process_subfolders=True):
@@ -99,6 +98,7 @@ def process_folder(
                 Path(local_dest).parent.mkdir(parents=True, exist_ok=True)
                 if 'year' in df.columns:
                     save_as_parquet(df, local_dest, gcs_dest, partitioned=True)
+                    upload_partitions(local_dest, gcs_dest)
                 else:
                     save_as_parquet(df, local_dest, gcs_dest, partitioned=False)
             elif are_yyyy_partitioned(files):
@@ -106,6 +106,7 @@ def process_folder(
                 for file in files:
                     df = pd.read_json(file, lines=True)
                     save_as_parquet(df, local_dest, gcs_dest, partitioned=True)
+                upload_partitions(local_dest, gcs_dest)
             else:
                 err = (
                     'if non-partitioned only 1 file may exist, '
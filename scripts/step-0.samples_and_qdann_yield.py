@@ -182,10 +182,11 @@ print(f'- samples shape:', samples_df.shape)
 table_name, local_dest, gcs_dest = interface.table_name_and_paths(
     c.SAMPLES_FOLDER,
     table_name=c.SAMPLE_POINTS_TABLE_NAME)
-local_dest = utils.dataframe_to_ldjson(
+local_dest = utils.save_dataframe(
     samples_df,
     dest=local_dest,
-    dry_run=c.DRY_RUN)
+    dry_run=c.DRY_RUN,
+    **gcp.table_format(table_name))
 interface.save_to_gcp(
     src=local_dest,
     gcs_dest=gcs_dest,
@@ -205,10 +206,11 @@ print(f'- yield shape:', yield_df.shape)
 table_name, local_dest, gcs_dest = interface.table_name_and_paths(
     c.QDANN_YIELD_FOLDER,
     table_name=c.QDANN_YIELD_TABLE_NAME)
-local_dest = utils.dataframe_to_ldjson(
+local_dest = utils.save_dataframe(
     yield_df,
     dest=local_dest,
-    dry_run=c.DRY_RUN)
+    dry_run=c.DRY_RUN,
+    **gcp.table_format(table_name))
 interface.save_to_gcp(
     src=local_dest,
     gcs_dest=gcs_dest,
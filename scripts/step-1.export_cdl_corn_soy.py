@@ -110,14 +110,20 @@ for year in YEARS:
     print(f'exporting yield data [{crop_data.shape}]:')
 
     # 4. save data (local, gcs, bq)
-    local_dest = utils.dataframe_to_ldjson(
+    local_dest = utils.save_dataframe(
         crop_data,
         dest=local_dest,
-        dry_run=c.DRY_RUN)
+        dry_run=c.DRY_RUN,
+        **gcp.table_format(table_name))
     interface.save_to_gcp(
         src=local_dest,
         gcs_dest=gcs_dest,
         dataset_name=c.DATASET_NAME,
         table_name=table_name,
         remove_src=True,
-        dry_run=c.DRY_RUN)
+        dry_run=c.DRY_RUN,
+        asynchronous=True)
+
+
+# wait for outstanding (asynchronous) uploads/table-loads
+interface.wait_for_saves()
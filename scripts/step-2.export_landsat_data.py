@@ -40,6 +40,8 @@ from spectral_trend_database import gcp
 from spectral_trend_database import paths
 from spectral_trend_database import interface
 from spectral_trend_database import utils
+from spectral_trend_database import checkpoint
+from spectral_trend_database import sharding
 from spectral_trend_database.gee import landsat
 from spectral_trend_database.gee import utils as ee_utils
 warnings.filterwarnings(
@@ -54,6 +56,7 @@ warnings.filterwarnings(
 YEARS = range(c.YEARS[0], c.YEARS[1] + 1)
 MAX_PROCESSES = 6
 MAX_ERR = 1
+STEP = 'step-2'
 
 
 #
@@ -93,7 +96,7 @@ def get_mean_pixel_values(row: pd.Series, year=int) -> xr.Dataset:
 def process_mean_pixel_rows(
         row: dict,
         year: int,
-        dest: str):
+        sink: checkpoint.CheckpointSink):
     row = dict(row).copy()
     sample_id = row['sample_id']
     ds = get_mean_pixel_values(row, year)
@@ -106,11 +109,7 @@ def process_mean_pixel_rows(
         rows['year'] = year
         rows['nb_images_in_year'] = len(rows)
         rows = rows[ORDERED_COLUMNS].sort_values(['date'])
-        utils.dataframe_to_ldjson(
-            rows,
-            dest=dest,
-            mode='a',
-            noisy=False)
+        sink.write(rows, sample_id=sample_id)
     except Exception as e:
         return dict(
             sample_id=sample_id,
@@ -139,16 +138,20 @@ print('load data:')
 print('-', SRC_PATH)
 df = pd.read_json(SRC_PATH, lines=True)
 print('- shape:', df.shape)
+if c.SHARD:
+    df = sharding.select_shard(df)
+    print(f'- shard {c.SHARD} shape:', df.shape)
 if c.LIMIT:
-    df = df.sample(c.LIMIT)
+    df = interface.limit_samples(df, limit=c.LIMIT)
     print('- limit shape:', df.shape)
 data = df.to_dict('records')
 
 
 # 2. For each year:
 #     - Get Mean Harmonized Landsat Values
-#     - Save results, local and GCS, as line-deliminated JSON files
+#     - Save results, local and GCS, as parquet or line-deliminated JSON files
 print(f'RUNNING LANDSAT EXPORT FOR {YEARS}')
+manifest = checkpoint.Checkpoint()
 for year in YEARS:
     print(f'\n- year: {year}')
     # 1. process paths
@@ -156,22 +159,51 @@ for year in YEARS:
         c.RAW_LANDSAT_FOLDER,
         file_name=c.RAW_LANDSAT_FILENAME,
         year=year)
+    if sharding.merging():
+        interface.merge_shards(
+            local_dest,
+            gcs_dest,
+            dataset_name=c.DATASET_NAME,
+            table_name=None,
+            dry_run=c.DRY_RUN,
+            asynchronous=True)
+        continue
+    if manifest.is_finalized(STEP, year):
+        print('- complete (see c.CHECKPOINT_PATH): skipping')
+        continue
+    sink = manifest.sink(STEP, year, local_dest, dry_run=c.DRY_RUN)
+    completed = manifest.completed(STEP, year)
+    year_data = [r for r in data if str(r['sample_id']) not in completed]
+    print('- nb_completed_samples:', len(completed))
 
     # 2. run
     errors = MAP_METHOD(
-        lambda r: process_mean_pixel_rows(r, year=year, dest=local_dest),
-        data,
+        lambda r: process_mean_pixel_rows(r, year=year, sink=sink),
+        year_data,
         max_processes=MAX_PROCESSES)
-    interface.print_errors(errors)
+    sink.close()
+    local_dest = sink.merge()
 
     # 3. report on errors
     interface.print_errors(errors)
 
     # 4. save data (gcs, bq)
-    interface.save_to_gcp(
+    if (local_dest is None) and (not c.DRY_RUN):
+        print('- no output rows: skipping save')
+        if not any(errors):
+            manifest.finalize(STEP, year)
+        continue
+    future = interface.save_to_gcp(
         src=local_dest,
         gcs_dest=gcs_dest,
         dataset_name=c.DATASET_NAME,
         table_name=None,
         remove_src=True,
-        dry_run=c.DRY_RUN)
+        dry_run=c.DRY_RUN,
+        asynchronous=True)
+    if not c.DRY_RUN:
+        manifest.finalize_when_done(future, STEP, year, dest=gcs_dest)
+
+
+# wait for outstanding (asynchronous) uploads/table-loads
+interface.wait_for_saves()
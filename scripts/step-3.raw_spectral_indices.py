@@ -80,9 +80,9 @@ for year in YEARS:
     src_uri = paths.gcs(
         c.RAW_LANDSAT_FOLDER,
         f'{c.RAW_LANDSAT_FILENAME}-{year}',
-        ext='json')
+        ext=gcp.table_format(None)['file_format'])
     print('- src:', src_uri)
-    df = pd.read_json(src_uri, lines=True)
+    df = utils.read_dataframe(src_uri)
     print('- src shape:', df.shape)
 
     # 3. run
@@ -91,14 +91,20 @@ for year in YEARS:
         index_config=index_config)
 
     # save data
-    local_dest = utils.dataframe_to_ldjson(
+    local_dest = utils.save_dataframe(
         df,
         dest=local_dest,
-        dry_run=c.DRY_RUN)
+        dry_run=c.DRY_RUN,
+        **gcp.table_format(table_name))
     interface.save_to_gcp(
         src=local_dest,
         gcs_dest=gcs_dest,
         dataset_name=c.DATASET_NAME,
         table_name=table_name,
         remove_src=True,
-        dry_run=c.DRY_RUN)
+        dry_run=c.DRY_RUN,
+        asynchronous=True)
+
+
+# wait for outstanding (asynchronous) uploads/table-loads
+interface.wait_for_saves()
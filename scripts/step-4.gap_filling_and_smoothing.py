@@ -38,20 +38,23 @@ from spectral_trend_database import gcp
 from spectral_trend_database import types
 from spectral_trend_database import utils
 from spectral_trend_database import interface
+from spectral_trend_database import checkpoint
+from spectral_trend_database import sharding
 from spectral_trend_database.gee import landsat
-import mproc
 
 
 #
 # CONSTANTS
 #
 YEARS = range(c.YEARS[0], c.YEARS[1] + 1)
-MAP_METHOD = mproc.map_with_threadpool
-# MAP_METHOD = mproc.map_sequential
+MAP_METHOD = c.DEFAULT_MAP_METHOD
+# MAP_METHOD = 'pool'
+# MAP_METHOD = 'sequential'
 YEAR_BUFFER = relativedelta(days=smoothing.DEFAULT_SG_WINDOW_LENGTH * 2)
 YEAR_DELTA = relativedelta(years=1)
 DS_COLUMNS = ['date'] + landsat.HARMONIZED_BANDS + list(spectral.index_config().keys())
 ORDERED_COLUMNS = ['sample_id', 'year'] + DS_COLUMNS
+STEP = 'step-4'
 
 
 #
@@ -72,8 +75,7 @@ def post_process_row(row: dict, data_vars: list[str]) -> dict:
 def process_smoothing(
         rows: Union[pd.Series, dict],
         year: int,
-        sample_id: str,
-        dest: str) -> Union[str, None]:
+        sample_id: str) -> Union[pd.DataFrame, dict]:
     try:
         rows = rows[DS_COLUMNS].copy()
         rows = rows[rows.ndvi > 0]
@@ -83,12 +85,7 @@ def process_smoothing(
         rows = ds.to_dataframe().reset_index(drop=False)
         rows['sample_id'] = sample_id
         rows['year'] = year
-        rows = rows[ORDERED_COLUMNS]
-        utils.dataframe_to_ldjson(
-            rows,
-            dest=dest,
-            mode='a',
-            noisy=False)
+        return rows[ORDERED_COLUMNS]
     except Exception as e:
         return dict(
             sample_id=sample_id,
@@ -101,6 +98,7 @@ def process_smoothing(
 #
 print('\nsmooth indices:')
 print('-' * 50)
+manifest = checkpoint.Checkpoint()
 for year in YEARS:
     print(f'\n- year: {year}')
     # 1. process paths
@@ -108,6 +106,26 @@ for year in YEARS:
         c.SMOOTHED_INDICES_FOLDER,
         table_name=c.SMOOTHED_INDICES_TABLE_NAME,
         year=year)
+    if sharding.merging():
+        interface.merge_shards(
+            local_dest,
+            gcs_dest,
+            dataset_name=c.DATASET_NAME,
+            table_name=table_name,
+            dry_run=c.DRY_RUN,
+            asynchronous=True)
+        continue
+    if manifest.is_finalized(STEP, year):
+        print('- complete (see c.CHECKPOINT_PATH): skipping')
+        continue
+    sink = manifest.sink(
+        STEP,
+        year,
+        local_dest,
+        float_type=gcp.table_format(table_name)['float_type'],
+        dry_run=c.DRY_RUN)
+    completed = manifest.completed(STEP, year)
+    print('- nb_completed_samples:', len(completed))
 
     # 2. query data
     jan1 = datetime(year=year, month=1, day=1)
@@ -115,31 +133,50 @@ for year in YEARS:
     end = (jan1 + YEAR_DELTA + YEAR_BUFFER).strftime(c.YYYY_MM_DD_FMT)
     qc = query.QueryConstructor(
         c.RAW_INDICES_TABLE_NAME,
-        table_prefix=f'{c.GCP_PROJECT}.{c.DATASET_NAME}')
+        table_prefix=f'{c.GCP_PROJECT}.{c.DATASET_NAME}',
+        parameterize=True)
     qc.where(date=start, date_op='>=')
     qc.where(date=end, date_op='<=')
     qc.append('ORDER BY date ASC')
-    data = query.run(sql=qc.sql())
-    sample_ids = data.sample_id.unique()
+    data = query.run(sql=qc.sql(), parameters=qc.parameters())
+    if completed:
+        data = data[~data.sample_id.astype(str).isin(completed)]
 
     # 3. run
-    errors = MAP_METHOD(
-        lambda s: process_smoothing(
-            data[data.sample_id == s],
-            sample_id=s,
-            year=year,
-            dest=local_dest),
-        sample_ids,
-        max_processes=c.MAX_PROCESSES)
+    errors = interface.map_samples(
+        process_smoothing,
+        data,
+        method=MAP_METHOD,
+        columns=DS_COLUMNS,
+        on_result=lambda result, sample_id: interface.write_result(
+            result,
+            sink,
+            sample_id=sample_id),
+        pass_key=True,
+        year=year)
+    sink.close()
+    local_dest = sink.merge()
 
     # 4. report on errors
     interface.print_errors(errors)
 
     # 5. save data (gcs, bq)
-    interface.save_to_gcp(
+    if (local_dest is None) and (not c.DRY_RUN):
+        print('- no output rows: skipping save')
+        if not any(errors):
+            manifest.finalize(STEP, year)
+        continue
+    future = interface.save_to_gcp(
         src=local_dest,
         gcs_dest=gcs_dest,
         dataset_name=c.DATASET_NAME,
         table_name=table_name,
         remove_src=True,
-        dry_run=c.DRY_RUN)
+        dry_run=c.DRY_RUN,
+        asynchronous=True)
+    if not c.DRY_RUN:
+        manifest.finalize_when_done(future, STEP, year, dest=gcs_dest)
+
+
+# wait for outstanding (asynchronous) uploads/table-loads
+interface.wait_for_saves()
@@ -25,7 +25,6 @@ from typing import Callable, Union, Optional, Literal, TypeAlias, Sequence, Any
 from datetime import timedelta
 from dateutil.parser import parse as dt_parse
 import pandas as pd
-import mproc
 from spectral_trend_database.config import config as c
 from spectral_trend_database import query
 from spectral_trend_database import smoothing
@@ -33,6 +32,7 @@ from spectral_trend_database import utils
 from spectral_trend_database import paths
 from spectral_trend_database import types
 from spectral_trend_database import interface
+from spectral_trend_database import sharding
 
 
 #
@@ -40,8 +40,9 @@ from spectral_trend_database import interface
 #
 YEARS = range(c.YEARS[0], c.YEARS[1] + 1)
 IDENT_COLS = ['sample_id', 'year', 'date']
-# MAP_METHOD = mproc.map_sequential
-MAP_METHOD = mproc.map_with_threadpool
+# MAP_METHOD = 'sequential'
+# MAP_METHOD = 'pool'
+MAP_METHOD = c.DEFAULT_MAP_METHOD
 SRC_INDICES = ['ndvi', 'evi', 'evi2']
 COLUMNS = ['date', 'sample_id'] + SRC_INDICES
 GROWING_YEAR_BUFFER = timedelta(days=20)
@@ -56,22 +57,15 @@ def process_rows(
         year: int,
         start_date: str,
         end_date: str,
-        local_dest: str,
-        data_vars: list):
+        data_vars: list) -> Union[pd.DataFrame, dict]:
     try:
         ds = rows[['date'] + data_vars].set_index('date').to_xarray()
         ds = smoothing.macd_processor(ds, spans=[5, 10, 5])
         ds = ds.sel(date=slice(start_date, end_date))
         data = ds.to_dataframe().reset_index(drop=False)
-        data['date'] = data.date.apply(lambda d: d.strftime(c.YYYY_MM_DD_FMT))
-        data = data.to_dict('records')
-        utils.append_ldjson(
-            local_dest,
-            data,
-            sample_id=sample_id,
-            year=year,
-            multiline=True,
-            dry_run=c.DRY_RUN)
+        data.insert(0, 'year', year)
+        data.insert(0, 'sample_id', sample_id)
+        return data
     except Exception as e:
         return dict(sample_id=sample_id, year=year, error=str(e))
 
@@ -91,15 +85,25 @@ for year in YEARS:
         c.MACD_FOLDER,
         table_name=c.MACD_TABLE_NAME,
         year=year)
+    if sharding.merging():
+        interface.merge_shards(
+            local_dest,
+            gcs_dest,
+            dataset_name=c.DATASET_NAME,
+            table_name=table_name,
+            dry_run=c.DRY_RUN,
+            asynchronous=True)
+        continue
     start = dt_parse(f'{year-1}-{c.OFF_SEASON_START_YYMM}')
     end = dt_parse(f'{year}-{c.OFF_SEASON_START_YYMM}')
-    utils.make_parent_directories(local_dest)
+    sink = interface.output_sink(local_dest, table_name, dry_run=c.DRY_RUN)
 
     # 2. query data
     print('- run query:')
     qc = query.QueryConstructor(
         c.SMOOTHED_INDICES_TABLE_NAME,
-        table_prefix=f'{c.GCP_PROJECT}.{c.DATASET_NAME}')
+        table_prefix=f'{c.GCP_PROJECT}.{c.DATASET_NAME}',
+        parameterize=True)
     qc.select(*COLUMNS)
     qc.where(
         date=(start - GROWING_YEAR_BUFFER).strftime(c.YYYY_MM_DD_FMT),
@@ -109,24 +113,27 @@ for year in YEARS:
         date_op='<')
     data = query.run(
         sql=qc.sql(),
+        parameters=qc.parameters(),
         to_dataframe=True,
         print_sql=True)
-    data = data.sort_values('date')
-    sample_ids = data.sample_id.unique()
 
     # 3. run
     data_vars = [n for n in data.columns if n not in IDENT_COLS]
-    errors = MAP_METHOD(
-        lambda s: process_rows(
-            data[data.sample_id == s],
-            sample_id=s,
-            year=year,
-            start_date=start.strftime(c.YYYY_MM_DD_FMT),
-            end_date=end.strftime(c.YYYY_MM_DD_FMT),
-            local_dest=local_dest,
-            data_vars=data_vars),
-        sample_ids,
-        max_processes=c.MAX_PROCESSES)
+    errors = interface.map_samples(
+        process_rows,
+        data,
+        method=MAP_METHOD,
+        columns=['date'] + data_vars,
+        on_result=lambda result, sample_id: interface.write_result(
+            result,
+            sink,
+            sample_id=sample_id),
+        pass_key=True,
+        year=year,
+        start_date=start.strftime(c.YYYY_MM_DD_FMT),
+        end_date=end.strftime(c.YYYY_MM_DD_FMT),
+        data_vars=data_vars)
+    sink.close()
 
     # 4. report on errors
     interface.print_errors(errors)
@@ -138,4 +145,9 @@ for year in YEARS:
         dataset_name=c.DATASET_NAME,
         table_name=table_name,
         remove_src=True,
-        dry_run=c.DRY_RUN)
+        dry_run=c.DRY_RUN,
+        asynchronous=True)
+
+
+# wait for outstanding (asynchronous) uploads/table-loads
+interface.wait_for_saves()
@@ -0,0 +1,461 @@
+""" batched (multi-sample) statistics over season windows
+
+DESCRIPTION:
+    computes the per-sample stats of `utils.xr_stats` (mean, median, min, max,
+    skew, kurtosis and optional quantiles for each variable) for all samples
+    and season windows in a few vectorized numpy passes, instead of one small
+    xarray computation per sample and window.
+
+    the long (sample_id, date, var_1, ..., var_n) rows are pivoted into a
+    (sample x var x day) array on a common date grid (missing days are NaN and
+    skipped). windows are converted once to index ranges on the grid and the
+    stats of each window are computed on a view of the array (moments are
+    centred on the window's own mean, see `utils.moments`). samples are
+    processed in batches of <batch_size> to bound memory.
+
+    like the per-sample step-5 code, samples with an empty window or (nearly)
+    constant values (undefined skew/kurtosis) are dropped and reported as
+    warnings.
+
+    season windows are configured with `c.SEASON_WINDOWS`, a list of
+
+        name: window name (ie 'off_season')
+        start: start date (MM-DD, inclusive)
+        end: end date (MM-DD, inclusive)
+        year_offset: start year relative to the (growing) year (default -1)
+        end_year_offset: end year relative to the (growing) year. if missing
+            the first <end> on or after <start>
+        table_suffix: suffix of the output table name (default name.upper(),
+            null for the unsuffixed table)
+
+    windows are clipped to the growing year ([<year-1>-OFF_SEASON_START,
+    <year>-OFF_SEASON_START)). if `c.SEASON_WINDOWS` is not set the windows are
+    the growing year, off-season and growing-season (see `default_season_windows`).
+
+USAGE:
+    ```python
+    from spectral_trend_database import aggregation
+
+    windows = aggregation.season_date_windows(2010)
+    tables, warnings = aggregation.batch_stats(data, data_vars, windows, year=2010)
+    tables['off_season']  # => sample_id, year, ndvi_mean, ..., evi_kurtosis
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from typing import Any, Optional, Sequence, Union
+import re
+import numpy as np
+import pandas as pd
+from spectral_trend_database.config import config as c
+from spectral_trend_database import utils
+
+
+#
+# CONSTANTS
+#
+STATS = ['mean', 'median', 'min', 'max', 'skew', 'kurtosis']
+MOMENT_STATS = ['skew', 'kurtosis']
+DEFAULT_BATCH_SIZE = 250
+GROWING_YEAR = 'growing_year'
+OFF_SEASON = 'off_season'
+GROWING_SEASON = 'growing_season'
+DEFAULT_YEAR_OFFSET = -1
+MMDD_REGEX = r'^\d{2}-\d{2}$'
+EMPTY_WARNING = 'empty window ({})'
+PRECISION_WARNING = 'nearly identical values, skew/kurtosis undefined ({})'
+
+
+#
+# TYPES
+#
+DATE = Union[str, np.datetime64, pd.Timestamp]
+WINDOWS = dict[str, tuple[DATE, DATE]]
+SEASON_WINDOW = dict[str, Any]
+
+
+#
+# SEASON WINDOWS
+#
+def default_season_windows() -> list[SEASON_WINDOW]:
+    """ growing year, off-season and growing-season windows (`c.*_YYMM` dates) """
+    return [
+        dict(
+            name=GROWING_YEAR,
+            start=c.OFF_SEASON_START_YYMM,
+            end=c.OFF_SEASON_START_YYMM,
+            end_year_offset=0,
+            table_suffix=None),
+        dict(
+            name=OFF_SEASON,
+            start=c.OFF_SEASON_START_YYMM,
+            end=c.OFF_SEASON_END_YYMM,
+            end_year_offset=0),
+        dict(
+            name=GROWING_SEASON,
+            start=c.GROWING_SEASON_START_YYMM,
+            end=c.GROWING_SEASON_END_YYMM,
+            end_year_offset=0)]
+
+
+def season_windows(windows: Optional[Sequence[dict]] = None) -> list[SEASON_WINDOW]:
+    """ validated season windows (with defaults filled in)
+
+    Args:
+
+        windows (Optional[Sequence[dict]] = None):
+            season windows. if None use `c.SEASON_WINDOWS` (or, if that is not
+            set, `default_season_windows()`)
+
+    Returns:
+
+        (list[SEASON_WINDOW]) windows with name, start, end, year_offset,
+        end_year_offset and table_suffix keys
+    """
+    if windows is None:
+        windows = c.SEASON_WINDOWS or default_season_windows()
+    result = []
+    for window in windows:
+        window = dict(window)
+        name = window.get('name')
+        start, end = str(window.get('start')), str(window.get('end'))
+        if (not name) or not (re.match(MMDD_REGEX, start) and re.match(MMDD_REGEX, end)):
+            err = (
+                'spectral_trend_database.aggregation.season_windows: '
+                f'window ({window}) requires a name and MM-DD start/end dates'
+            )
+            raise ValueError(err)
+        year_offset = int(window.get('year_offset', DEFAULT_YEAR_OFFSET))
+        end_year_offset = window.get('end_year_offset')
+        if end_year_offset is None:
+            end_year_offset = year_offset + int(end < start)
+        result.append(dict(
+            name=name,
+            start=start,
+            end=end,
+            year_offset=year_offset,
+            end_year_offset=int(end_year_offset),
+            table_suffix=window.get('table_suffix', name.upper())))
+    names = [w['name'] for w in result]
+    suffixes = [w['table_suffix'] for w in result]
+    if (len(set(names)) < len(names)) or (len(set(suffixes)) < len(suffixes)):
+        err = (
+            'spectral_trend_database.aggregation.season_windows: '
+            f'window names ({names}) and table suffixes ({suffixes}) must be unique'
+        )
+        raise ValueError(err)
+    return result
+
+
+def window_dates(window: SEASON_WINDOW, year: int, clip: bool = True) -> tuple[DATE, DATE]:
+    """ (inclusive) start and end dates of season window for (growing) year
+
+    Args:
+
+        window (SEASON_WINDOW): season window (see `season_windows`)
+        year (int): year
+        clip (bool = True): if true clip to the growing year
+            ([<year-1>-OFF_SEASON_START, <year>-OFF_SEASON_START))
+
+    Returns:
+
+        (tuple[DATE, DATE]) start, end timestamps
+    """
+    start = pd.Timestamp(f'{year + window["year_offset"]}-{window["start"]}')
+    end = pd.Timestamp(f'{year + window["end_year_offset"]}-{window["end"]}')
+    if clip:
+        year_start = pd.Timestamp(f'{year - 1}-{c.OFF_SEASON_START_YYMM}')
+        year_end = pd.Timestamp(f'{year}-{c.OFF_SEASON_START_YYMM}') - pd.Timedelta(days=1)
+        start, end = max(start, year_start), min(end, year_end)
+    return start, end
+
+
+def season_date_windows(
+        year: int,
+        windows: Optional[Sequence[dict]] = None) -> WINDOWS:
+    """ name, (start, end) pairs of (clipped) season windows for year (see `batch_stats`) """
+    return {w['name']: window_dates(w, year) for w in season_windows(windows)}
+
+
+def window_ident(window: SEASON_WINDOW) -> str:
+    """ path identifier of window (ie '1201_0315') """
+    return re.sub('-', '', '_'.join([window['start'], window['end']]))
+
+
+def window_table_name(table_name: str, window: SEASON_WINDOW) -> str:
+    """ table name of window (<table_name>_<table_suffix> or <table_name>) """
+    if window['table_suffix']:
+        return f'{table_name}_{window["table_suffix"]}'
+    return table_name
+
+
+#
+# ARRAYS
+#
+def sample_cube(
+        data: pd.DataFrame,
+        data_vars: Sequence[str],
+        key: str = 'sample_id',
+        date_column: Optional[str] = None,
+        dates: Optional[pd.DatetimeIndex] = None) -> tuple[
+            np.ndarray,
+            pd.DatetimeIndex,
+            np.ndarray]:
+    """ pivot long rows into a (sample x var x day) array
+
+    Args:
+
+        data (pd.DataFrame): rows with <key>, <date_column> and <data_vars> columns
+        data_vars (Sequence[str]): variables
+        key (str = 'sample_id'): sample column
+        date_column (Optional[str] = None): date column. if None use `c.DATE_COLUMN`
+        dates (Optional[pd.DatetimeIndex] = None):
+            date grid. if None use the (sorted) unique dates of <data>.
+            rows with dates not on the grid are dropped
+
+    Returns:
+
+        (tuple) sorted sample keys, date grid and float64 array of shape
+        (nb_samples, nb_vars, nb_dates) (NaN where a sample has no row for a date)
+    """
+    date_column = date_column or c.DATE_COLUMN
+    row_dates = pd.DatetimeIndex(pd.to_datetime(data[date_column]))
+    if dates is None:
+        dates = row_dates.unique().sort_values()
+    date_index = dates.get_indexer(row_dates)
+    on_grid = date_index >= 0
+    sample_index, keys = pd.factorize(data[key], sort=True)
+    cube = np.full((len(keys), len(data_vars), len(dates)), np.nan)
+    values = data[list(data_vars)].to_numpy(dtype=np.float64)
+    cube[sample_index[on_grid], :, date_index[on_grid]] = values[on_grid]
+    return np.asarray(keys), dates, cube
+
+
+def window_slices(dates: pd.DatetimeIndex, windows: WINDOWS) -> dict[str, slice]:
+    """ index ranges of (inclusive) date windows on a (sorted) date grid
+
+    Args:
+
+        dates (pd.DatetimeIndex): sorted date grid
+        windows (WINDOWS): name, (start, end) pairs. start and end are inclusive
+
+    Returns:
+
+        (dict[str, slice]) name, slice pairs
+    """
+    slices = dict()
+    for name, (start, end) in windows.items():
+        start_index = dates.searchsorted(pd.Timestamp(start), side='left')
+        end_index = dates.searchsorted(pd.Timestamp(end), side='right')
+        slices[name] = slice(int(start_index), int(max(start_index, end_index)))
+    return slices
+
+
+#
+# STATS
+#
+def nan_stats(
+        values: np.ndarray,
+        axis: int = -1,
+        skew_kurtosis: bool = True,
+        quantiles: Optional[Sequence[float]] = None) -> dict[str, np.ndarray]:
+    """ NaN-skipping stats along <axis>
+
+    count, mean and central moments come from a single pass (`utils.moments`),
+    the median and <quantiles> from partitioning (`utils.nan_quantiles`).
+    skew and kurtosis are the (biased) Fisher-Pearson skew and excess kurtosis
+    (the defaults of `scipy.stats.skew` and `scipy.stats.kurtosis`). they are NaN
+    where values are (nearly) identical.
+
+    Args:
+
+        values (np.ndarray): values
+        axis (int = -1): axis along which to compute stats
+        skew_kurtosis (bool = True): if true also include skew, kurtosis in stats
+        quantiles (Optional[Sequence[float]] = None):
+            additional quantiles (in [0, 1]) named `utils.quantile_name(q)`
+
+    Returns:
+
+        (dict[str, np.ndarray]) stat-name, values pairs (including `count`)
+    """
+    quantiles = list(quantiles or [])
+    mmts = utils.moments(values, axis=axis)
+    quantile_values = utils.nan_quantiles(values, [0.5] + quantiles, axis=axis)
+    result = dict(
+        count=mmts['count'],
+        mean=mmts['mean'],
+        median=quantile_values[0],
+        min=utils.nan_reduce(np.nanmin, values, axis=axis),
+        max=utils.nan_reduce(np.nanmax, values, axis=axis))
+    if skew_kurtosis:
+        result['skew'], result['kurtosis'] = utils.skew_kurtosis_from_moments(mmts)
+    for q, q_values in zip(quantiles, quantile_values[1:]):
+        result[utils.quantile_name(q)] = q_values
+    return result
+
+
+def window_stats(
+        cube: np.ndarray,
+        slices: dict[str, slice],
+        skew_kurtosis: bool = True,
+        quantiles: Optional[Sequence[float]] = None) -> dict[str, dict[str, np.ndarray]]:
+    """ stats for each window of a (sample x var x day) array
+
+    stats are computed on views of <cube> (see `nan_stats`). moments are
+    centred on the mean of each window, so low-variance windows (ie a flat
+    off-season within a year with a strong seasonal peak) keep their precision.
+
+    Args:
+
+        cube (np.ndarray): (sample x var x day) values (see `sample_cube`)
+        slices (dict[str, slice]): name, day-index slice pairs (see `window_slices`)
+        skew_kurtosis (bool = True): if true also include skew, kurtosis in stats
+        quantiles (Optional[Sequence[float]] = None): additional quantiles (see `nan_stats`)
+
+    Returns:
+
+        (dict) name, (stat-name, (sample x var) values) pairs
+    """
+    return {
+        name: nan_stats(
+            cube[:, :, day_slice],
+            axis=-1,
+            skew_kurtosis=skew_kurtosis,
+            quantiles=quantiles)
+        for name, day_slice in slices.items()}
+
+
+def stat_names(
+        skew_kurtosis: bool = True,
+        quantiles: Optional[Sequence[float]] = None) -> list[str]:
+    """ names of stats (in `utils.xr_stats` order) """
+    names = STATS if skew_kurtosis else [s for s in STATS if s not in MOMENT_STATS]
+    return names + [utils.quantile_name(q) for q in (quantiles or [])]
+
+
+def stats_frame(
+        stats: dict[str, np.ndarray],
+        data_vars: Sequence[str],
+        skew_kurtosis: bool = True,
+        quantiles: Optional[Sequence[float]] = None,
+        **columns: Any) -> pd.DataFrame:
+    """ (sample x var) stats to table with `utils.xr_stats` column names and order
+
+    Args:
+
+        stats (dict[str, np.ndarray]): stat-name, (sample x var) values pairs
+        data_vars (Sequence[str]): variables
+        skew_kurtosis (bool = True): if true include skew, kurtosis columns
+        quantiles (Optional[Sequence[float]] = None): quantile columns (see `nan_stats`)
+        **columns: leading columns (ie sample_id=<keys>, year=2010)
+
+    Returns:
+
+        (pd.DataFrame) table with <columns> then <var>_<stat> columns
+    """
+    nb_rows = stats['mean'].shape[0]
+    table = {
+        name: (value if np.ndim(value) else np.full(nb_rows, value))
+        for name, value in columns.items()}
+    for name in stat_names(skew_kurtosis=skew_kurtosis, quantiles=quantiles):
+        for index, data_var in enumerate(data_vars):
+            table[f'{data_var}_{name}'] = stats[name][:, index]
+    return pd.DataFrame(table)
+
+
+def invalid_samples(
+        stats: dict[str, np.ndarray],
+        window: str,
+        skew_kurtosis: bool = True) -> dict[int, str]:
+    """ samples (row-index) whose stats are undefined, with warning message
+
+    Args:
+
+        stats (dict[str, np.ndarray]): stat-name, (sample x var) values pairs
+        window (str): window name (for warning message)
+        skew_kurtosis (bool = True): if true check skew, kurtosis
+
+    Returns:
+
+        (dict[int, str]) row-index, warning pairs
+    """
+    invalid = dict()
+    if skew_kurtosis:
+        loss = utils.precision_loss(stats['count'], stats['mean'], stats['min'], stats['max'])
+        for index in np.flatnonzero(loss.any(axis=1)):
+            invalid[int(index)] = PRECISION_WARNING.format(window)
+    for index in np.flatnonzero((stats['count'] == 0).any(axis=1)):
+        invalid[int(index)] = EMPTY_WARNING.format(window)
+    return invalid
+
+
+def batch_stats(
+        data: pd.DataFrame,
+        data_vars: Sequence[str],
+        windows: WINDOWS,
+        key: str = 'sample_id',
+        date_column: Optional[str] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        skew_kurtosis: bool = True,
+        quantiles: Optional[Sequence[float]] = None,
+        **columns: Any) -> tuple[dict[str, pd.DataFrame], list[dict]]:
+    """ stats tables (one per window) for all samples in <data>
+
+    Args:
+
+        data (pd.DataFrame): rows with <key>, <date_column> and <data_vars> columns
+        data_vars (Sequence[str]): variables
+        windows (WINDOWS): name, (start, end) pairs. start and end are inclusive
+        key (str = 'sample_id'): sample column
+        date_column (Optional[str] = None): date column. if None use `c.DATE_COLUMN`
+        batch_size (int = DEFAULT_BATCH_SIZE): number of samples per vectorized batch
+        skew_kurtosis (bool = True): if true also include skew, kurtosis in stats
+        quantiles (Optional[Sequence[float]] = None): additional quantiles (see `nan_stats`)
+        **columns: constant valued columns added after <key> (ie year=2010)
+
+    Returns:
+
+        (tuple) window-name, table pairs and list of warnings
+        (dicts with <key>, <columns>, warning and error keys. see `interface.print_errors`)
+    """
+    date_column = date_column or c.DATE_COLUMN
+    dates = pd.DatetimeIndex(pd.to_datetime(data[date_column]).unique()).sort_values()
+    slices = window_slices(dates, windows)
+    sample_index, keys = pd.factorize(data[key], sort=True)
+    order = np.argsort(sample_index, kind='stable')
+    bounds = np.searchsorted(sample_index[order], np.arange(0, len(keys) + batch_size, batch_size))
+    frames: dict[str, list[pd.DataFrame]] = {name: [] for name in windows}
+    errors: list[dict] = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        rows = data.iloc[order[start:end]]
+        batch_keys, _, cube = sample_cube(
+            rows,
+            data_vars,
+            key=key,
+            date_column=date_column,
+            dates=dates)
+        stats = window_stats(cube, slices, skew_kurtosis=skew_kurtosis, quantiles=quantiles)
+        invalid: dict[int, str] = dict()
+        for name, window in stats.items():
+            invalid.update(invalid_samples(window, name, skew_kurtosis=skew_kurtosis))
+        keep = np.ones(len(batch_keys), dtype=bool)
+        keep[list(invalid)] = False
+        for index, warning in invalid.items():
+            errors.append({key: batch_keys[index], **columns, 'warning': warning, 'error': None})
+        for name, window in stats.items():
+            window = {stat: values[keep] for stat, values in window.items()}
+            frames[name].append(stats_frame(
+                window,
+                data_vars,
+                skew_kurtosis=skew_kurtosis,
+                quantiles=quantiles,
+                **{key: batch_keys[keep]},
+                **columns))
+    tables = {
+        name: (pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame())
+        for name, dfs in frames.items()}
+    return tables, errors
@@ -0,0 +1,522 @@
+""" benchmark suite
+
+DESCRIPTION:
+    times core conversions and processors on synthetic landsat-like data at
+    several scales (number of samples), so changes to `smoothing`, `npxr`,
+    `spectral` or `utils` can be checked for speed regressions.
+
+    synthetic samples mimic landsat cadence (two satellites, 16 days apart,
+    offset by 8 days), persistent cloud gaps, undetected cloud/shadow "drops"
+    and a seasonal vegetation cycle.
+
+    import-time benchmarks (`import_<module>`) run `python -X importtime` in a
+    fresh interpreter and record the cumulative import time of the module.
+    they do not depend on the number of samples and run once per benchmark.
+
+    results are saved as json (see `save_results`) and compared against a
+    baseline result file (see `compare`). run with `stdb bench`.
+
+USAGE:
+    ```python
+    from spectral_trend_database import bench
+
+    results = bench.run(scales=[10, 100], repeat=3)
+    dest = bench.save_results(results, 'benchmarks')
+    print(bench.compare(results, bench.load_results('benchmarks/<baseline>.json')))
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Optional, Sequence
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from spectral_trend_database import lazy
+from spectral_trend_database import smoothing
+from spectral_trend_database import spectral
+from spectral_trend_database import utils
+if TYPE_CHECKING:
+    import xarray as xr
+else:
+    xr = lazy.lazy_import('xarray')
+
+
+#
+# CONSTANTS
+#
+# landsat.HARMONIZED_BANDS (not imported: `gee` requires earth-engine)
+BANDS = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'st']
+INDICES = ['ndvi', 'evi', 'evi2']
+DEFAULT_SCALES = [10, 100]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+DEFAULT_RESULTS_DIR = 'benchmarks'
+RESULTS_TMPL = 'stdb-bench.{timestamp}.json'
+TIMESTAMP_FMT = '%Y%m%d-%H%M%S'
+SATELLITE_REVISIT = 16
+SATELLITE_OFFSET = 8
+CLOUD_FRACTION = 0.35
+CLOUD_PERSISTENCE = 0.6
+DROP_FRACTION = 0.05
+START_DATE = '2009-06-01'
+NB_DAYS = 730
+SEED = 1234
+MACD_SPANS = [5, 10, 5]
+ROOT_MODULE = 'spectral_trend_database'
+IMPORT_MODULES = ['cli', 'config', 'utils', 'query', 'smoothing', 'interface', 'pipeline']
+IMPORT_TIME_REGEX = r'^import time:\s*\d+\s*\|\s*(\d+)\s*\|\s*(\S+)\s*$'
+
+
+#
+# SYNTHETIC DATA
+#
+def synthetic_landsat(
+        nb_samples: int,
+        start_date: str = START_DATE,
+        nb_days: int = NB_DAYS,
+        cloud_fraction: float = CLOUD_FRACTION,
+        drop_fraction: float = DROP_FRACTION,
+        seed: int = SEED) -> pd.DataFrame:
+    """ synthetic landsat-like observations
+
+    Args:
+
+        nb_samples (int): number of samples
+        start_date (str = START_DATE): first date
+        nb_days (int = NB_DAYS): number of days
+        cloud_fraction (float = CLOUD_FRACTION): (approximate) fraction of cloudy observations
+        drop_fraction (float = DROP_FRACTION): fraction of (unmasked) cloud/shadow "drops"
+        seed (int = SEED): random seed
+
+    Returns:
+
+        (pd.DataFrame) rows with columns sample_id, year, date and BANDS
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start_date, periods=nb_days, freq='D')
+    frames = []
+    for index in range(nb_samples):
+        # two satellites, each with a 16 day revisit, 8 days apart
+        first = rng.integers(0, SATELLITE_OFFSET)
+        days = np.sort(np.concatenate([
+            np.arange(first, nb_days, SATELLITE_REVISIT),
+            np.arange(first + SATELLITE_OFFSET, nb_days, SATELLITE_REVISIT)]))
+        days = days[_clear_sky(len(days), cloud_fraction, rng)]
+        doy = dates[days].dayofyear.to_numpy()
+        peak = rng.normal(200, 10)
+        greenness = rng.uniform(0.4, 0.8) * np.exp(-((doy - peak) / rng.uniform(25, 40)) ** 2)
+        noise = rng.normal(0, 0.01, (len(BANDS), len(days)))
+        values = {
+            'blue': 0.06 - 0.02 * greenness,
+            'green': 0.09 + 0.01 * greenness,
+            'red': 0.10 - 0.06 * greenness,
+            'nir': 0.25 + 0.30 * greenness,
+            'swir1': 0.25 - 0.08 * greenness,
+            'swir2': 0.18 - 0.08 * greenness,
+            'st': 290 + 10 * np.sin(2 * np.pi * (doy - 110) / 365)}
+        df = pd.DataFrame({
+            band: values[band] + noise[i] for i, band in enumerate(BANDS)})
+        drops = rng.random(len(days)) < drop_fraction
+        df.loc[drops, 'nir'] = df.loc[drops, 'red'] * rng.uniform(1.0, 1.3, drops.sum())
+        df.insert(0, 'date', dates[days])
+        df.insert(0, 'year', dates[days].year)
+        df.insert(0, 'sample_id', f'sample-{index:06d}')
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def synthetic_daily(
+        nb_samples: int,
+        data_vars: Sequence[str] = INDICES,
+        nb_days: int = NB_DAYS,
+        seed: int = SEED) -> list[xr.Dataset]:
+    """ synthetic (smoothed) daily datasets
+
+    Args:
+
+        nb_samples (int): number of samples
+        data_vars (Sequence[str] = INDICES): data_var names
+        nb_days (int = NB_DAYS): number of days
+        seed (int = SEED): random seed
+
+    Returns:
+
+        (list[xr.Dataset]) daily datasets (one per sample) with a `date` coord
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(START_DATE, periods=nb_days, freq='D')
+    doy = dates.dayofyear.to_numpy()
+    datasets = []
+    for _ in range(nb_samples):
+        data = {
+            name: ('date', 0.2 + 0.5 * np.exp(-((doy - rng.normal(200, 10)) / 30) ** 2))
+            for name in data_vars}
+        datasets.append(xr.Dataset(data_vars=data, coords=dict(date=dates)))
+    return datasets
+
+
+#
+# BENCHMARKS
+#
+def setup_rows_to_xr(nb_samples: int) -> Callable:
+    groups = [rows for _, rows in synthetic_landsat(nb_samples).groupby('sample_id')]
+
+    def _run():
+        return [utils.rows_to_xr(rows, cols=BANDS, attr_cols=['sample_id']) for rows in groups]
+    return _run
+
+
+def setup_add_index_arrays(nb_samples: int) -> Callable:
+    data = synthetic_landsat(nb_samples)
+    indices = spectral.index_config()
+
+    def _run():
+        return spectral.add_index_arrays(data, indices=indices)
+    return _run
+
+
+def setup_savitzky_golay_processor(nb_samples: int) -> Callable:
+    data = synthetic_landsat(nb_samples)
+    data['ndvi'] = (data.nir - data.red) / (data.nir + data.red)
+    datasets = [
+        utils.rows_to_xr(rows, cols=BANDS + ['ndvi'])
+        for _, rows in data.groupby('sample_id')]
+
+    def _run():
+        return [smoothing.savitzky_golay_processor(ds) for ds in datasets]
+    return _run
+
+
+def setup_macd_processor(nb_samples: int) -> Callable:
+    datasets = synthetic_daily(nb_samples)
+
+    def _run():
+        return [smoothing.macd_processor(ds, spans=MACD_SPANS) for ds in datasets]
+    return _run
+
+
+def setup_xr_stats(nb_samples: int) -> Callable:
+    datasets = synthetic_daily(nb_samples, data_vars=BANDS + INDICES, nb_days=365)
+
+    def _run():
+        return [utils.xr_stats(ds) for ds in datasets]
+    return _run
+
+
+def setup_dataframe_to_ldjson(nb_samples: int) -> Callable:
+    return _writer(nb_samples, utils.dataframe_to_ldjson, 'json')
+
+
+def setup_dataframe_to_parquet(nb_samples: int) -> Callable:
+    return _writer(nb_samples, utils.dataframe_to_parquet, 'parquet')
+
+
+def setup_import_time(module: str) -> Callable[[int], Callable]:
+    """ import-time benchmark setup for `spectral_trend_database.<module>` """
+    def _setup(nb_samples: int) -> Callable:
+        def _run():
+            return Measured(import_time(f'{ROOT_MODULE}.{module}'))
+        return _run
+    return _setup
+
+
+BENCHMARKS: dict[str, Callable[[int], Callable]] = {
+    'rows_to_xr': setup_rows_to_xr,
+    'add_index_arrays': setup_add_index_arrays,
+    'savitzky_golay_processor': setup_savitzky_golay_processor,
+    'macd_processor': setup_macd_processor,
+    'xr_stats': setup_xr_stats,
+    'dataframe_to_ldjson': setup_dataframe_to_ldjson,
+    'dataframe_to_parquet': setup_dataframe_to_parquet,
+    **{f'import_{m}': setup_import_time(m) for m in IMPORT_MODULES}
+}
+# benchmarks that do not depend on the number of samples (run once with scale=1)
+SCALE_FREE_BENCHMARKS: list[str] = [f'import_{m}' for m in IMPORT_MODULES]
+
+
+#
+# IMPORT TIME
+#
+class Measured(float):
+    """ seconds measured by a benchmark itself (used in place of its wall time) """
+
+
+def import_time(module: str) -> float:
+    """ cumulative import time (seconds) of <module> in a fresh interpreter
+
+    uses `python -X importtime`, so interpreter start-up is excluded.
+
+    Args:
+
+        module (str): module name
+
+    Returns:
+
+        (float) seconds
+    """
+    env = dict(os.environ)
+    package_dir = str(Path(__file__).resolve().parent.parent)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_dir, env.get('PYTHONPATH')]))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        env=env)
+    if proc.returncode:
+        err = (
+            'spectral_trend_database.bench.import_time: '
+            f'failed to import {module} ({proc.stderr.strip().splitlines()[-1:]})'
+        )
+        raise ValueError(err)
+    for line in proc.stderr.splitlines():
+        match = re.match(IMPORT_TIME_REGEX, line)
+        if match and (match.group(2) == module):
+            return int(match.group(1)) / 1e6
+    err = (
+        'spectral_trend_database.bench.import_time: '
+        f'{module} not found in importtime output (already imported by a parent package?)'
+    )
+    raise ValueError(err)
+
+
+#
+# RUN
+#
+def time_function(
+        func: Callable,
+        repeat: int = DEFAULT_REPEAT,
+        warmup: bool = True) -> list[float]:
+    """ wall times (seconds) of <repeat> calls of <func>
+
+    if <func> returns a `Measured` value it is used in place of the wall time.
+    if <warmup> <func> is called once (untimed) first, so dependencies that are
+    imported on first use (see `lazy`) are not included in the timings.
+    """
+    if warmup:
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if isinstance(result, Measured):
+            elapsed = float(result)
+        times.append(elapsed)
+    return times
+
+
+def run(
+        names: Optional[Sequence[str]] = None,
+        scales: Sequence[int] = DEFAULT_SCALES,
+        repeat: int = DEFAULT_REPEAT,
+        noisy: bool = True) -> dict:
+    """ run benchmarks
+
+    Args:
+
+        names (Optional[Sequence[str]] = None): benchmark names. if None run all BENCHMARKS
+        scales (Sequence[int] = DEFAULT_SCALES): numbers of samples
+        repeat (int = DEFAULT_REPEAT): number of timed calls per benchmark and scale
+        noisy (bool = True): if true print results as they complete
+
+    Returns:
+
+        (dict) results with keys timestamp, metadata, results (list of dicts
+        with benchmark, scale, repeat, min, median, mean, per_sample) and skipped
+        (dict of benchmark-name, reason pairs for benchmarks that could not run)
+    """
+    names = list(names or BENCHMARKS)
+    invalid = [n for n in names if n not in BENCHMARKS]
+    if invalid:
+        err = (
+            'spectral_trend_database.bench.run: '
+            f'invalid benchmarks ({invalid}) must be in {list(BENCHMARKS)}.'
+        )
+        raise ValueError(err)
+    results = []
+    skipped = {}
+    for name in names:
+        for scale in ([1] if name in SCALE_FREE_BENCHMARKS else scales):
+            try:
+                func = BENCHMARKS[name](scale)
+            except ImportError as e:
+                skipped[name] = str(e)
+                if noisy:
+                    print(f'- {name}: skipped ({e})')
+                break
+            times = time_function(func, repeat=repeat)
+            result = dict(
+                benchmark=name,
+                scale=scale,
+                repeat=repeat,
+                min=min(times),
+                median=statistics.median(times),
+                mean=statistics.mean(times),
+                per_sample=min(times) / scale)
+            results.append(result)
+            if noisy:
+                print(f'- {name} [{scale}]: {result["min"]:.4f}s (median {result["median"]:.4f}s)')
+    return dict(
+        timestamp=datetime.now().strftime(TIMESTAMP_FMT),
+        metadata=metadata(),
+        results=results,
+        skipped=skipped)
+
+
+def metadata() -> dict:
+    """ environment metadata stored with results """
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        numpy=np.__version__,
+        pandas=pd.__version__,
+        xarray=xr.__version__,
+        commit=_git_commit())
+
+
+#
+# RESULTS
+#
+def save_results(results: dict, dest: str = DEFAULT_RESULTS_DIR) -> str:
+    """ save results as json
+
+    Args:
+
+        results (dict): results (see `run`)
+        dest (str = DEFAULT_RESULTS_DIR):
+            json file path or directory. for a directory the file name is
+            RESULTS_TMPL
+
+    Returns:
+
+        (str) path of saved file
+    """
+    path = Path(dest)
+    if path.suffix != '.json':
+        path = path / RESULTS_TMPL.format(timestamp=results['timestamp'])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+    return str(path)
+
+
+def load_results(src: str) -> dict:
+    """ load json results """
+    with open(src, 'r') as file:
+        return json.load(file)
+
+
+def latest_results(src: str = DEFAULT_RESULTS_DIR, exclude: Optional[str] = None) -> Optional[str]:
+    """ path of most recent results file in directory (or None)
+
+    Args:
+
+        src (str = DEFAULT_RESULTS_DIR): results directory
+        exclude (Optional[str] = None): path to ignore (ie the current results)
+
+    Returns:
+
+        (Optional[str]) path
+    """
+    paths = sorted(
+        str(p) for p in Path(src).glob(RESULTS_TMPL.format(timestamp='*'))
+        if str(p) != exclude)
+    return paths[-1] if paths else None
+
+
+def compare(
+        results: dict,
+        baseline: dict,
+        threshold: float = DEFAULT_THRESHOLD) -> pd.DataFrame:
+    """ compare results to baseline results
+
+    Args:
+
+        results (dict): results (see `run`)
+        baseline (dict): baseline results
+        threshold (float = DEFAULT_THRESHOLD):
+            relative change in (min) time above which a benchmark is flagged
+            as 'slower' or 'faster'
+
+    Returns:
+
+        (pd.DataFrame) benchmark, scale, baseline, current, ratio (current/baseline), status
+    """
+    base = {(r['benchmark'], r['scale']): r['min'] for r in baseline['results']}
+    rows = []
+    for result in results['results']:
+        key = (result['benchmark'], result['scale'])
+        if key not in base:
+            continue
+        ratio = result['min'] / base[key]
+        if ratio > 1 + threshold:
+            status = 'slower'
+        elif ratio < 1 - threshold:
+            status = 'faster'
+        else:
+            status = 'same'
+        rows.append(dict(
+            benchmark=key[0],
+            scale=key[1],
+            baseline=base[key],
+            current=result['min'],
+            ratio=ratio,
+            status=status))
+    return pd.DataFrame(
+        rows,
+        columns=['benchmark', 'scale', 'baseline', 'current', 'ratio', 'status'])
+
+
+#
+# INTERNAL
+#
+def _clear_sky(nb_obs: int, cloud_fraction: float, rng: np.random.Generator) -> np.ndarray:
+    """ clear-sky mask with persistent (markov) cloudy periods """
+    cloudy = np.zeros(nb_obs, dtype=bool)
+    # stationary cloud fraction of the two-state chain is <cloud_fraction>
+    p_cloudy = cloud_fraction * (1 - CLOUD_PERSISTENCE) / (1 - cloud_fraction)
+    for i in range(1, nb_obs):
+        p = CLOUD_PERSISTENCE if cloudy[i - 1] else p_cloudy
+        cloudy[i] = rng.random() < p
+    return ~cloudy
+
+
+def _writer(nb_samples: int, writer: Callable, ext: str) -> Callable:
+    datasets = synthetic_daily(nb_samples, data_vars=BANDS + INDICES, nb_days=365)
+    frames = []
+    for index, ds in enumerate(datasets):
+        df = ds.to_dataframe().reset_index()
+        df.insert(0, 'sample_id', f'sample-{index:06d}')
+        frames.append(df)
+    data = pd.concat(frames, ignore_index=True)
+    dest = f'{tempfile.gettempdir()}/stdb-bench.{ext}'
+
+    def _run():
+        # copy: dataframe_to_ldjson converts the date column in place
+        return writer(data.copy(), dest=dest, noisy=False)
+    return _run
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent).stdout.strip()
+    except Exception:
+        return None
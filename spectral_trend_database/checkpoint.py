@@ -0,0 +1,364 @@
+""" checkpoint/resume manifest for per-year, per-sample runs
+
+DESCRIPTION:
+    a (local sqlite) manifest of completed (step, year, sample_id) units, the
+    output shard holding each unit's rows, and the (step, year) pairs that have
+    been finalised (merged, uploaded and loaded).
+
+    `CheckpointSink` is a drop-in replacement for `utils.ShardedTableSink`.
+    rows are written to small, complete shard files of <batch_size> samples.
+    once a shard file is closed its samples are recorded as completed, so after
+    a crash (EE quota, preemption) a restarted script skips completed samples
+    and only reprocesses those whose shard was never closed. when the year is
+    complete `merge` combines the shards of all runs into the output file.
+
+    if `c.CHECKPOINT_PATH` is not set the manifest is kept in memory, so runs
+    behave as before (nothing is skipped on restart).
+
+    for sharded runs (`c.SHARD`, see `sharding`) steps are recorded per shard,
+    so several shards can share a manifest.
+
+USAGE:
+    ```python
+    from spectral_trend_database import checkpoint
+
+    manifest = checkpoint.Checkpoint()
+    for year in years:
+        if manifest.is_finalized('step-4', year):
+            continue
+        completed = manifest.completed('step-4', year)
+        sink = manifest.sink('step-4', year, local_dest)
+        ... write rows for samples not in <completed> ...
+        sink.close()
+        src = sink.merge()
+        future = interface.save_to_gcp(src, ..., asynchronous=True)
+        manifest.finalize_when_done(future, 'step-4', year)
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from typing import Any, Optional, Sequence, Union
+import sqlite3
+import threading
+import secrets
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+from spectral_trend_database.config import config as c
+from spectral_trend_database import utils
+from spectral_trend_database import sharding
+from spectral_trend_database import types
+
+
+#
+# CONSTANTS
+#
+MEMORY_DATABASE = ':memory:'
+DEFAULT_BATCH_SIZE = 500
+SHARD_TMPL = '{stem}.part-{token}{suffix}'
+SAMPLE_ID_COLUMN = 'sample_id'
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS units (
+        step TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        sample_id TEXT NOT NULL,
+        shard TEXT,
+        completed_at TEXT NOT NULL,
+        PRIMARY KEY (step, year, sample_id))
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS finalized (
+        step TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        dest TEXT,
+        finalized_at TEXT NOT NULL,
+        PRIMARY KEY (step, year))
+    """
+]
+
+
+#
+# MANIFEST
+#
+class Checkpoint(object):
+    """ sqlite manifest of completed units and finalised years """
+    def __init__(self, path: Optional[str] = None, shard: sharding.SHARD = None) -> None:
+        """
+        Args:
+
+            path (Optional[str] = None):
+                path to sqlite manifest. if None use `c.CHECKPOINT_PATH`
+                (if that is not set the manifest is kept in memory)
+            shard (sharding.SHARD = None):
+                'i/n' or (i, n). if None use `c.SHARD`. if set steps are
+                recorded per shard (see `sharding.shard_label`)
+        """
+        self.shard = sharding.parse_shard(shard) or sharding.current_shard()
+        if path is None:
+            path = c.CHECKPOINT_PATH or MEMORY_DATABASE
+        if path != MEMORY_DATABASE:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            for sql in SCHEMA:
+                self._connection.execute(sql)
+
+    def completed(self, step: str, year: int) -> set[str]:
+        """ sample-ids completed for step/year """
+        rows = self._fetch(
+            'SELECT sample_id FROM units WHERE step = ? AND year = ?',
+            (self._step(step), year))
+        return {row[0] for row in rows}
+
+    def shards(self, step: str, year: int) -> list[str]:
+        """ (existing) shard files for step/year """
+        rows = self._fetch(
+            'SELECT DISTINCT shard FROM units WHERE step = ? AND year = ? AND shard IS NOT NULL',
+            (self._step(step), year))
+        return sorted(row[0] for row in rows if Path(row[0]).is_file())
+
+    def mark_completed(
+            self,
+            step: str,
+            year: int,
+            sample_ids: Sequence[str],
+            shard: Optional[str] = None) -> None:
+        """ record sample-ids (and the shard containing their rows) as completed
+
+        samples without rows are recorded with <shard> None. a None <shard> does
+        not replace the shard of a previously recorded sample.
+        """
+        now = _now()
+        self._execute(
+            'INSERT INTO units VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (step, year, sample_id) DO UPDATE SET '
+            'shard = COALESCE(excluded.shard, units.shard), '
+            'completed_at = excluded.completed_at',
+            [(self._step(step), year, str(s), shard, now) for s in sample_ids],
+            many=True)
+
+    def is_finalized(self, step: str, year: int) -> bool:
+        """ true if step/year has been finalised """
+        rows = self._fetch(
+            'SELECT 1 FROM finalized WHERE step = ? AND year = ?',
+            (self._step(step), year))
+        return bool(rows)
+
+    def finalize(
+            self,
+            step: str,
+            year: int,
+            dest: Optional[str] = None,
+            remove_shards: bool = True) -> None:
+        """ mark step/year as finalised and (optionally) remove its shard files """
+        shards = self.shards(step, year)
+        self._execute(
+            'INSERT OR REPLACE INTO finalized VALUES (?, ?, ?, ?)',
+            (self._step(step), year, dest, _now()))
+        if remove_shards:
+            for shard in shards:
+                Path(shard).unlink(missing_ok=True)
+
+    def finalize_when_done(
+            self,
+            future: Union[Future, None],
+            step: str,
+            year: int,
+            dest: Optional[str] = None,
+            remove_shards: bool = True) -> None:
+        """ finalise step/year once <future> (ie an asynchronous `save_to_gcp`) succeeds
+
+        if <future> is None, finalise immediately
+        """
+        if future is None:
+            self.finalize(step, year, dest=dest, remove_shards=remove_shards)
+        else:
+            def _callback(done: Future) -> None:
+                if (not done.cancelled()) and (done.exception() is None):
+                    self.finalize(step, year, dest=dest, remove_shards=remove_shards)
+            future.add_done_callback(_callback)
+
+    def reset(self, step: str, year: Optional[int] = None) -> None:
+        """ remove manifest entries for step (and year) """
+        step = self._step(step)
+        if year is None:
+            where, args = 'step = ?', (step,)
+        else:
+            where, args = 'step = ? AND year = ?', (step, year)  # type: ignore[assignment]
+        self._execute(f'DELETE FROM units WHERE {where}', args)
+        self._execute(f'DELETE FROM finalized WHERE {where}', args)
+
+    def sink(
+            self,
+            step: str,
+            year: int,
+            dest: str,
+            float_type: types.FLOAT_TYPE = utils.DEFAULT_FLOAT_TYPE,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            dry_run: bool = False,
+            noisy: bool = True) -> 'CheckpointSink':
+        """ checkpointed output sink for step/year (see `CheckpointSink`) """
+        return CheckpointSink(
+            self,
+            step=step,
+            year=year,
+            dest=dest,
+            float_type=float_type,
+            batch_size=batch_size,
+            dry_run=dry_run,
+            noisy=noisy)
+
+    def close(self) -> None:
+        """ close sqlite connection """
+        with self._lock:
+            self._connection.close()
+
+    def _step(self, step: str) -> str:
+        if self.shard is None:
+            return step
+        return sharding.shard_label(step, self.shard)
+
+    def _execute(self, sql: str, args: Any, many: bool = False) -> None:
+        with self._lock, self._connection:
+            if many:
+                self._connection.executemany(sql, args)
+            else:
+                self._connection.execute(sql, args)
+
+    def _fetch(self, sql: str, args: tuple) -> list:
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+
+#
+# SINK
+#
+class CheckpointSink(object):
+    """ thread-safe output sink that records completed samples in a `Checkpoint`
+
+    rows are buffered until <batch_size> samples have been written. the batch
+    is then written to its own (complete) shard file and its samples are marked
+    as completed.
+    """
+    def __init__(
+            self,
+            checkpoint: Checkpoint,
+            step: str,
+            year: int,
+            dest: str,
+            float_type: types.FLOAT_TYPE = utils.DEFAULT_FLOAT_TYPE,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            dry_run: bool = False,
+            noisy: bool = True) -> None:
+        """
+        Args:
+
+            checkpoint (Checkpoint): manifest
+            step (str): step name
+            year (int): year
+            dest (str): local dest of merged file (the file format is taken from its extension)
+            float_type (types.FLOAT_TYPE = 'float64'): float type for parquet files
+            batch_size (int = DEFAULT_BATCH_SIZE): number of samples per shard
+            dry_run (bool = True): if true print message but don't save
+            noisy (bool = True): if true print destination
+        """
+        self.checkpoint = checkpoint
+        self.step = step
+        self.year = year
+        self.dest = dest
+        self.file_format = utils.file_format_from_path(dest)
+        self.float_type = float_type
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.noisy = noisy
+        self._frames: list[pd.DataFrame] = []
+        self._sample_ids: set[str] = set()
+        self._empty_ids: set[str] = set()
+        self._lock = threading.Lock()
+        if noisy:
+            if dry_run:
+                print('- dry_run [local]:', dest)
+            else:
+                print('- local:', dest)
+        if not dry_run:
+            Path(dest).parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, data: Union[pd.DataFrame, list[dict], dict], **shared) -> None:
+        """ buffer rows. <data> (or <shared>) must contain a `sample_id` column
+
+        samples without rows (empty <data> with `sample_id` in <shared>) are
+        marked as completed with the next batch.
+        """
+        if self.dry_run:
+            return None
+        df = utils.records_to_dataframe(data, **shared)
+        with self._lock:
+            if df.empty:
+                if shared.get(SAMPLE_ID_COLUMN) is not None:
+                    self._empty_ids.add(str(shared[SAMPLE_ID_COLUMN]))
+            else:
+                self._frames.append(df)
+                self._sample_ids.update(df[SAMPLE_ID_COLUMN].astype(str).unique())
+            if len(self._sample_ids | self._empty_ids) >= self.batch_size:
+                self._write_shard()
+
+    def close(self) -> None:
+        """ write remaining buffered rows """
+        with self._lock:
+            self._write_shard()
+
+    def merge(self) -> Union[str, None]:
+        """ merge shards of all runs for step/year into <dest>
+
+        Returns:
+
+            <dest> if any shards exist otherwise None
+        """
+        if self.dry_run:
+            return None
+        shards = self.checkpoint.shards(self.step, self.year)
+        if shards:
+            return utils.merge_table_files(shards, self.dest, file_format=self.file_format)
+        else:
+            return None
+
+    def __enter__(self) -> 'CheckpointSink':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _write_shard(self) -> None:
+        empty_ids = self._empty_ids - self._sample_ids
+        if empty_ids:
+            self.checkpoint.mark_completed(self.step, self.year, sorted(empty_ids))
+            self._empty_ids = set()
+        if not self._frames:
+            return None
+        path = Path(self.dest)
+        shard = str(path.parent / SHARD_TMPL.format(
+            stem=path.stem,
+            token=secrets.token_hex(8),
+            suffix=path.suffix))
+        utils.save_dataframe(
+            pd.concat(self._frames, ignore_index=True),
+            dest=shard,
+            file_format=self.file_format,
+            float_type=self.float_type,
+            create_dirs=False,
+            noisy=False)
+        self.checkpoint.mark_completed(self.step, self.year, sorted(self._sample_ids), shard)
+        self._frames = []
+        self._sample_ids = set()
+
+
+#
+# INTERNAL
+#
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')
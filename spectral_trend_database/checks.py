@@ -0,0 +1,301 @@
+""" numerical regression checks
+
+DESCRIPTION:
+    checks that the vectorized stats code matches the reference
+    implementations it replaced:
+
+        - `utils.moments` (block-wise/pairwise merged moments) and
+          `utils.skew_kurtosis_from_moments` against numpy and `scipy.stats`
+        - `utils.nan_quantiles` against `np.nanquantile`
+        - `aggregation.batch_stats` against the baseline per-sample stats
+          (mean, median, min, max and `scipy.stats` skew/kurtosis of each
+          window, with warnings raised as errors as in step-5)
+
+    the synthetic data includes NaN gaps, all-NaN rows/windows, constant values
+    and low-variance windows far from the mean of the year.
+
+    each check returns a list of failures (empty if the check passes). run all
+    checks with `stdb check` (exits with an error if any check fails).
+
+USAGE:
+    ```python
+    from spectral_trend_database import checks
+
+    failures = checks.run()
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Callable, Optional, Sequence
+import warnings
+import numpy as np
+import pandas as pd
+from spectral_trend_database import lazy
+from spectral_trend_database import aggregation
+from spectral_trend_database import utils
+if TYPE_CHECKING:
+    import scipy.stats as stats  # type: ignore[import-untyped]
+else:
+    stats = lazy.lazy_import('scipy.stats')
+
+
+#
+# CONSTANTS
+#
+SEED = 1234
+RTOL = 1e-7
+ATOL = 1e-12
+BLOCK_SIZES = [1, 7, 64, utils.MOMENT_BLOCK_SIZE]
+QUANTILES = [0, 0.025, 0.25, 0.5, 0.75, 1]
+NB_VALUES = 200
+NB_SAMPLES = 12
+YEAR = 2010
+DATA_VARS = ['ndvi', 'evi']
+
+
+#
+# SYNTHETIC DATA
+#
+def synthetic_values(nb_values: int = NB_VALUES, seed: int = SEED) -> np.ndarray:
+    """ (case x value) array of edge cases
+
+    rows: normal, skewed (lognormal), NaN gaps, all-NaN, single value, constant,
+    low-variance far from zero and a large offset with small spread
+    """
+    rng = np.random.default_rng(seed)
+    normal = rng.normal(0.4, 0.1, nb_values)
+    skewed = rng.lognormal(0, 0.8, nb_values)
+    gaps = np.where(rng.random(nb_values) < 0.3, np.nan, rng.normal(0.3, 0.2, nb_values))
+    empty = np.full(nb_values, np.nan)
+    single = np.full(nb_values, np.nan)
+    single[nb_values // 2] = 0.7
+    constant = np.full(nb_values, 0.25)
+    low_variance = 0.2 + rng.normal(0, 1e-6, nb_values)
+    offset = 1e4 + rng.normal(0, 1e-2, nb_values)
+    return np.stack([normal, skewed, gaps, empty, single, constant, low_variance, offset])
+
+
+def synthetic_rows(
+        nb_samples: int = NB_SAMPLES,
+        year: int = YEAR,
+        data_vars: Sequence[str] = DATA_VARS,
+        seed: int = SEED) -> pd.DataFrame:
+    """ long (sample_id, date, var_1, ..., var_n) rows over the growing year
+
+    samples have a seasonal peak and noise. sample 0 has a flat (low-variance)
+    off-season, sample 1 no off-season rows, sample 2 NaN gaps and sample 3 a
+    constant growing season.
+    """
+    rng = np.random.default_rng(seed)
+    windows = aggregation.season_date_windows(year)
+    start, end = windows[aggregation.GROWING_YEAR]
+    dates = pd.date_range(start, end, freq='D')
+    off_start, off_end = [pd.Timestamp(d) for d in windows[aggregation.OFF_SEASON]]
+    grow_start, grow_end = [pd.Timestamp(d) for d in windows[aggregation.GROWING_SEASON]]
+    off = np.asarray((dates >= off_start) & (dates <= off_end))
+    grow = np.asarray((dates >= grow_start) & (dates <= grow_end))
+    days = np.arange(len(dates))
+    frames = []
+    for index in range(nb_samples):
+        data: dict[str, Any] = dict(sample_id=f's{index:03d}', date=dates)
+        for name in data_vars:
+            peak = rng.uniform(0.3, 0.6) * np.exp(-((days - rng.normal(250, 15)) / 40) ** 2)
+            values = 0.2 + peak + rng.normal(0, 0.01, len(dates))
+            if index == 0:
+                values = np.where(off, 0.2 + rng.normal(0, 1e-5, len(dates)), values)
+            elif index == 2:
+                values = np.where(rng.random(len(dates)) < 0.4, np.nan, values)
+            elif index == 3:
+                values = np.where(grow, 0.5, values)
+            data[name] = values
+        frame = pd.DataFrame(data)
+        if index == 1:
+            frame = frame[~off]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+#
+# CHECKS
+#
+def check_moments(values: Optional[np.ndarray] = None) -> list[dict]:
+    """ `utils.moments` (for several block sizes) vs numpy / `scipy.stats` """
+    if values is None:
+        values = synthetic_values()
+    failures: list[dict] = []
+    expected = [_reference_moments(row) for row in values]
+    for block_size in BLOCK_SIZES:
+        mmts = utils.moments(values, block_size=block_size)
+        skew, kurtosis = utils.skew_kurtosis_from_moments(mmts)
+        actual = dict(
+            count=mmts['count'],
+            mean=mmts['mean'],
+            m2=mmts['m2'],
+            skew=skew,
+            kurtosis=kurtosis)
+        for index, row in enumerate(expected):
+            for name, value in row.items():
+                failures += _compare(
+                    'moments',
+                    f'case={index} block_size={block_size}',
+                    name,
+                    value,
+                    actual[name][index])
+    return failures
+
+
+def check_quantiles(values: Optional[np.ndarray] = None) -> list[dict]:
+    """ `utils.nan_quantiles` vs `np.nanquantile` """
+    if values is None:
+        values = synthetic_values()
+    failures: list[dict] = []
+    actual = utils.nan_quantiles(values, QUANTILES, axis=-1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.nanquantile(values, QUANTILES, axis=-1)
+    for i, q in enumerate(QUANTILES):
+        for index in range(len(values)):
+            failures += _compare(
+                'quantiles',
+                f'case={index}',
+                utils.quantile_name(q),
+                expected[i, index],
+                actual[i, index])
+    return failures
+
+
+def check_batch_stats(
+        data: Optional[pd.DataFrame] = None,
+        year: int = YEAR,
+        data_vars: Sequence[str] = DATA_VARS,
+        batch_size: int = 5) -> list[dict]:
+    """ `aggregation.batch_stats` vs the baseline per-sample stats
+
+    the baseline (step-5) computed each window's stats per sample and dropped
+    samples whose stats raised warnings in any window (empty windows, constant
+    values). dropped samples must be reported in the returned warnings.
+    """
+    if data is None:
+        data = synthetic_rows(year=year, data_vars=data_vars)
+    windows = aggregation.season_date_windows(year)
+    tables, errors = aggregation.batch_stats(
+        data,
+        data_vars,
+        windows,
+        batch_size=batch_size,
+        year=year)
+    warned = {e['sample_id'] for e in errors}
+    expected: dict[str, dict] = {name: dict() for name in windows}
+    dropped = set()
+    for sample_id, rows in data.groupby('sample_id'):
+        dates = pd.to_datetime(rows.date)
+        for name, (start, end) in windows.items():
+            window_rows = rows[(dates >= pd.Timestamp(start)) & (dates <= pd.Timestamp(end))]
+            window_stats = _reference_stats(window_rows, data_vars)
+            if window_stats is None:
+                dropped.add(sample_id)
+            else:
+                expected[name][sample_id] = window_stats
+    failures: list[dict] = []
+    for sample_id in sorted(dropped ^ warned):
+        failures.append(_failure(
+            'batch_stats',
+            sample_id,
+            'dropped',
+            sample_id in dropped,
+            sample_id in warned))
+    for name, table in tables.items():
+        table = table.set_index('sample_id') if len(table) else pd.DataFrame()
+        if set(table.index) != (set(expected[name]) - dropped):
+            failures.append(_failure(
+                'batch_stats',
+                name,
+                'sample_ids',
+                sorted(set(expected[name]) - dropped),
+                sorted(table.index)))
+        for sample_id in set(table.index) - dropped:
+            for stat_name, value in expected[name].get(sample_id, {}).items():
+                failures += _compare(
+                    'batch_stats',
+                    f'{sample_id} {name}',
+                    stat_name,
+                    value,
+                    table.loc[sample_id, stat_name])
+    return failures
+
+
+def run() -> list[dict]:
+    """ run all checks
+
+    Returns:
+
+        (list[dict]) failures (check, case, stat, expected, actual). empty if all
+        checks pass
+    """
+    failures: list[dict] = []
+    check_funcs: list[Callable[[], list[dict]]] = [
+        check_moments,
+        check_quantiles,
+        check_batch_stats]
+    for check in check_funcs:
+        check_failures = check()
+        print(f'- {check.__name__}:', 'ok' if not check_failures else len(check_failures))
+        failures += check_failures
+    return failures
+
+
+#
+# INTERNAL
+#
+def _reference_moments(row: np.ndarray) -> dict[str, float]:
+    valid = row[~np.isnan(row)]
+    if not valid.size:
+        return dict(count=0, mean=np.nan, m2=np.nan, skew=np.nan, kurtosis=np.nan)
+    mean = valid.mean()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        skew = stats.skew(valid)
+        kurtosis = stats.kurtosis(valid)
+    return dict(
+        count=valid.size,
+        mean=mean,
+        m2=((valid - mean) ** 2).sum(),
+        skew=skew,
+        kurtosis=kurtosis)
+
+
+def _reference_stats(rows: pd.DataFrame, data_vars: Sequence[str]) -> Optional[dict]:
+    """ baseline stats of a window (None if the baseline dropped the sample) """
+    result = {}
+    try:
+        with warnings.catch_warnings():
+            warnings.filterwarnings('error')
+            for name in data_vars:
+                arr = rows[name].dropna().to_numpy()
+                if not arr.size:
+                    return None
+                result[f'{name}_mean'] = arr.mean()
+                result[f'{name}_median'] = np.median(arr)
+                result[f'{name}_min'] = arr.min()
+                result[f'{name}_max'] = arr.max()
+                result[f'{name}_skew'] = stats.skew(arr)
+                result[f'{name}_kurtosis'] = stats.kurtosis(arr)
+    except Warning:
+        return None
+    if any(np.isnan(v) for v in result.values()):
+        return None
+    return result
+
+
+def _compare(check: str, case: str, stat: str, expected: Any, actual: Any) -> list[dict]:
+    if np.isnan(expected) and np.isnan(actual):
+        return []
+    if np.isclose(actual, expected, rtol=RTOL, atol=ATOL):
+        return []
+    return [_failure(check, case, stat, expected, actual)]
+
+
+def _failure(check: str, case: str, stat: str, expected: Any, actual: Any) -> dict:
+    return dict(check=check, case=case, stat=stat, expected=expected, actual=actual)
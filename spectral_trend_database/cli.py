@@ -5,6 +5,10 @@ from pprint import pprint
 import click
 from spectral_trend_database import utils
 from spectral_trend_database import runner
+from spectral_trend_database import bench
+from spectral_trend_database import checks
+from spectral_trend_database import profiling
+from spectral_trend_database import sharding
 from spectral_trend_database.config import ConfigHandler
 """
 ```yaml
@@ -14,6 +18,7 @@ config_folder: if/exists/append/config/paths/below
 user_config: path/to/user_config.yaml
 indices_config: path/to/spectral_index_config.yaml
 job_folder: jobs/
+max_parallel: 2
 jobs:
     - name: my_job_step1
       file: my_job_step1.py
@@ -27,8 +32,37 @@ jobs:
     # no config is required
     - name: config_not_required_step3
       file: my_job_step3.py
+      # run after my_job_step1 (independent jobs run concurrently if max_parallel > 1)
+      depends_on: my_job_step1
     # jobs without `file` run pre-defined jobs from stdb
-    - name: step-0.samples_and_qdann_yield
+    - name: fused_pipeline
+```
+
+profile a single job (`stdb profile <name>`):
+
+```bash
+# cProfile => profiles/<name>.<timestamp>.pstats
+stdb profile fused_pipeline --limit 100
+# sampling profiler => profiles/<name>.<timestamp>.speedscope.json (https://speedscope.app)
+stdb profile fused_pipeline --limit 100 --method sampling
+# offline: query a local duckdb database instead of bigquery
+stdb profile fused_pipeline --limit 100 DEFAULT_QUERY_BACKEND=duckdb
+```
+
+fan a job out across machines (see `sharding`):
+
+```bash
+# on machine i of 4 (zero-based)
+stdb job step-4 --shard i/4
+# once all shards have been uploaded: merge shards and load bigquery tables
+stdb job step-4 --merge_shards 4
+```
+
+or drain a shared work queue with any number of workers (see `workqueue`):
+
+```bash
+# on each machine (the queue must be on a shared filesystem)
+stdb job fused_pipeline --queue /shared/stdb/queue.db
 ```
 
 
@@ -48,6 +82,11 @@ MUTUALLY_EXCLUSIVE_ARGS: list[str] = [
     'index_range',
     'run_all' ]
 _NOT_FOUND: str = '_NOT_FOUND'
+PROFILE_METHODS: list[str] = [profiling.CPROFILE, profiling.SAMPLING]
+PROFILE_OUTPUTS: dict = {
+    profiling.CPROFILE: 'profiles/{name}.{timestamp}.pstats',
+    profiling.SAMPLING: 'profiles/{name}.{timestamp}.speedscope.json'}
+PROFILE_TOP: int = 30
 
 
 
@@ -68,6 +107,11 @@ def cli(ctx):
 @click.option('-c', '--config', required=False, default=DEFAULT_CONFIG)
 @click.option('-l', '--limit', type=int, required=False)
 @click.option('--dry_run', type=bool, required=False, default=DRY_RUN)
+@click.option('-p', '--max_parallel', type=int, required=False)
+@click.option('--profile_report', type=str, required=False)
+@click.option('--shard', type=str, required=False, help='run shard i/n of the samples')
+@click.option('--merge_shards', type=int, required=False, help='merge outputs of n shards')
+@click.option('--queue', type=str, required=False, help='sqlite work queue shared by workers')
 @click.pass_context
 def job(
         ctx,
@@ -77,7 +121,12 @@ def job(
         run_all,
         config,
         limit=None,
-        dry_run=DRY_RUN):
+        dry_run=DRY_RUN,
+        max_parallel=None,
+        profile_report=None,
+        shard=None,
+        merge_shards=None,
+        queue=None):
     name, run_config = _pocess_name_and_context(name, ctx.args)
     _check_argument_exclusions(
         name=name,
@@ -89,13 +138,100 @@ def job(
         index=index,
         index_range=index_range,
         run_all=run_all)
+    if limit:
+        run_config['LIMIT'] = limit
+    if shard:
+        sharding.parse_shard(shard)
+        run_config['SHARD'] = shard
+    if merge_shards:
+        run_config['MERGE_SHARDS'] = merge_shards
+    if queue:
+        run_config['WORK_QUEUE_PATH'] = queue
     jr = runner.JobRunner(config)
     jr.run(
         name=name,
         start_index=start_index,
         end_index=end_index,
-        run_config=run_config)
+        run_config=run_config,
+        max_parallel=max_parallel,
+        profile_report=profile_report)
+
+
+@cli.command(name='profile', help='run a job under a code profiler', context_settings=CTX_SETTINGS)
+@click.argument('name', type=str, required=True)
+@click.option('-c', '--config', required=False, default=DEFAULT_CONFIG)
+@click.option('-l', '--limit', type=int, required=False, help='max number of samples')
+@click.option('-m', '--method', type=click.Choice(PROFILE_METHODS), default=profiling.CPROFILE)
+@click.option('-o', '--output', type=str, required=False)
+@click.option('--top', type=int, required=False, default=PROFILE_TOP)
+@click.option('--interval', type=float, default=profiling.DEFAULT_SAMPLING_INTERVAL)
+@click.option('--external/--no-external', default=False, help='include non-stdb functions')
+@click.option(
+    '--sort', 'sort_by', type=click.Choice(['self_time', 'total_time']),
+    default='self_time')
+@click.pass_context
+def profile_command(ctx, name, config, limit, method, output, top, interval, external, sort_by):
+    name, run_config = _pocess_name_and_context(name, ctx.args)
+    if limit:
+        run_config['LIMIT'] = limit
+    if method == profiling.CPROFILE:
+        # cProfile only sees the calling thread
+        run_config.setdefault('DEFAULT_MAP_METHOD', 'sequential')
+    if not output:
+        output = PROFILE_OUTPUTS[method].format(
+            name=name,
+            timestamp=utils.Timer().now('ts'))
+    jr = runner.JobRunner(config)
+    run_kwargs = dict(name=name, run_config=run_config, max_parallel=1, profile_report=False)
+    if method == profiling.CPROFILE:
+        _, stats = profiling.run_cprofile(jr.run, dest=output, **run_kwargs)
+    else:
+        with profiling.SamplingProfiler(interval=interval) as stats:
+            jr.run(**run_kwargs)
+        stats.save_speedscope(output, name=name)
+    print('- hot functions:')
+    hot = profiling.hot_functions(stats, limit=top, external=external, sort_by=sort_by)
+    print(hot.to_string(index=False))
+    print('- profile:', output)
+
+
+
+@cli.command(name='bench', help='run benchmarks on synthetic landsat-like data')
+@click.option('-n', '--names', type=str, required=False, help='comma separated benchmark names')
+@click.option('-s', '--scales', type=str, required=False, help='comma separated numbers of samples')
+@click.option('-r', '--repeat', type=int, required=False, default=bench.DEFAULT_REPEAT)
+@click.option('-o', '--output', type=str, required=False, default=bench.DEFAULT_RESULTS_DIR)
+@click.option(
+    '-b', '--baseline', type=str, required=False,
+    help='baseline results (default: latest in output)')
+@click.option('-t', '--threshold', type=float, required=False, default=bench.DEFAULT_THRESHOLD)
+@click.option('--save/--no-save', default=True)
+def bench_command(names, scales, repeat, output, baseline, threshold, save):
+    if names:
+        names = [n.strip() for n in names.split(',')]
+    if scales:
+        scales = [int(v) for v in scales.split(',')]
+    else:
+        scales = bench.DEFAULT_SCALES
+    results = bench.run(names=names, scales=scales, repeat=repeat)
+    dest = None
+    if save:
+        dest = bench.save_results(results, output)
+        print('- results:', dest)
+    if not baseline:
+        baseline = bench.latest_results(output, exclude=dest)
+    if baseline:
+        print('- baseline:', baseline)
+        print(bench.compare(results, bench.load_results(baseline), threshold=threshold).to_string())
+
 
+@cli.command(name='check', help='check vectorized stats against reference implementations')
+def check_command():
+    failures = checks.run()
+    for failure in failures:
+        pprint(failure)
+    if failures:
+        raise click.ClickException(f'{len(failures)} numerical check(s) failed')
 
 
 #
@@ -168,3 +304,5 @@ def _check_argument_exclusions(
 # MAIN
 #
 cli.add_command(job)
+cli.add_command(bench_command)
+cli.add_command(profile_command)
@@ -0,0 +1,201 @@
+""" shared clients
+
+DESCRIPTION:
+    thread-safe registry of lazily created, reused bigquery, cloud-storage and
+    (local) duckdb clients. clients are keyed by project/location so repeated
+    calls inside per-year/per-sample loops share authentication and HTTP
+    connection pools rather than creating new ones for every call.
+
+    the HTTP connection pool of each gcp client is sized to the number of
+    workers in the pipeline (`c.MAX_PROCESSES`) so that threads calling
+    `query`/`gcp` methods concurrently do not block on, or discard, connections.
+
+USAGE:
+    ```python
+    from spectral_trend_database import clients
+
+    bq_client = clients.bigquery_client()
+    gcs_client = clients.storage_client()
+    assert bq_client is clients.bigquery_client()
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Callable, Optional
+import threading
+from spectral_trend_database import lazy
+from spectral_trend_database.config import config as c
+from spectral_trend_database import types
+if TYPE_CHECKING:
+    import requests
+    import google.auth as google_auth  # type: ignore[import-untyped]
+    import google.auth.transport.requests as google_requests  # type: ignore[import-untyped]
+    from google.cloud import storage  # type: ignore
+    from google.cloud import bigquery as bq
+else:
+    requests = lazy.lazy_import('requests')
+    google_auth = lazy.lazy_import('google.auth')
+    google_requests = lazy.lazy_import('google.auth.transport.requests')
+    storage = lazy.lazy_import('google.cloud.storage')
+    bq = lazy.lazy_import('google.cloud.bigquery')
+
+
+#
+# CONSTANTS
+#
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+HTTPS_PREFIX = 'https://'
+BIGQUERY = 'bigquery'
+STORAGE = 'storage'
+DUCKDB = 'duckdb'
+
+
+#
+# REGISTRY
+#
+_LOCK = threading.Lock()
+_CLIENTS: dict[tuple, Any] = {}
+
+
+#
+# PUBLIC
+#
+def bigquery_client(
+        project: Optional[str] = None,
+        location: Optional[str] = None,
+        pool_size: Optional[int] = None) -> bq.Client:
+    """ shared bigquery client
+
+    Args:
+
+        project (Optional[str] = None): gcp project name
+        location (Optional[str] = None): gcp location
+        pool_size (Optional[int] = None):
+            maximum number of pooled HTTP connections.
+            if None use `connection_pool_size()`
+
+    Returns:
+
+        (bq.Client) bigquery client for <project>/<location>
+    """
+    pool_size = pool_size or connection_pool_size()
+
+    def _create():
+        credentials, _ = google_auth.default(scopes=SCOPES)
+        return bq.Client(
+            project=project,
+            location=location,
+            credentials=credentials,
+            _http=_http_session(credentials, pool_size))
+    return _get_or_create((BIGQUERY, project, location, pool_size), _create)
+
+
+def storage_client(
+        project: Optional[str] = None,
+        pool_size: Optional[int] = None) -> storage.Client:
+    """ shared cloud-storage client
+
+    Args:
+
+        project (Optional[str] = None): gcp project name
+        pool_size (Optional[int] = None):
+            maximum number of pooled HTTP connections.
+            if None use `connection_pool_size()`
+
+    Returns:
+
+        (storage.Client) cloud-storage client for <project>
+    """
+    pool_size = pool_size or connection_pool_size()
+
+    def _create():
+        credentials, _ = google_auth.default(scopes=SCOPES)
+        return storage.Client(
+            project=project,
+            credentials=credentials,
+            _http=_http_session(credentials, pool_size))
+    return _get_or_create((STORAGE, project, pool_size), _create)
+
+
+def query_client(
+        backend: types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND,
+        project: Optional[str] = None,
+        location: Optional[str] = None) -> types.QUERY_CLIENT:
+    """ shared client for query backend
+
+    Args:
+
+        backend (types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND):
+            one of 'bigquery' or 'duckdb'
+        project (Optional[str] = None): gcp project name
+        location (Optional[str] = None): gcp location (bigquery only)
+
+    Returns:
+
+        bigquery client or duckdb_client.DuckDBClient
+    """
+    if backend == c.BIGQUERY_BACKEND:
+        return bigquery_client(project=project, location=location)
+    elif backend == c.DUCKDB_BACKEND:
+        # duckdb is only required for the local backend
+        from spectral_trend_database.duckdb_client import DuckDBClient
+        return _get_or_create(
+            (DUCKDB, project, c.LOCAL_PARQUET_DIR),
+            lambda: DuckDBClient(project=project))
+    else:
+        err = (
+            'spectral_trend_database.clients.query_client: '
+            f'invalid backend ({backend}) must be one of {types.QUERY_BACKEND_ARGS}.'
+        )
+        raise ValueError(err)
+
+
+def connection_pool_size(nb_workers: Optional[int] = None) -> int:
+    """ HTTP connection-pool size for number of workers
+
+    Args:
+
+        nb_workers (Optional[int] = None):
+            number of concurrent workers. if None use `c.MAX_PROCESSES`
+
+    Returns:
+
+        (int) max of <nb_workers> and c.DEFAULT_CONNECTION_POOL_SIZE
+    """
+    if nb_workers is None:
+        nb_workers = c.get('MAX_PROCESSES') or 0
+    return max(int(nb_workers), c.DEFAULT_CONNECTION_POOL_SIZE)
+
+
+def reset_clients() -> None:
+    """ remove (and close) all shared clients """
+    with _LOCK:
+        for client in _CLIENTS.values():
+            try:
+                client.close()
+            except:
+                pass
+        _CLIENTS.clear()
+
+
+#
+# INTERNAL
+#
+def _get_or_create(key: tuple, create: Callable) -> Any:
+    with _LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = create()
+            _CLIENTS[key] = client
+    return client
+
+
+def _http_session(credentials: Any, pool_size: int) -> google_requests.AuthorizedSession:
+    session = google_requests.AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size)
+    session.mount(HTTPS_PREFIX, adapter)
+    return session
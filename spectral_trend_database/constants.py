@@ -47,6 +47,39 @@ DEFAULT_QUERY_CONFIG = 'v1'
 DEFAULT_SPECTRAL_INDEX_CONFIG = 'v1'
 DEFAULT_LOCATION = 'US'
 DEFAULT_TIMEOUT = 30
+DEFAULT_QUERY_BACKEND = 'bigquery'
+DEFAULT_PAGE_SIZE = 100000
+DEFAULT_CONNECTION_POOL_SIZE = 10
+DEFAULT_MAP_METHOD = 'threadpool'
+CHECKPOINT_PATH = None
+FUSED_INTERMEDIATES = None
+SHARD = None
+SHARD_KEY = 'sample_id'
+MERGE_SHARDS = None
+WORK_QUEUE_PATH = None
+WORK_QUEUE_BATCH_SIZE = 50
+WORK_QUEUE_LEASE_SECONDS = 900
+WORK_QUEUE_MAX_ATTEMPTS = 3
+STATS_QUANTILES = None
+SEASON_WINDOWS = None
+
+
+#
+# QUERY BACKENDS
+#
+BIGQUERY_BACKEND = 'bigquery'
+DUCKDB_BACKEND = 'duckdb'
+LOCAL_PARQUET_DIR = None
+LOCAL_PARQUET_TABLES = None
+
+
+#
+# TABLE LAYOUTS
+#
+TABLE_PARTITIONS = None
+DEFAULT_TABLE_FORMAT = 'json'
+DEFAULT_FLOAT_TYPE = 'float64'
+TABLE_FORMATS = None
 
 
 #
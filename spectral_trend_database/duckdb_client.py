@@ -0,0 +1,333 @@
+""" duckdb query backend
+
+DESCRIPTION:
+    executes the (bigquery) sql generated by `query.QueryConstructor` and
+    `query.named_sql` against a local parquet mirror of the database, such as
+    the output of `scripts/json_to_parquet.py`.
+
+    `DuckDBClient` implements the part of the `bq.Client` interface used in
+    `spectral_trend_database.query` so it may be passed anywhere a bigquery
+    client is accepted.
+
+    tables are discovered in the mirror directory by name:
+
+        - `<root>/.../<name>.parquet` (file or directory of parquet files)
+        - `<root>/.../<name>/<key>=<value>/...` (hive partitioned directory)
+
+    or can be given explicitly with `tables={<TABLE_NAME>: <path>}`. table
+    names are upper-cased (ie `smoothed_indices.parquet` => `SMOOTHED_INDICES`)
+
+USAGE:
+    ```python
+    from spectral_trend_database import query
+    from spectral_trend_database.duckdb_client import DuckDBClient
+
+    client = DuckDBClient(
+        'data/parquet',
+        tables=dict(SMOOTHED_INDICES_V1='smoothed_indices.parquet'))
+    df = query.run(table='SMOOTHED_INDICES_V1', year=2010, client=client)
+
+    # or with root/tables set by c.LOCAL_PARQUET_DIR/c.LOCAL_PARQUET_TABLES
+    df = query.run(table='SMOOTHED_INDICES_V1', year=2010, backend='duckdb')
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Optional, Iterator, Sequence, Union
+import re
+import math
+from datetime import date
+from pathlib import Path
+import pandas as pd
+import duckdb
+from spectral_trend_database import lazy
+from spectral_trend_database.config import config as c
+from spectral_trend_database import paths
+if TYPE_CHECKING:
+    from google.cloud import bigquery as bq
+else:
+    bq = lazy.lazy_import('google.cloud.bigquery')
+
+
+#
+# CONSTANTS
+#
+PARQUET_EXT = 'parquet'
+VECTOR_SIZE = duckdb.__standard_vector_size__
+HIVE_PARTITION_REGEX = r'^[^=]+=[^=]+$'
+RGX_INFORMATION_SCHEMA = r'`[^`]*INFORMATION_SCHEMA\.(TABLES|COLUMNS)`'
+RGX_ESCAPED_TABLE = r'`(?:[^`.]+\.)*([^`.]+)`'
+RGX_IN_UNNEST = r'IN\s+UNNEST\(\s*@(\w+)\s*\)'
+RGX_QUOTED_OR_PARAMETER = r"'(?:[^'\\]|\\.)*'|\"((?:[^\"\\]|\\.)*)\"|(?<![\w@])@(\w+)"
+
+
+#
+# CLIENT
+#
+class DuckDBClient(object):
+    """ bigquery-like client for querying a local parquet mirror with duckdb
+
+    Usage:
+
+    ```python
+    client = DuckDBClient('path/to/mirror')
+    print(client.table_names())
+    df = client.query('SELECT * FROM `project.dataset.SAMPLE_POINTS`').to_dataframe()
+    ```
+    """
+    def __init__(
+            self,
+            root: Optional[str] = None,
+            tables: Optional[dict[str, str]] = None,
+            project: Optional[str] = None,
+            location: Optional[str] = None,
+            database: str = ':memory:') -> None:
+        """
+        Args:
+
+            root (Optional[str] = None):
+                local directory containing the parquet mirror.
+                if None use `c.LOCAL_PARQUET_DIR` or, if that is not set, the
+                local path of `c.GCS_BUCKET/c.GCS_PARQUET_FOLDER`
+            tables (Optional[dict[str, str]] = None):
+                explicit table-name, path pairs. relative paths are relative to <root>.
+                if None use `c.LOCAL_PARQUET_TABLES`. these override discovered tables.
+            project (Optional[str] = None): included for parity with `bq.Client`
+            location (Optional[str] = None): included for parity with `bq.Client`
+            database (str = ':memory:'): duckdb database
+        """
+        if root is None:
+            root = c.LOCAL_PARQUET_DIR or paths.local(c.GCS_BUCKET, c.GCS_PARQUET_FOLDER)
+        if tables is None:
+            tables = c.LOCAL_PARQUET_TABLES or {}
+        self.root = str(root)
+        self.project = project
+        self.location = location
+        self.connection = duckdb.connect(database)
+        self.tables = discover_tables(self.root)
+        self.tables.update({
+            k.upper(): _full_path(v, self.root)
+            for k, v in tables.items()})
+        for name, path in self.tables.items():
+            self.connection.execute(_view_sql(name, path))
+
+    def query(
+            self,
+            sql: str,
+            job_config: Optional[bq.QueryJobConfig] = None,
+            **kwargs) -> 'DuckDBQueryJob':
+        """ execute (bigquery) sql against local parquet mirror
+
+        Args:
+
+            sql (str): bigquery sql statement
+            job_config (Optional[bq.QueryJobConfig] = None):
+                bigquery job-config. only `query_parameters` are used.
+            **kwargs: ignored (included for parity with `bq.Client.query`)
+
+        Returns:
+
+            (DuckDBQueryJob) query result
+        """
+        cursor = self.connection.cursor()
+        parameters = None
+        if job_config is not None:
+            parameters = duckdb_parameters(job_config.query_parameters)
+        return DuckDBQueryJob(cursor.execute(to_duckdb_sql(sql), parameters or None))
+
+    def table_names(self) -> list[str]:
+        """ list of available table names """
+        return sorted(self.tables.keys())
+
+    def close(self) -> None:
+        """ close duckdb connection """
+        self.connection.close()
+
+
+class DuckDBQueryJob(object):
+    """ bigquery-like query-job wrapper for duckdb query results """
+    def __init__(self, cursor: duckdb.DuckDBPyConnection) -> None:
+        self.cursor = cursor
+
+    def to_dataframe(self, **kwargs) -> pd.DataFrame:
+        """ query result as dataframe
+
+        Args:
+
+            **kwargs: ignored (included for parity with `bq.QueryJob.to_dataframe`)
+
+        Returns:
+
+            (pd.DataFrame) query result
+        """
+        return self.cursor.df()
+
+    def result(self, page_size: Optional[int] = None, **kwargs) -> 'DuckDBRowIterator':
+        """ paged query result
+
+        Args:
+
+            page_size (Optional[int] = None):
+                (approximate) number of rows per page. duckdb returns results in vectors
+                of `duckdb.__standard_vector_size__` rows so pages are rounded up to
+                a multiple of the vector size. if None, the full result is one page.
+            **kwargs: ignored (included for parity with `bq.QueryJob.result`)
+
+        Returns:
+
+            (DuckDBRowIterator) paged query result
+        """
+        return DuckDBRowIterator(self.cursor, page_size=page_size)
+
+
+class DuckDBRowIterator(object):
+    """ bigquery-like row-iterator wrapper for paging through duckdb query results """
+    def __init__(self, cursor: duckdb.DuckDBPyConnection, page_size: Optional[int] = None) -> None:
+        self.cursor = cursor
+        self.page_size = page_size
+
+    def to_dataframe(self, **kwargs) -> pd.DataFrame:
+        """ (remaining) query result as dataframe """
+        return self.cursor.df()
+
+    def to_dataframe_iterable(self, **kwargs) -> Iterator[pd.DataFrame]:
+        """ iterate over query result as page-sized dataframes
+
+        Args:
+
+            **kwargs: ignored (included for parity with `bq.table.RowIterator`)
+
+        Yields:
+
+            (pd.DataFrame) page of query result
+        """
+        if self.page_size:
+            nb_vectors = math.ceil(self.page_size / VECTOR_SIZE)
+            while True:
+                page = self.cursor.fetch_df_chunk(nb_vectors)
+                if page.empty:
+                    break
+                yield page
+        else:
+            yield self.cursor.df()
+
+
+#
+# METHODS
+#
+def discover_tables(root: str) -> dict[str, str]:
+    """ find parquet tables in directory
+
+    Args:
+
+        root (str): local directory containing the parquet mirror
+
+    Returns:
+
+        (dict) upper-cased table-name, path pairs
+    """
+    tables: dict[str, str] = {}
+    root_path = Path(root)
+    if root_path.is_dir():
+        for path in sorted(root_path.iterdir()):
+            if path.suffix == f'.{PARQUET_EXT}':
+                tables[path.stem.upper()] = str(path)
+            elif path.is_dir():
+                if _is_hive_partitioned(path):
+                    tables[path.name.upper()] = str(path)
+                else:
+                    tables.update(discover_tables(str(path)))
+    return tables
+
+
+def duckdb_parameters(
+        query_parameters: Sequence[Union[bq.ScalarQueryParameter, bq.ArrayQueryParameter]]) -> dict:
+    """ convert bigquery query parameters to duckdb named parameters
+
+    Args:
+
+        query_parameters (Sequence): bigquery scalar/array query parameters
+
+    Returns:
+
+        (dict) parameter-name, value pairs
+    """
+    parameters = {}
+    for param in query_parameters:
+        if isinstance(param, bq.ArrayQueryParameter):
+            value = [_parameter_value(v, param.array_type) for v in param.values]
+        else:
+            value = _parameter_value(param.value, param.type_)
+        parameters[param.name] = value
+    return parameters
+
+
+def to_duckdb_sql(sql: str) -> str:
+    """ convert bigquery sql to duckdb sql
+
+    - `project.dataset.INFORMATION_SCHEMA.TABLES|COLUMNS` => information_schema.tables|columns
+    - `project.dataset.TABLE_NAME` => TABLE_NAME
+    - "string values" => 'string values'
+    - IN UNNEST(@param) => IN (SELECT UNNEST($param))
+    - @param => $param
+
+    Args:
+
+        sql (str): bigquery sql statement
+
+    Returns:
+
+        (str) duckdb sql statement
+    """
+    sql = re.sub(
+        RGX_INFORMATION_SCHEMA,
+        lambda m: f'information_schema.{m.group(1).lower()}',
+        sql)
+    sql = re.sub(RGX_ESCAPED_TABLE, r'\1', sql)
+    sql = re.sub(RGX_IN_UNNEST, r'IN (SELECT UNNEST(@\1))', sql, flags=re.IGNORECASE)
+    return re.sub(RGX_QUOTED_OR_PARAMETER, _translate_token, sql)
+
+
+#
+# INTERNAL
+#
+def _full_path(path: str, root: str) -> str:
+    if Path(path).is_absolute():
+        return path
+    else:
+        return f'{root}/{path}'
+
+
+def _is_hive_partitioned(path: Path) -> bool:
+    return any(p.is_dir() and re.search(HIVE_PARTITION_REGEX, p.name) for p in path.iterdir())
+
+
+def _view_sql(name: str, path: str) -> str:
+    if Path(path).is_dir():
+        src = (
+            f"read_parquet('{path}/**/*.{PARQUET_EXT}', "
+            "hive_partitioning = true, union_by_name = true)")
+    else:
+        src = f"read_parquet('{path}')"
+    return f'CREATE OR REPLACE VIEW "{name}" AS SELECT * FROM {src}'
+
+
+def _parameter_value(value: Any, parameter_type: str) -> Any:
+    if (parameter_type == 'DATE') and isinstance(value, str):
+        value = date.fromisoformat(value)
+    return value
+
+
+def _translate_token(match: re.Match) -> str:
+    """ double-quoted strings => single-quoted strings, @param => $param """
+    value, parameter = match.group(1), match.group(2)
+    if parameter is not None:
+        return f'${parameter}'
+    elif value is not None:
+        value = re.sub(r'\\"', '"', value)
+        value = re.sub(r"(?<!\\)'", "''", value)
+        return f"'{value}'"
+    else:
+        return match.group(0)
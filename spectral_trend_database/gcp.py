@@ -3,20 +3,54 @@
 License:
     BSD, see LICENSE.md
 """
-from typing import Optional, Union
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Optional, Union, Any
 import re
+import time
+import base64
+import hashlib
 from pathlib import Path
 import pandas as pd
-from google.cloud import storage  # type: ignore
-from google.cloud import bigquery as bq
+import pyarrow as pa  # type: ignore[import-untyped]
+from spectral_trend_database import lazy
 from spectral_trend_database.config import config as c
 from spectral_trend_database import utils
+from spectral_trend_database import clients
+from spectral_trend_database import types
+if TYPE_CHECKING:
+    import google_crc32c  # type: ignore[import-untyped]
+    import mproc  # type: ignore[import-untyped]
+    from google.cloud import storage  # type: ignore
+    from google.cloud.storage import transfer_manager  # type: ignore
+    from google.cloud import bigquery as bq
+    from google.api_core import exceptions as gexceptions  # type: ignore
+else:
+    google_crc32c = lazy.lazy_import('google_crc32c')
+    mproc = lazy.lazy_import('mproc')
+    storage = lazy.lazy_import('google.cloud.storage')
+    transfer_manager = lazy.lazy_import('google.cloud.storage.transfer_manager')
+    bq = lazy.lazy_import('google.cloud.bigquery')
+    gexceptions = lazy.lazy_import('google.api_core.exceptions')
 
 
 #
 # CONSTANTS
 #
 DATE_FMT = '%Y-%m-%d'
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+PARALLEL_UPLOAD_THRESHOLD = 4 * UPLOAD_CHUNK_SIZE
+DEFAULT_UPLOAD_WORKERS = 8
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 2
+HASH_BLOCK_SIZE = 1024 * 1024
+RANGE_PARTITION = 'RANGE'
+REPEATED_MODE = 'REPEATED'
+NULLABLE_MODE = 'NULLABLE'
+# values of bq.SourceFormat (bigquery is imported on first use)
+SOURCE_FORMATS = {
+    utils.JSON_FORMAT: 'NEWLINE_DELIMITED_JSON',
+    utils.PARQUET_FORMAT: 'PARQUET'
+}
 
 
 #
@@ -88,14 +122,14 @@ def gcs_list(
         project (Optional[str] = None): gcp project name
         client Optional[bq.Client] = None):
             instance of bigquery client
-            if None a new one will be instantiated
+            if None use shared client (see `clients`)
 
     Returns:
 
         list of cloud storage object paths
     """
     if client is None:
-        client = storage.Client(project=project)
+        client = clients.storage_client(project=project)
     bucket, path = process_gcs_path(path, *args, bucket=bucket)
     blobs = client.list_blobs(bucket, prefix=path)
     paths = [f'{bucket}/{b.name}' for b in blobs]
@@ -125,7 +159,7 @@ def gcs_list_folders(
         project (Optional[str] = None): gcp project name
         client Optional[bq.Client] = None):
             instance of bigquery client
-            if None a new one will be instantiated
+            if None use shared client (see `clients`)
         include_bucket (bool = True): if true prefix with bucket-name
         include_gs (bool = False): if true prefix with gs://
 
@@ -134,7 +168,7 @@ def gcs_list_folders(
         list of cloud storage object paths
     """
     if client is None:
-        client = storage.Client(project=project)
+        client = clients.storage_client(project=project)
     bucket, path = process_gcs_path(path, *args, bucket=bucket)
     path_count = path.count('/')
     blobs = client.list_blobs(bucket, prefix=path)
@@ -164,9 +198,18 @@ def upload_file(
         search: Optional[str] = None,
         prefix: Optional[str] = c.URI_PREFIX,
         project: Optional[str] = None,
-        client: Optional[storage.Client] = None) -> str:
+        client: Optional[storage.Client] = None,
+        skip_identical: bool = False,
+        parallel_threshold: Optional[int] = PARALLEL_UPLOAD_THRESHOLD,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+        max_workers: int = DEFAULT_UPLOAD_WORKERS) -> str:
     """ upload file to cloud storage
 
+    Files smaller than <parallel_threshold> are uploaded in a single (resumable)
+    stream. Larger files are split into <chunk_size> parts which are uploaded
+    concurrently and composed into a single object (see
+    `storage.transfer_manager.upload_chunks_concurrently`).
+
     Args:
 
         src: (str): local source file-path
@@ -179,22 +222,185 @@ def upload_file(
         project (Optional[str] = None): gcp project name
         client Optional[bq.Client] = None):
             instance of bigquery client
-            if None a new one will be instantiated
+            if None use shared client (see `clients`)
+        skip_identical (bool = False):
+            if true, don't upload if the destination exists and its MD5 (or
+            crc32c for composed objects) matches <src> (see `is_identical`)
+        parallel_threshold (Optional[int] = PARALLEL_UPLOAD_THRESHOLD):
+            minimum file size (bytes) for chunked parallel uploads. if None never
+            use chunked uploads
+        chunk_size (int = UPLOAD_CHUNK_SIZE): chunk size (bytes) for parallel uploads
+        max_workers (int = DEFAULT_UPLOAD_WORKERS): max number of concurrent chunk uploads
 
     Returns:
 
         (str) destination uri of uploaded object
     """
     if client is None:
-        client = storage.Client(project=project)
+        client = clients.storage_client(project=project)
     bucket_name, path = process_gcs_path(path, *args, bucket=bucket_name)
     dest_uri = f'{c.URI_PREFIX}{bucket_name}/{path}'
     bucket = client.bucket(bucket_name)
+    if skip_identical and is_identical(src, bucket.get_blob(path)):
+        return dest_uri
     blob = bucket.blob(path)
-    blob.upload_from_filename(src)
+    if parallel_threshold and (Path(src).stat().st_size >= parallel_threshold):
+        transfer_manager.upload_chunks_concurrently(
+            str(src),
+            blob,
+            chunk_size=chunk_size,
+            max_workers=max_workers,
+            worker_type=transfer_manager.THREAD)
+    else:
+        blob.chunk_size = chunk_size
+        blob.upload_from_filename(str(src))
     return dest_uri
 
 
+def download_file(
+        path: str,
+        dest: str,
+        *args: str,
+        bucket_name: Optional[str] = None,
+        project: Optional[str] = None,
+        client: Optional[storage.Client] = None) -> str:
+    """ download cloud storage object to local file
+
+    Args:
+
+        path (str): source gcp file-path may or may not include scheme
+        dest (str): local destination file-path (parent directories are created)
+        *args (str): ordered additional parts to path (see Usage in `process_gcs_path` above)
+        bucket_name (Optional[str] = None): bucket name (if not included in <path>)
+        project (Optional[str] = None): gcp project name
+        client Optional[storage.Client] = None):
+            instance of storage client
+            if None use shared client (see `clients`)
+
+    Returns:
+
+        (str) <dest>
+    """
+    if client is None:
+        client = clients.storage_client(project=project)
+    bucket_name, path = process_gcs_path(path, *args, bucket=bucket_name)
+    Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    client.bucket(bucket_name).blob(path).download_to_filename(str(dest))
+    return dest
+
+
+def upload_directory(
+        src: str,
+        path: str,
+        *args: str,
+        bucket_name: Optional[str] = None,
+        pattern: str = '**/*',
+        skip_identical: bool = True,
+        max_workers: int = DEFAULT_UPLOAD_WORKERS,
+        retries: int = UPLOAD_RETRIES,
+        backoff: float = UPLOAD_BACKOFF,
+        project: Optional[str] = None,
+        client: Optional[storage.Client] = None) -> list[str]:
+    """ upload files in directory to cloud storage concurrently
+
+    Usage:
+
+    ```python
+    # data/parquet/year=2010/a.parquet => gs://bucket/folder/year=2010/a.parquet
+    upload_directory('data/parquet', 'gs://bucket/folder')
+    ```
+
+    Args:
+
+        src: (str): local source directory
+        path (str): destination gcp folder-path may or may not include scheme
+        *args (str): ordered additional parts to path (see Usage in `process_gcs_path` above)
+        bucket_name (Optional[str] = None): gcs bucket (if not included in <path>)
+        pattern (str = '**/*'): glob pattern of files (relative to <src>) to upload
+        skip_identical (bool = True): skip files whose destination is identical (see `upload_file`)
+        max_workers (int = DEFAULT_UPLOAD_WORKERS): max number of concurrent uploads
+        retries (int = UPLOAD_RETRIES): number of retries for failed uploads
+        backoff (float = UPLOAD_BACKOFF): wait <backoff>**<attempt> seconds between retries
+        project (Optional[str] = None): gcp project name
+        client Optional[storage.Client] = None):
+            instance of storage client
+            if None use shared client (see `clients`)
+
+    Returns:
+
+        (list[str]) destination uris of uploaded objects
+    """
+    if client is None:
+        client = clients.storage_client(project=project)
+    bucket_name, path = process_gcs_path(path, *args, bucket=bucket_name)
+    srcs = sorted(p for p in Path(src).glob(pattern) if p.is_file())
+
+    def _upload(file_path: Path) -> str:
+        return _with_retries(
+            lambda: upload_file(
+                str(file_path),
+                path,
+                file_path.relative_to(src).as_posix(),
+                bucket_name=bucket_name,
+                client=client,
+                skip_identical=skip_identical),
+            retries=retries,
+            backoff=backoff)
+    return mproc.map_with_threadpool(_upload, srcs, max_processes=max_workers)
+
+
+def is_identical(src: str, blob: Optional[storage.Blob]) -> bool:
+    """ check if local file and cloud storage object have the same content
+
+    compares sizes and then MD5 hashes. objects composed from parallel uploads
+    do not have MD5 hashes, for these crc32c checksums are compared instead.
+
+    Args:
+
+        src (str): local file-path
+        blob (Optional[storage.Blob]): cloud storage object (None if it does not exist)
+
+    Returns:
+
+        (bool) true if <blob> exists and matches <src>
+    """
+    if (blob is None) or (blob.size != Path(src).stat().st_size):
+        return False
+    elif blob.md5_hash:
+        return blob.md5_hash == file_hash(src, 'md5')
+    else:
+        return blob.crc32c == file_hash(src, 'crc32c')
+
+
+def file_hash(src: str, hash_type: str = 'md5') -> str:
+    """ base64 encoded MD5 or crc32c of local file (as stored by cloud storage)
+
+    Args:
+
+        src (str): local file-path
+        hash_type (str = 'md5'): one of 'md5' or 'crc32c'
+
+    Returns:
+
+        (str) base64 encoded digest
+    """
+    hasher: Any
+    if hash_type == 'md5':
+        hasher = hashlib.md5()
+    elif hash_type == 'crc32c':
+        hasher = google_crc32c.Checksum()
+    else:
+        err = (
+            'spectral_trend_database.gcp.file_hash: '
+            f'invalid hash_type ({hash_type}) must be one of md5 or crc32c.'
+        )
+        raise ValueError(err)
+    with open(src, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return base64.b64encode(hasher.digest()).decode('utf-8')
+
+
 #
 # BIG QUERY
 #
@@ -214,7 +420,7 @@ def load_or_create_dataset(
         project (Optional[str] = None): gcp project name
         client Optional[bq.Client] = None):
             instance of bigquery client
-            if None a new one will be instantiated
+            if None use shared client (see `clients`)
         timeout (int=30): timeout (seconds)
         warn (bool = False): print message if dataset exist
 
@@ -223,7 +429,7 @@ def load_or_create_dataset(
         bigquery dataset
     """
     if client is None:
-        client = bq.Client(project=project)
+        client = clients.bigquery_client(project=project)
     try:
         dataset = client.get_dataset(name)
         if warn:
@@ -239,46 +445,82 @@ def load_or_create_dataset(
     return dataset
 
 
-def create_or_update_table_from_json(
+def create_or_update_table(
         dataset: bq.Dataset,
         name: str,
         uri: str,
+        file_format: Optional[types.TABLE_FORMAT] = None,
+        schema: Optional[Union[pa.Schema, list[bq.SchemaField]]] = None,
         wait: bool = True,
         return_table: bool = False,
         project: Optional[str] = None,
         client: Optional[bq.Client] = None,
-        timeout: int = c.DEFAULT_TIMEOUT) -> Union[bq.Table, None]:
-    """ create/update table from (line deliminated) json
+        timeout: int = c.DEFAULT_TIMEOUT,
+        partition: Optional[dict] = None,
+        clustering: Optional[types.STRINGS] = None) -> Union[bq.Table, None]:
+    """ create/update table from (line deliminated) json or parquet
 
     Note:
 
-    list valued columns failed if they contained NaNs. Substitue NaNs
-    with value (such as -99999) and replace after loading table.
+    If <schema> is None the schema is autodetected. For json, list valued
+    columns failed if they contained NaNs. Substitue NaNs with value
+    (such as -99999) and replace after loading table. Parquet files written
+    with `utils.dataframe_to_parquet` and loaded with an explicit schema
+    do not have this issue.
+
+    Partitioning/clustering are only applied when the table is created
+    (BigQuery rejects loads whose partitioning/clustering differ from an existing
+    destination table). Existing tables keep their layout: to partition an
+    existing table delete (or recreate) it before loading. see
+    `table_partitioning` for a description of the <partition> spec.
 
     Args:
 
         dataset (bq.Dataset): instance of bigquery dataset to create table in
         name (str): name for table
-        uri (str): cloud-storage uri of line-deliminated-json
+        uri (str): cloud-storage uri of line-deliminated-json or parquet file
+        file_format (Optional[types.TABLE_FORMAT] = None):
+            one of 'json' or 'parquet'. if None use file extension of <uri>
+        schema (Optional[Union[pa.Schema, list[bq.SchemaField]]] = None):
+            explicit table schema (arrow schemas are converted with `bigquery_schema`).
+            if None autodetect schema
         wait (bool = True): wait from creation to complete before continuing
         return_table (bool = False): if true return bigquery table instance
         project (Optional[str] = None): gcp project name
         client Optional[bq.Client] = None):
             instance of bigquery client
-            if None a new one will be instantiated
+            if None use shared client (see `clients`)
         timeout (int=30): timeout (seconds)
+        partition (Optional[dict] = None): partition spec (see `table_partitioning`)
+        clustering (Optional[types.STRINGS] = None): column(s) to cluster table on
 
     Returns:
 
         if <return table>: bigquery table instance
     """
     if client is None:
-        client = bq.Client(project=project)
+        client = clients.bigquery_client(project=project)
+    if file_format is None:
+        file_format = utils.file_format_from_path(uri)
+    if isinstance(schema, pa.Schema):
+        schema = bigquery_schema(schema)
+    if isinstance(clustering, str):
+        clustering = [clustering]
+    format_kwargs = {}
+    if file_format == utils.PARQUET_FORMAT:
+        parquet_options = bq.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        format_kwargs['parquet_options'] = parquet_options
     table_id = f'{client.project}.{dataset.dataset_id}.{name}'
+    if (partition or clustering) and table_exists(table_id, client=client):
+        partition, clustering = None, None
     job_config = bq.LoadJobConfig(
-        autodetect=True,
-        source_format=bq.SourceFormat.NEWLINE_DELIMITED_JSON,
-    )
+        autodetect=not schema,
+        schema=schema or None,
+        source_format=SOURCE_FORMATS[file_format],
+        clustering_fields=clustering or None,
+        **format_kwargs,
+        **table_partitioning(partition))
     job = client.load_table_from_uri(
         uri,
         table_id,
@@ -290,3 +532,222 @@ def create_or_update_table_from_json(
         return client.get_table(table_id)
     else:
         return None
+
+
+def create_or_update_table_from_json(
+        dataset: bq.Dataset,
+        name: str,
+        uri: str,
+        wait: bool = True,
+        return_table: bool = False,
+        project: Optional[str] = None,
+        client: Optional[bq.Client] = None,
+        timeout: int = c.DEFAULT_TIMEOUT,
+        partition: Optional[dict] = None,
+        clustering: Optional[types.STRINGS] = None) -> Union[bq.Table, None]:
+    """ create/update table from (line deliminated) json with autodetected schema
+
+    see `create_or_update_table`
+    """
+    return create_or_update_table(
+        dataset,
+        name=name,
+        uri=uri,
+        file_format=utils.JSON_FORMAT,  # type: ignore[arg-type]
+        wait=wait,
+        return_table=return_table,
+        project=project,
+        client=client,
+        timeout=timeout,
+        partition=partition,
+        clustering=clustering)
+
+
+def bigquery_schema(schema: pa.Schema) -> list[bq.SchemaField]:
+    """ bigquery schema from arrow schema
+
+    - float32/float64 => FLOAT64
+    - (u)int => INT64
+    - date => DATE
+    - timestamp => TIMESTAMP
+    - list<type> => REPEATED <TYPE>
+
+    Args:
+
+        schema (pa.Schema): arrow schema (ie `pq.read_schema(path)`)
+
+    Returns:
+
+        (list[bq.SchemaField]) bigquery schema
+    """
+    fields = []
+    for field in schema:
+        dtype = field.type
+        if pa.types.is_list(dtype) or pa.types.is_large_list(dtype):
+            dtype = dtype.value_type
+            mode = REPEATED_MODE
+        else:
+            mode = NULLABLE_MODE
+        fields.append(bq.SchemaField(field.name, _bigquery_type(dtype), mode=mode))
+    return fields
+
+
+def table_exists(table_id: str, client: Optional[bq.Client] = None) -> bool:
+    """ true if bigquery table <table_id> (project.dataset.name) exists """
+    if client is None:
+        client = clients.bigquery_client()
+    try:
+        client.get_table(table_id)
+        return True
+    except gexceptions.NotFound:
+        return False
+
+
+def table_partitioning(partition: Optional[dict] = None) -> dict:
+    """ bigquery partitioning kwargs from partition spec
+
+    Partition spec:
+
+    ```yaml
+    # integer-range partitioning
+    field: year
+    start: 2000
+    end: 2030
+    interval: 1    # optional (default 1)
+
+    # time partitioning
+    field: date
+    type: DAY      # one of DAY, MONTH, YEAR (default DAY)
+    ```
+
+    Additionally, `date_field` (range partitions) or `year_field` (time partitions)
+    name a column whose values determine the partition (ie year == date.year).
+    `query.QueryConstructor` uses these to add partition-pruning filters.
+
+    Note: integer-range partitioning is used if the spec contains `start` or
+    `type: RANGE`. Otherwise time partitioning is used.
+
+    Args:
+
+        partition (Optional[dict] = None): partition spec
+
+    Returns:
+
+        (dict) `range_partitioning` or `time_partitioning` kwarg for bq.LoadJobConfig
+    """
+    if not partition:
+        return {}
+    elif is_range_partition(partition):
+        return dict(range_partitioning=bq.RangePartitioning(
+            field=partition['field'],
+            range_=bq.PartitionRange(
+                start=partition['start'],
+                end=partition['end'],
+                interval=partition.get('interval', 1))))
+    else:
+        return dict(time_partitioning=bq.TimePartitioning(
+            type_=partition.get('type', bq.TimePartitioningType.DAY).upper(),
+            field=partition['field']))
+
+
+def is_range_partition(partition: dict) -> bool:
+    """ true if partition spec is an integer-range partition (see `table_partitioning`) """
+    return ('start' in partition) or (partition.get('type', '').upper() == RANGE_PARTITION)
+
+
+def table_layout(name: Optional[str]) -> dict:
+    """ partition spec and clustering for table
+
+    Args:
+
+        name (Optional[str]): table name (case insensitive, may include project/dataset)
+
+    Returns:
+
+        (dict) `partition`/`clustering` kwargs for `create_or_update_table`
+        taken from `c.TABLE_PARTITIONS[<NAME>]`
+    """
+    layouts = c.TABLE_PARTITIONS or {}
+    if name:
+        layout = layouts.get(name.strip('`').split('.')[-1].upper(), {})
+    else:
+        layout = {}
+    return dict(
+        partition=layout.get('partition'),
+        clustering=layout.get('clustering'))
+
+
+def table_format(name: Optional[str]) -> dict:
+    """ file format and float type for table
+
+    Args:
+
+        name (Optional[str]): table name (case insensitive, may include project/dataset)
+
+    Returns:
+
+        (dict) `file_format`/`float_type` kwargs for `utils.save_dataframe` taken
+        from `c.TABLE_FORMATS[<NAME>]` (defaults: `c.DEFAULT_TABLE_FORMAT`,
+        `c.DEFAULT_FLOAT_TYPE`)
+    """
+    formats = c.TABLE_FORMATS or {}
+    if name:
+        table_config = formats.get(name.strip('`').split('.')[-1].upper(), {})
+    else:
+        table_config = {}
+    if isinstance(table_config, str):
+        table_config = dict(format=table_config)
+    file_format = table_config.get('format', c.DEFAULT_TABLE_FORMAT)
+    float_type = table_config.get('float_type', c.DEFAULT_FLOAT_TYPE)
+    if file_format not in types.TABLE_FORMAT_ARGS:
+        err = (
+            'spectral_trend_database.gcp.table_format: '
+            f'invalid format ({file_format}) must be one of {types.TABLE_FORMAT_ARGS}.'
+        )
+        raise ValueError(err)
+    if float_type not in types.FLOAT_TYPE_ARGS:
+        err = (
+            'spectral_trend_database.gcp.table_format: '
+            f'invalid float_type ({float_type}) must be one of {types.FLOAT_TYPE_ARGS}.'
+        )
+        raise ValueError(err)
+    return dict(
+        file_format=file_format,
+        float_type=float_type)
+
+
+#
+# INTERNAL
+#
+def _bigquery_type(dtype: pa.DataType) -> str:
+    if pa.types.is_floating(dtype):
+        return 'FLOAT64'
+    elif pa.types.is_integer(dtype):
+        return 'INT64'
+    elif pa.types.is_boolean(dtype):
+        return 'BOOL'
+    elif pa.types.is_date(dtype):
+        return 'DATE'
+    elif pa.types.is_timestamp(dtype):
+        return 'TIMESTAMP'
+    elif pa.types.is_string(dtype) or pa.types.is_large_string(dtype) or pa.types.is_null(dtype):
+        return 'STRING'
+    else:
+        err = (
+            'spectral_trend_database.gcp.bigquery_schema: '
+            f'unsupported arrow type ({dtype}).'
+        )
+        raise ValueError(err)
+
+
+def _with_retries(
+        func: Callable,
+        retries: int = UPLOAD_RETRIES,
+        backoff: float = UPLOAD_BACKOFF) -> Any:
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == retries:
+                raise e
+            time.sleep(backoff ** attempt)
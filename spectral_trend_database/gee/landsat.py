@@ -34,8 +34,13 @@ band descriptions:
 License:
     BSD, see LICENSE.md
 """
-from typing import Union, Optional
-import ee
+from __future__ import annotations
+from typing import TYPE_CHECKING, Union, Optional
+from spectral_trend_database import lazy
+if TYPE_CHECKING:
+    import ee
+else:
+    ee = lazy.lazy_import('ee')
 
 
 #
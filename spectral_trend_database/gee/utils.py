@@ -3,13 +3,20 @@
 License:
     BSD, see LICENSE.md
 """
-from typing import Union, Optional
-import ee
+from __future__ import annotations
+from typing import TYPE_CHECKING, Union, Optional
 import re
 from pprint import pprint
-import requests
 import numpy as np
-import xarray as xr
+from spectral_trend_database import lazy
+if TYPE_CHECKING:
+    import ee
+    import requests
+    import xarray as xr
+else:
+    ee = lazy.lazy_import('ee')
+    requests = lazy.lazy_import('requests')
+    xr = lazy.lazy_import('xarray')
 
 
 EE_CRS = 'EPSG:3857'
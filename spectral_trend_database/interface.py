@@ -3,28 +3,44 @@
 License:
     BSD, see LICENSE.md
 """
-from typing import Optional, Union, Sequence, Callable
+from __future__ import annotations
+from typing import TYPE_CHECKING, Optional, Union, Sequence, Callable, Any
 from pathlib import Path
-from IPython.display import display
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
 import json
 import pandas as pd
-import mproc  # type: ignore[import-untyped]
+import pyarrow.parquet as pq  # type: ignore[import-untyped]
+from spectral_trend_database import lazy
 from spectral_trend_database.config import config as c
 from spectral_trend_database import utils
 from spectral_trend_database import paths
 from spectral_trend_database import gcp
+from spectral_trend_database import parallel
+from spectral_trend_database import profiling
+from spectral_trend_database import sharding
 from spectral_trend_database import types
-import ee
-ee.Initialize()
+if TYPE_CHECKING:
+    import IPython.display as ipython_display
+    import mproc  # type: ignore[import-untyped]
+    import ee
+else:
+    ipython_display = lazy.lazy_import('IPython.display')
+    mproc = lazy.lazy_import('mproc')
+    # earth-engine is initialized on first use
+    ee = lazy.lazy_import('ee', on_load=lambda module: module.Initialize())
 
 
 #
 # CONSTANTS
 #
-DEFAULT_MAP_METHOD: types.MAP_METHOD = 'threadpool'
+DEFAULT_MAP_METHOD: types.MAP_METHOD = c.DEFAULT_MAP_METHOD
 NOISY = True
 DRY_RUN = False
 EXT = 'json'
+# saves run in order (one at a time) so loads into the same table never race
+ASYNC_SAVE_WORKERS = 1
 
 CORN_TYPE: str = 'corn'
 SOY_TYPE: str = 'soy'
@@ -37,6 +53,14 @@ OTHER_LABEL: int = 2
 NA_LABEL: int = 3
 
 
+#
+# ASYNC SAVES
+#
+_SAVE_LOCK = threading.Lock()
+_SAVE_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_PENDING_SAVES: list[Future] = []
+
+
 #
 # HELPERS
 #
@@ -61,6 +85,8 @@ def mapper(func: Union[types.MAP_METHOD, Callable]) -> Callable:
             f'or one of {types.MAP_METHOD_ARGS}.'
         )
         raise ValueError(err)
+    else:
+        mapper = func
     return mapper
 
 
@@ -153,7 +179,26 @@ def table_name_and_paths(
         table_name: Optional[str] = None,
         year: Optional[int] = None,
         file_name: Optional[str] = None,
-        ext: Optional[str] = 'json'):
+        ext: Optional[str] = None):
+    """ table name and local/gcs destinations
+
+    if `c.SHARD` is set the destinations are shard specific (see `sharding.shard_path`)
+
+    Args:
+
+        *path_parts (str): folder path parts
+        table_name (Optional[str] = None): table name
+        year (Optional[int] = None): if not None append `-<year>` to file name
+        file_name (Optional[str] = None): file name. if None use lower-cased table name
+        ext (Optional[str] = None):
+            file extension. if None use table's format (see `gcp.table_format`)
+
+    Returns:
+
+        (tuple) table_name, local_dest, gcs_dest
+    """
+    if ext is None:
+        ext = gcp.table_format(table_name)['file_format']
     if table_name:
         table_name = table_name.upper()
     if not file_name:
@@ -168,7 +213,209 @@ def table_name_and_paths(
     gcs_dest = paths.gcs(
         *path_parts,
         file_name)
-    return table_name, local_dest, gcs_dest
+    return table_name, sharding.shard_path(local_dest), sharding.shard_path(gcs_dest)
+
+
+def limit_samples(
+        data: pd.DataFrame,
+        key: str = 'sample_id',
+        limit: Optional[int] = None) -> pd.DataFrame:
+    """ rows of the first <limit> samples (ordered by <key>). if <limit> is falsy return <data> """
+    if not limit:
+        return data
+    keys = pd.Series(data[key].unique()).sort_values().head(limit)
+    return data[data[key].isin(keys)]
+
+
+def sample_groups(
+        data: pd.DataFrame,
+        key: str = 'sample_id',
+        sort_by: Optional[types.STRINGS] = c.DATE_COLUMN) -> list[tuple[Any, pd.DataFrame]]:
+    """ per-sample slices of dataframe
+
+    Sorts <data> once (by <key>, then <sort_by>) and slices it with precomputed
+    group offsets (see `utils.group_offsets`). This replaces filtering with
+    `data[data.sample_id == s]` for each sample, which scans the full column
+    for every sample.
+
+    Usage:
+
+    ```python
+    errors = mproc.map_with_threadpool(
+        lambda group: process(group[1], sample_id=group[0]),
+        sample_groups(data))
+    ```
+
+    Args:
+
+        data (pd.DataFrame): source dataframe
+        key (str = 'sample_id'): grouping column
+        sort_by (Optional[types.STRINGS] = 'date'):
+            column(s) to (stable) sort by within each group
+
+    Returns:
+
+        (list) of (key-value, dataframe-slice) tuples ordered by key-value
+    """
+    if isinstance(sort_by, str):
+        sort_by = [sort_by]
+    columns = [key] + [col for col in (sort_by or []) if col and (col != key)]
+    data = data.sort_values(columns, kind='stable', ignore_index=True)
+    starts, ends = utils.group_offsets(data[key].to_numpy())
+    keys = data[key].to_numpy()
+    return [(keys[start], data.iloc[start:end]) for start, end in zip(starts, ends)]
+
+
+def map_samples(
+        func: Callable,
+        data: pd.DataFrame,
+        key: str = 'sample_id',
+        sort_by: Optional[types.STRINGS] = c.DATE_COLUMN,
+        method: Optional[Union[types.MAP_METHOD, Callable]] = None,
+        max_processes: Optional[int] = None,
+        on_result: Optional[Callable] = None,
+        columns: Optional[Sequence[str]] = None,
+        pass_key: bool = False,
+        **kwargs) -> list:
+    """ map function over per-sample slices of dataframe
+
+    calls `func(rows, **{<key>: value}, **kwargs)` for each group. For
+    method='pool' the data is placed in shared memory and groups are
+    processed by a process pool (see `parallel.map_groups`), otherwise groups
+    are sliced with `sample_groups` and mapped with `mapper(method)`.
+
+    if `c.SHARD` is set only the samples of the shard are processed (see
+    `sharding.select_shard`). if `c.LIMIT` is set only the first `c.LIMIT`
+    groups (ordered by <key>) are processed (ie `stdb profile <job> --limit 100`).
+
+    Args:
+
+        func (Callable): per-sample function (module level for method='pool')
+        data (pd.DataFrame): source dataframe
+        key (str = 'sample_id'): grouping column
+        sort_by (Optional[types.STRINGS] = 'date'): column(s) to sort by within groups
+        method (Optional[Union[types.MAP_METHOD, Callable]] = None):
+            one of 'sequential', 'threadpool', 'pool' or a mproc-like map function.
+            if None use `c.DEFAULT_MAP_METHOD`
+        max_processes (Optional[int] = None):
+            max number of threads/processes. if None use `c.MAX_PROCESSES` (if set)
+        on_result (Optional[Callable] = None):
+            called with each result (in the parent process for method='pool').
+            if passed, its return values are returned in place of the results
+        columns (Optional[Sequence[str]] = None):
+            columns passed to <func> for method='pool'. if None all columns
+        pass_key (bool = False):
+            if true <on_result> is called with the result and the group's <key>
+            value (ie to record samples without rows, see `write_result`)
+        **kwargs: passed to <func>
+
+    Returns:
+
+        (list) results (or <on_result> values) in group order
+    """
+    if method is None:
+        method = c.DEFAULT_MAP_METHOD
+    if max_processes is None:
+        max_processes = c.get('MAX_PROCESSES')
+    data = sharding.select_shard(data)
+    data = limit_samples(data, key=key, limit=c.get('LIMIT'))
+    with profiling.stage(profiling.COMPUTE, unit='samples') as stage:
+        if method == 'pool':
+            # don't start workers while background uploads are running
+            wait_for_saves()
+            results = parallel.map_groups(
+                func,
+                data,
+                key=key,
+                sort_by=sort_by,
+                columns=columns,
+                max_processes=max_processes,
+                on_result=on_result,
+                pass_key=pass_key,
+                **kwargs)
+        else:
+            def _run(group):
+                result = func(group[1], **{key: group[0]}, **kwargs)
+                if on_result and pass_key:
+                    result = on_result(result, group[0])
+                elif on_result:
+                    result = on_result(result)
+                return result
+            results = mapper(method)(
+                _run,
+                sample_groups(data, key=key, sort_by=sort_by),
+                max_processes=max_processes)
+        stage.items = len(results)
+    return results
+
+
+def output_sink(
+        dest: str,
+        table_name: Optional[str] = None,
+        sharded: bool = True,
+        dry_run: bool = DRY_RUN,
+        noisy: bool = NOISY) -> Union[utils.ShardedTableSink, utils.TableSink]:
+    """ output writer for (threaded) per-sample results
+
+    Args:
+
+        dest (str): local dest. the file format is taken from its extension
+        table_name (Optional[str] = None): table name used to look up float type
+            (see `gcp.table_format`)
+        sharded (bool = True):
+            if true each worker thread writes to its own shard and shards are
+            merged into <dest> on `close()` (see `utils.ShardedTableSink`).
+            otherwise threads share a single locked `utils.TableSink`
+        dry_run (bool = DRY_RUN): if true print message but don't save
+        noisy (bool = NOISY): if true print destination
+
+    Returns:
+
+        (utils.ShardedTableSink|utils.TableSink) sink. call `close()` before `save_to_gcp`
+    """
+    float_type = gcp.table_format(table_name)['float_type']
+    if sharded:
+        return utils.ShardedTableSink(dest, float_type=float_type, dry_run=dry_run, noisy=noisy)
+    else:
+        return utils.TableSink(dest, float_type=float_type, dry_run=dry_run, noisy=noisy)
+
+
+def write_result(
+        result: Any,
+        sink: Union[utils.ShardedTableSink, utils.TableSink],
+        sample_id: Optional[str] = None) -> Any:
+    """ write dataframe results to sink and pass through anything else (ie errors)
+
+    Usage:
+
+    ```python
+    errors = map_samples(
+        func,
+        data,
+        on_result=lambda r, sample_id: write_result(r, sink, sample_id=sample_id),
+        pass_key=True)
+    ```
+
+    Args:
+
+        result (Any): result of per-sample function
+        sink (Union[utils.ShardedTableSink, utils.TableSink]): output sink
+        sample_id (Optional[str] = None):
+            sample id passed to the sink with empty results, so that
+            `checkpoint.CheckpointSink` records samples without rows as completed
+
+    Returns:
+
+        None if <result> is a dataframe, otherwise <result>
+    """
+    if isinstance(result, pd.DataFrame):
+        if result.empty and (sample_id is not None):
+            sink.write(result, sample_id=sample_id)
+        else:
+            sink.write(result)
+        return None
+    else:
+        return result
 
 
 def print_errors(errors: list[str]):
@@ -179,14 +426,14 @@ def print_errors(errors: list[str]):
             _df = df[~df.error.isna()]
             if _df.shape[0]:
                 print(f'ERRORS [{_df.shape[0]}]:')
-                display(_df.groupby('error').size())
+                ipython_display.display(_df.groupby('error').size())
         except:
             pass
         try:
             _df = df[~df.warning.isna()]
             if _df.shape[0]:
                 print(f'WARNING [{_df.shape[0]}]:')
-                display(_df.groupby('warning').size())
+                ipython_display.display(_df.groupby('warning').size())
         except:
             pass
 
@@ -200,14 +447,193 @@ def save_to_gcp(
         gcs_uri: Optional[str] = None,
         remove_src: bool = False,
         noisy: bool = NOISY,
-        dry_run: bool = False) -> None:
+        dry_run: bool = False,
+        asynchronous: bool = False) -> Union[Future, None]:
+    """ upload local file to cloud storage and load it into bigquery table
+
+    if `c.SHARD` is set the table load is skipped. tables are loaded from the
+    merged shards (see `merge_shards`).
+
+    Args:
+
+        src (str): local source file
+        gcs_dest (Optional[str]): cloud storage destination. if None skip upload
+        dataset_name (Optional[str]): bigquery dataset name
+        table_name (Optional[str]): bigquery table name. if None skip table load
+        bigquery_loc (str = c.LOCATION): bigquery location
+        gcs_uri (Optional[str] = None): uri to load table from (if <gcs_dest> is None)
+        remove_src (bool = False): if true delete <src> after upload
+        noisy (bool = NOISY): if true print progress
+        dry_run (bool = False): if true print message but don't save
+        asynchronous (bool = False):
+            if true upload/load in a background thread and return a future.
+            call `wait_for_saves` before exiting to join outstanding saves
+
+    Returns:
+
+        if <asynchronous> future of the save, otherwise None
+    """
+    if table_name and sharding.current_shard():
+        if noisy:
+            print(f'- shard {c.SHARD}: defer table load [{dataset_name}.{table_name}] to merge')
+        table_name = None
+    save = partial(
+        _save_to_gcp,
+        src=src,
+        gcs_dest=gcs_dest,
+        dataset_name=dataset_name,
+        table_name=table_name,
+        bigquery_loc=bigquery_loc,
+        gcs_uri=gcs_uri,
+        remove_src=remove_src,
+        noisy=noisy,
+        dry_run=dry_run)
+    if asynchronous:
+        global _SAVE_EXECUTOR
+        with _SAVE_LOCK:
+            if _SAVE_EXECUTOR is None:
+                _SAVE_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=ASYNC_SAVE_WORKERS,
+                    thread_name_prefix='save_to_gcp')
+            future = _SAVE_EXECUTOR.submit(save)
+            _PENDING_SAVES.append(future)
+        return future
+    else:
+        save()
+        return None
+
+
+def merge_shards(
+        local_dest: str,
+        gcs_dest: str,
+        dataset_name: Optional[str],
+        table_name: Optional[str],
+        count: Optional[int] = None,
+        remove_src: bool = True,
+        noisy: bool = NOISY,
+        dry_run: bool = False,
+        asynchronous: bool = False) -> Union[Future, None]:
+    """ merge uploaded shard files then upload/load the merged table
+
+    downloads the <count> shard files of <gcs_dest> (see `sharding.shard_paths`),
+    merges them into <local_dest> and calls `save_to_gcp`.
+
+    Args:
+
+        local_dest (str): local destination of merged file
+        gcs_dest (str): cloud storage destination of merged file
+        dataset_name (Optional[str]): bigquery dataset name
+        table_name (Optional[str]): bigquery table name. if None skip table load
+        count (Optional[int] = None): number of shards. if None use `c.MERGE_SHARDS`
+        remove_src (bool = True): if true delete local shard and merged files after upload
+        noisy (bool = NOISY): if true print progress
+        dry_run (bool = False): if true print message but don't save
+        asynchronous (bool = False): passed to `save_to_gcp`
+
+    Returns:
+
+        if <asynchronous> future of the save, otherwise None
+    """
+    count = count or sharding.merge_count()
+    if not count:
+        err = (
+            'spectral_trend_database.interface.merge_shards: '
+            'count or c.MERGE_SHARDS required'
+        )
+        raise ValueError(err)
+    shard_uris = sharding.shard_paths(gcs_dest, count)
+    shard_srcs = sharding.shard_paths(local_dest, count)
+    if noisy:
+        print(f'- merge {count} shards:', gcs_dest)
+    if dry_run:
+        if noisy:
+            print('- dry_run [merge]:', local_dest)
+        return save_to_gcp(
+            src=local_dest,
+            gcs_dest=gcs_dest,
+            dataset_name=dataset_name,
+            table_name=table_name,
+            noisy=noisy,
+            dry_run=dry_run)
+    existing = set(gcp.gcs_list(gcs_dest.rsplit('/', 1)[0]))
+    missing = [uri for uri in shard_uris if uri not in existing]
+    if missing:
+        err = (
+            'spectral_trend_database.interface.merge_shards: '
+            f'missing shards {missing}'
+        )
+        raise ValueError(err)
+    for uri, src in zip(shard_uris, shard_srcs):
+        gcp.download_file(uri, src)
+    utils.merge_table_files(shard_srcs, local_dest)
+    if remove_src:
+        for src in shard_srcs:
+            Path(src).unlink(missing_ok=True)
+    return save_to_gcp(
+        src=local_dest,
+        gcs_dest=gcs_dest,
+        dataset_name=dataset_name,
+        table_name=table_name,
+        remove_src=remove_src,
+        noisy=noisy,
+        dry_run=dry_run,
+        asynchronous=asynchronous)
+
+
+def wait_for_saves(raise_errors: bool = True) -> list[Any]:
+    """ wait for outstanding asynchronous `save_to_gcp` calls
+
+    Args:
+
+        raise_errors (bool = True):
+            if true re-raise the first error (after all saves have completed).
+            otherwise errors are returned in place of results
+
+    Returns:
+
+        (list) results (or errors) of saves, in order of submission
+    """
+    with _SAVE_LOCK:
+        futures = list(_PENDING_SAVES)
+        _PENDING_SAVES.clear()
+    results: list[Any] = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    if raise_errors:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
+
+#
+# INTERNAL
+#
+def _save_to_gcp(
+        src: str,
+        gcs_dest: Optional[str],
+        dataset_name: Optional[str],
+        table_name: Optional[str],
+        bigquery_loc: str,
+        gcs_uri: Optional[str],
+        remove_src: bool,
+        noisy: bool,
+        dry_run: bool) -> Union[str, None]:
+    schema = None
+    if table_name and (not dry_run) and (utils.file_format_from_path(src) == utils.PARQUET_FORMAT):
+        # read before <src> is (optionally) removed
+        schema = pq.read_schema(src)
     if gcs_dest:
         assert isinstance(gcs_dest, str)
         if dry_run:
             if noisy:
                 print('- dry_run [gcs]:', gcs_dest)
         else:
-            gcs_uri = gcp.upload_file(src, gcs_dest)
+            with profiling.stage(profiling.UPLOAD, items=Path(src).stat().st_size, unit='bytes'):
+                gcs_uri = gcp.upload_file(src, gcs_dest)
             if noisy:
                 print('- uploaded to gcs:', gcs_uri)
             if gcs_uri and remove_src:
@@ -221,7 +647,11 @@ def save_to_gcp(
                 print(f'- update table [{dataset_name}.{table_name}]')
             assert isinstance(dataset_name, str)
             assert isinstance(gcs_uri, str)
-            gcp.create_or_update_table_from_json(
-                gcp.load_or_create_dataset(dataset_name, bigquery_loc),
-                name=table_name,
-                uri=gcs_uri)
+            with profiling.stage(profiling.LOAD, items=1, unit='tables'):
+                gcp.create_or_update_table(
+                    gcp.load_or_create_dataset(dataset_name, bigquery_loc),
+                    name=table_name,
+                    uri=gcs_uri,
+                    schema=schema,
+                    **gcp.table_layout(table_name))
+    return gcs_uri
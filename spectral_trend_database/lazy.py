@@ -0,0 +1,116 @@
+""" lazy module loader
+
+DESCRIPTION:
+    defers importing heavy dependencies (bigquery, dask, scipy, xarray, ...)
+    until one of their attributes is first used. this keeps `stdb --help`,
+    worker processes and small library calls from paying seconds of import
+    time for modules they never touch.
+
+    `lazy_import` returns a module proxy. the real module is imported
+    (thread-safely) on the first attribute access, after which the proxy
+    forwards every attribute lookup to it. use it together with
+    `typing.TYPE_CHECKING` so static type checkers still see the real module.
+
+    note: annotations referencing a lazy module are evaluated at definition
+    time unless the importing module uses `from __future__ import annotations`.
+
+USAGE:
+    ```python
+    from typing import TYPE_CHECKING
+    from spectral_trend_database import lazy
+    if TYPE_CHECKING:
+        import xarray as xr
+    else:
+        xr = lazy.lazy_import('xarray')
+
+    ds = xr.Dataset()  # xarray is imported here
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from typing import Any, Callable, Optional, Sequence
+import importlib
+import sys
+import threading
+from types import ModuleType
+
+
+#
+# LOADER
+#
+class LazyModule(ModuleType):
+    """ module proxy that imports <name> on first attribute access """
+    def __init__(
+            self,
+            name: str,
+            submodules: Sequence[str] = (),
+            on_load: Optional[Callable[[ModuleType], Any]] = None) -> None:
+        """
+        Args:
+
+            name (str): module name
+            submodules (Sequence[str] = ()):
+                submodules imported with <name> (ie ['array'] for `import dask.array`)
+            on_load (Optional[Callable[[ModuleType], Any]] = None):
+                called with the module once it has been imported
+        """
+        super().__init__(name)
+        self.__dict__['_lazy_state'] = dict(
+            module=None,
+            submodules=list(submodules),
+            on_load=on_load,
+            lock=threading.Lock())
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+    def __dir__(self) -> list[str]:
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self.__dict__['_lazy_state']['module'] else 'not loaded'
+        return f'<lazy module {self.__name__!r} ({state})>'
+
+    def _load(self) -> ModuleType:
+        state = self.__dict__['_lazy_state']
+        if state['module'] is None:
+            with state['lock']:
+                if state['module'] is None:
+                    module = importlib.import_module(self.__name__)
+                    for submodule in state['submodules']:
+                        importlib.import_module(f'{self.__name__}.{submodule}')
+                    if state['on_load']:
+                        state['on_load'](module)
+                    state['module'] = module
+        return state['module']
+
+
+def lazy_import(
+        name: str,
+        submodules: Sequence[str] = (),
+        on_load: Optional[Callable[[ModuleType], Any]] = None) -> ModuleType:
+    """ lazily imported module
+
+    Args:
+
+        name (str): module name (ie 'xarray' or 'google.cloud.bigquery')
+        submodules (Sequence[str] = ()):
+            submodules imported with <name> (ie ['array'] for `import dask.array`)
+        on_load (Optional[Callable[[ModuleType], Any]] = None):
+            called with the module once it has been imported (ie `ee.Initialize`)
+
+    Returns:
+
+        (ModuleType) the module if it has already been imported (and neither
+        <submodules> nor <on_load> are passed) otherwise a `LazyModule`
+    """
+    module = sys.modules.get(name)
+    if (module is not None) and (not submodules) and (on_load is None):
+        return module
+    return LazyModule(name, submodules=submodules, on_load=on_load)
+
+
+def is_loaded(name: str) -> bool:
+    """ true if module <name> has been imported """
+    return name in sys.modules
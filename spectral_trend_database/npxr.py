@@ -1,11 +1,21 @@
-from typing import Any, Callable, Union, Optional, Literal, Sequence, Literal
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Callable, Union, Optional, Literal, Sequence, Literal
+import os
+import threading
+import time
 from copy import deepcopy
 from functools import wraps
 import numpy as np
-import xarray as xr
-import dask.array
+import pandas as pd
+from spectral_trend_database import lazy
 from spectral_trend_database import types
 from spectral_trend_database import utils
+if TYPE_CHECKING:
+    import xarray as xr
+    import dask.array
+else:
+    xr = lazy.lazy_import('xarray')
+    dask = lazy.lazy_import('dask', submodules=['array'])
 
 
 #
@@ -16,6 +26,24 @@ DATA_ARRAY_TYPE = 'data_array'
 DATASET_TYPE = 'dataset'
 REINDEX_DROP_INIT = 'drop_init'
 REINDEX_DROP_LAST = 'drop_last'
+PROFILE_ENV_VAR = 'STDB_NPXR_PROFILE'
+PROFILE_COLUMNS = [
+    'function',
+    'calls',
+    'total_time',
+    'conversion_time',
+    'kernel_time',
+    'conversion_fraction',
+    'bytes_copied']
+
+
+#
+# PROFILING STATE
+#
+_PROFILE_LOCK = threading.Lock()
+_PROFILE: dict[str, Any] = dict(
+    enabled=os.environ.get(PROFILE_ENV_VAR, '').lower() in ['1', 'true', 'yes'],
+    stats={})
 
 
 #
@@ -229,6 +257,9 @@ def execute_func(
         data processed by <func>, possibly along an axis, in the same format
         as the initial source data.
     """
+    profile = _PROFILE['enabled']
+    if profile:
+        start = time.perf_counter()
     if data is None:
         data = args[0]
         args = args[1:]
@@ -240,6 +271,8 @@ def execute_func(
         data=data,
         data_vars=data_vars,
         exclude=exclude)
+    if profile:
+        kernel_start = time.perf_counter()
     if along_axis is False:
         values = func(values, *args, **kwargs)
     else:
@@ -249,10 +282,19 @@ def execute_func(
             axis=along_axis,
             arr=values,
             **kwargs)
-    return post_process_npxr_data(
+    if profile:
+        kernel_end = time.perf_counter()
+    result = post_process_npxr_data(
         data=data,
         values=values,
         rename=rename)
+    if profile:
+        _record_call(
+            func,
+            conversion_time=(kernel_start - start) + (time.perf_counter() - kernel_end),
+            kernel_time=kernel_end - kernel_start,
+            bytes_copied=_bytes_copied(data, values))
+    return result
 
 
 def post_process_npxr_data(data: types.NPDXR, values: types.NPD, rename: dict[str, str] = {}):
@@ -283,9 +325,95 @@ def post_process_npxr_data(data: types.NPDXR, values: types.NPD, rename: dict[st
     return data
 
 
+#
+# PROFILING
+#
+def enable_profiling(enabled: bool = True) -> None:
+    """ turn npxr profiling on/off
+
+    when enabled `execute_func` (and so every npxr-decorated function) records
+    per-function call counts, time spent converting between xarray and numpy
+    (copying, stacking and rebuilding data) vs time spent in the decorated
+    function ("kernel"), and an estimate of the bytes copied. profiling may
+    also be enabled by setting the environment variable STDB_NPXR_PROFILE=1.
+
+    Args:
+
+        enabled (bool = True): if true record profiling stats
+    """
+    _PROFILE['enabled'] = enabled
+
+
+def profiling_enabled() -> bool:
+    """ true if npxr profiling is enabled """
+    return _PROFILE['enabled']
+
+
+def reset_profile() -> None:
+    """ clear recorded npxr profiling stats """
+    with _PROFILE_LOCK:
+        _PROFILE['stats'] = {}
+
+
+def profile_report(reset: bool = False) -> pd.DataFrame:
+    """ npxr profiling report
+
+    Note: times are inclusive. if a decorated function calls other decorated
+    functions their time is included in its kernel time.
+
+    Args:
+
+        reset (bool = False): if true clear recorded stats
+
+    Returns:
+
+        (pd.DataFrame) one row per decorated function (sorted by total_time) with
+        columns: function, calls, total_time, conversion_time, kernel_time,
+        conversion_fraction (conversion_time / total_time) and bytes_copied
+    """
+    with _PROFILE_LOCK:
+        stats = [dict(function=k, **v) for k, v in _PROFILE['stats'].items()]
+        if reset:
+            _PROFILE['stats'] = {}
+    df = pd.DataFrame(stats, columns=PROFILE_COLUMNS)
+    df['total_time'] = df.conversion_time + df.kernel_time
+    df['conversion_fraction'] = df.conversion_time / df.total_time
+    return df.sort_values('total_time', ascending=False, ignore_index=True)
+
+
 #
 # INTERNAL
 #
+def _record_call(
+        func: Callable,
+        conversion_time: float,
+        kernel_time: float,
+        bytes_copied: int) -> None:
+    name = f'{func.__module__}.{func.__qualname__}'
+    with _PROFILE_LOCK:
+        stats = _PROFILE['stats'].setdefault(name, dict(
+            calls=0,
+            conversion_time=0.0,
+            kernel_time=0.0,
+            bytes_copied=0))
+        stats['calls'] += 1
+        stats['conversion_time'] += conversion_time
+        stats['kernel_time'] += kernel_time
+        stats['bytes_copied'] += bytes_copied
+
+
+def _bytes_copied(data: types.NPDXR, values: types.NPD) -> int:
+    """ (estimated) bytes copied by `execute_func`
+
+    the input is deep-copied. for datasets the data_vars are also stacked
+    into an array and the output values copied back into the dataset.
+    """
+    nbytes = int(data.nbytes)
+    if isinstance(data, xr.Dataset):
+        nbytes += 2 * int(values.nbytes)
+    return nbytes
+
+
 def _lists_of(length: int, values: Any) -> list:
     """ lists of (length or object)
 
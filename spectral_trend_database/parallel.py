@@ -0,0 +1,323 @@
+""" process-pool execution with shared-memory inputs
+
+DESCRIPTION:
+    runs a per-sample function over a (large) dataframe with a process pool.
+
+    the columns of the dataframe are copied once into
+    `multiprocessing.shared_memory` buffers (string columns are stored as
+    integer codes). worker processes attach to the buffers when they start, so
+    the full dataframe is never pickled. each sample's rows are copied from the
+    buffers into a (small) dataframe when its group is processed. tasks are
+    small picklable specs: a function reference ('module:function') and a range
+    of sample groups.
+
+    workers are started with 'forkserver' (MP_CONTEXT): forking the parent
+    directly is unsafe while other threads (ie background uploads or the
+    thread pools of the gcs/bigquery clients) may hold locks. forkserver
+    workers import the mapped function, so it must live in an importable
+    module. functions defined in a script (`__main__`) can only be resolved by
+    forked workers and fall back to 'fork' (MAIN_CONTEXT). `interface.map_samples`
+    waits for outstanding uploads before starting the pool.
+
+USAGE:
+    ```python
+    from spectral_trend_database import parallel
+
+    def process(rows, sample_id, year):
+        ...
+        return rows
+
+    results = parallel.map_groups(
+        process,
+        data,
+        key='sample_id',
+        sort_by='date',
+        max_processes=8,
+        year=2010)
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from typing import Any, Callable, Optional, Sequence
+import importlib
+import math
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from spectral_trend_database import utils
+from spectral_trend_database import types
+
+
+#
+# CONSTANTS
+#
+MP_CONTEXT = 'forkserver'
+MAIN_CONTEXT = 'fork'
+MAIN_MODULE = '__main__'
+BATCHES_PER_PROCESS = 4
+CODE_DTYPE = 'int32'
+FUNCTION_REF_SEP = ':'
+
+
+#
+# WORKER STATE
+#
+_WORKER: dict[str, Any] = {}
+
+
+#
+# SHARED DATA
+#
+class SharedFrame(object):
+    """ dataframe columns copied into shared memory
+
+    Usage:
+
+    ```python
+    with SharedFrame(df) as frame:
+        # in another process
+        arrays, handles = attach(frame.spec)
+        rows = frame_slice(frame.spec, arrays, 0, 10)
+    ```
+    """
+    def __init__(self, data: pd.DataFrame, columns: Optional[Sequence[str]] = None) -> None:
+        """
+        Args:
+
+            data (pd.DataFrame): source dataframe
+            columns (Optional[Sequence[str]] = None):
+                columns to share. if None share all columns
+        """
+        self.length = len(data)
+        self.columns: list[dict] = []
+        self._handles: list[shared_memory.SharedMemory] = []
+        try:
+            for name in (columns or list(data.columns)):
+                self._share_column(name, data[name])
+        except Exception as e:
+            self.close()
+            raise e
+
+    @property
+    def spec(self) -> dict:
+        """ picklable description of shared buffers (see `attach`) """
+        return dict(length=self.length, columns=self.columns)
+
+    def close(self) -> None:
+        """ release and remove shared buffers """
+        for handle in self._handles:
+            handle.close()
+            handle.unlink()
+        self._handles = []
+
+    def __enter__(self) -> 'SharedFrame':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _share_column(self, name: str, values: pd.Series) -> None:
+        categories = None
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_dtype(values):
+            arr = values.to_numpy()
+        else:
+            codes, uniques = pd.factorize(values)
+            arr = codes.astype(CODE_DTYPE)
+            categories = np.asarray(uniques, dtype=object)
+        if arr.dtype == object:
+            err = (
+                'spectral_trend_database.parallel.SharedFrame: '
+                f'column ({name}) can not be stored in shared memory.'
+            )
+            raise ValueError(err)
+        handle = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        self._handles.append(handle)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=handle.buf)[:] = arr
+        self.columns.append(dict(
+            name=name,
+            shm_name=handle.name,
+            dtype=arr.dtype.str,
+            categories=categories))
+
+
+def attach(spec: dict) -> tuple[dict[str, np.ndarray], list[shared_memory.SharedMemory]]:
+    """ zero-copy views of shared buffers
+
+    Args:
+
+        spec (dict): `SharedFrame.spec`
+
+    Returns:
+
+        (tuple) dict of column-name, array pairs and the shared-memory handles
+        (which must be kept open while the arrays are used)
+    """
+    arrays = {}
+    handles = []
+    for column in spec['columns']:
+        handle = shared_memory.SharedMemory(name=column['shm_name'])
+        handles.append(handle)
+        arrays[column['name']] = np.ndarray(
+            (spec['length'],),
+            dtype=np.dtype(column['dtype']),
+            buffer=handle.buf)
+    return arrays, handles
+
+
+def frame_slice(spec: dict, arrays: dict[str, np.ndarray], start: int, end: int) -> pd.DataFrame:
+    """ dataframe of rows <start>:<end> of shared buffers
+
+    Args:
+
+        spec (dict): `SharedFrame.spec`
+        arrays (dict[str, np.ndarray]): arrays returned by `attach`
+        start (int): first row (inclusive)
+        end (int): last row (exclusive)
+
+    Returns:
+
+        (pd.DataFrame) rows
+    """
+    data = {}
+    for column in spec['columns']:
+        values = arrays[column['name']][start:end]
+        if column['categories'] is not None:
+            values = column['categories'][values]
+        data[column['name']] = values
+    return pd.DataFrame(data)
+
+
+#
+# MAP
+#
+def map_groups(
+        func: Callable,
+        data: pd.DataFrame,
+        key: str = 'sample_id',
+        sort_by: Optional[types.STRINGS] = 'date',
+        columns: Optional[Sequence[str]] = None,
+        max_processes: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        on_result: Optional[Callable] = None,
+        context: Optional[str] = None,
+        pass_key: bool = False,
+        **kwargs) -> list:
+    """ map function over groups of dataframe with a process pool
+
+    <data> is sorted by <key> (then <sort_by>) and copied into shared memory.
+    for each group `func(rows, **{<key>: value}, **kwargs)` is called in a
+    worker process. exceptions are returned as `{<key>: value, 'error': str}`.
+
+    Args:
+
+        func (Callable): module level function
+        data (pd.DataFrame): source dataframe
+        key (str = 'sample_id'): grouping column
+        sort_by (Optional[types.STRINGS] = 'date'): column(s) to sort by within groups
+        columns (Optional[Sequence[str]] = None):
+            columns passed to <func> (in addition to <key>). if None all columns
+        max_processes (Optional[int] = None): number of processes. if None use cpu-count
+        batch_size (Optional[int] = None):
+            number of groups per task. if None split groups into
+            BATCHES_PER_PROCESS tasks per process
+        on_result (Optional[Callable] = None):
+            called (in the parent process) with each result as it arrives. if
+            passed, its return values are returned in place of the results
+        context (Optional[str] = None):
+            multiprocessing start method. if None use `start_method(func)`
+        pass_key (bool = False):
+            if true <on_result> is called with the result and the group's <key> value
+        **kwargs: passed to <func>
+
+    Returns:
+
+        (list) results (or <on_result> values) in group order
+    """
+    if isinstance(sort_by, str):
+        sort_by = [sort_by]
+    sort_columns = [key] + [col for col in (sort_by or []) if col and (col != key)]
+    data = data.sort_values(sort_columns, kind='stable', ignore_index=True)
+    keys = data[key].to_numpy()
+    starts, ends = utils.group_offsets(keys)
+    keys = keys[starts]
+    nb_groups = len(starts)
+    if not nb_groups:
+        return []
+    if columns is not None:
+        columns = [col for col in columns if col != key]
+    processes = max_processes or mp.cpu_count()
+    if not batch_size:
+        batch_size = max(1, math.ceil(nb_groups / (processes * BATCHES_PER_PROCESS)))
+    tasks = [
+        (function_reference(func), start, min(start + batch_size, nb_groups), key, kwargs)
+        for start in range(0, nb_groups, batch_size)]
+    results: list = []
+    with SharedFrame(data, columns=columns) as frame:
+        ctx = mp.get_context(context or start_method(func))
+        with ctx.Pool(
+                processes,
+                initializer=_init_worker,
+                initargs=(frame.spec, keys, starts, ends)) as pool:
+            for batch_results in pool.imap(_run_batch, tasks):
+                for result in batch_results:
+                    if on_result and pass_key:
+                        result = on_result(result, keys[len(results)])
+                    elif on_result:
+                        result = on_result(result)
+                    results.append(result)
+    return results
+
+
+def start_method(func: Callable) -> str:
+    """ MP_CONTEXT, or MAIN_CONTEXT for functions defined in `__main__` """
+    if func.__module__ == MAIN_MODULE:
+        return MAIN_CONTEXT
+    return MP_CONTEXT
+
+
+def function_reference(func: Callable) -> str:
+    """ picklable 'module:qualified.name' reference for module level function """
+    return f'{func.__module__}{FUNCTION_REF_SEP}{func.__qualname__}'
+
+
+def resolve_function(reference: str) -> Callable:
+    """ function from `function_reference` """
+    module_name, qualname = reference.split(FUNCTION_REF_SEP, maxsplit=1)
+    obj: Any = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+#
+# INTERNAL
+#
+def _init_worker(spec: dict, keys: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> None:
+    arrays, handles = attach(spec)
+    _WORKER.update(
+        spec=spec,
+        arrays=arrays,
+        handles=handles,
+        keys=keys,
+        starts=starts,
+        ends=ends)
+
+
+def _run_batch(task: tuple) -> list:
+    reference, start, end, key, kwargs = task
+    func = resolve_function(reference)
+    results = []
+    for index in range(start, end):
+        value = _WORKER['keys'][index]
+        try:
+            rows = frame_slice(
+                _WORKER['spec'],
+                _WORKER['arrays'],
+                _WORKER['starts'][index],
+                _WORKER['ends'][index])
+            results.append(func(rows, **{key: value}, **kwargs))
+        except Exception as e:
+            results.append({key: value, 'error': str(e)})
+    return results
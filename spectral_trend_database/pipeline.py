@@ -0,0 +1,621 @@
+""" fused per-sample pipeline
+
+DESCRIPTION:
+    computes the outputs of steps 3-6 (raw indices, smoothed indices, index
+    stats and macd features) in a single in-memory pass over the raw landsat
+    data for each growing year.
+
+    the step scripts upload each intermediate table to gcs/bigquery and query
+    it back in the next step. here the raw bands for a growing year are loaded
+    once, spectral indices are added (vectorized over all samples), and for
+    each sample the smoothed series is computed once and used for the stats
+    (one table per season window, see `aggregation.season_windows`) and macd
+    outputs. only the final
+    tables are saved, the raw/smoothed indices tables are optional
+    (see `c.FUSED_INTERMEDIATES`).
+
+    sharded runs (`c.SHARD`) process and save the samples of a shard,
+    `c.MERGE_SHARDS` merges the shard outputs and loads the tables (see `sharding`).
+    with `c.WORK_QUEUE_PATH` any number of workers claim batches of samples from a
+    shared queue and the last worker merges and loads the tables (see `workqueue`).
+
+    the growing year for <year> is [<year-1>-OFF_SEASON_START, <year>-OFF_SEASON_START).
+    smoothing and macd are run over a buffered window so values approximately
+    match those of the step scripts. they are not identical: step-4 smooths each
+    calendar year separately and step-5 computes growing-year stats from two of
+    these calendar-year tables, whereas here a single window spanning the growing
+    year is smoothed. values differ slightly, mostly near the january 1st seam.
+
+USAGE:
+    ```python
+    from spectral_trend_database import pipeline
+
+    # in-memory
+    result = pipeline.process_sample(rows, sample_id='9zmy1', year=2010)
+
+    # as a job (see `runner.JobRunner`)
+    pipeline.run(dict(YEARS=[2008, 2010], FUSED_INTERMEDIATES=['smoothed_indices']))
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Optional, Sequence, Union
+import re
+import warnings
+from datetime import datetime, timedelta
+from pathlib import Path
+import pandas as pd
+from spectral_trend_database import lazy
+from spectral_trend_database.config import config as c
+from spectral_trend_database import aggregation
+from spectral_trend_database import gcp
+from spectral_trend_database import interface
+from spectral_trend_database import paths
+from spectral_trend_database import sharding
+from spectral_trend_database import smoothing
+from spectral_trend_database import spectral
+from spectral_trend_database import types
+from spectral_trend_database import utils
+from spectral_trend_database import workqueue
+from spectral_trend_database.gee import landsat
+if TYPE_CHECKING:
+    import xarray as xr
+else:
+    xr = lazy.lazy_import('xarray')
+
+
+#
+# CONSTANTS
+#
+JOB_NAME = 'fused_pipeline'
+RAW_INDICES = 'raw_indices'
+SMOOTHED_INDICES = 'smoothed_indices'
+INTERMEDIATES = [RAW_INDICES, SMOOTHED_INDICES]
+STATS = 'stats'
+STATS_OFF_SEASON = 'stats_off_season'
+STATS_GROWING_SEASON = 'stats_growing_season'
+MACD = 'macd'
+HEADER_COLS = ['sample_id', 'year', 'date'] + landsat.HARMONIZED_BANDS
+MACD_INDICES = ['ndvi', 'evi', 'evi2']
+MACD_SPANS = [5, 10, 5]
+SMOOTHING_BUFFER = timedelta(days=smoothing.DEFAULT_SG_WINDOW_LENGTH * 2)
+MACD_BUFFER = timedelta(days=20)
+ONE_DAY = timedelta(days=1)
+
+
+#
+# METHODS
+#
+def growing_year(year: int) -> tuple[datetime, datetime]:
+    """ start (inclusive) and end (exclusive) of growing year
+
+    Args:
+
+        year (int): year
+
+    Returns:
+
+        (tuple) (<year-1>-OFF_SEASON_START, <year>-OFF_SEASON_START)
+    """
+    start = datetime.strptime(f'{year-1}-{c.OFF_SEASON_START_YYMM}', c.YYYY_MM_DD_FMT)
+    end = datetime.strptime(f'{year}-{c.OFF_SEASON_START_YYMM}', c.YYYY_MM_DD_FMT)
+    return start, end
+
+
+def data_window(year: int) -> tuple[datetime, datetime]:
+    """ date range of raw data required to process <year>
+
+    covers the growing year, the calendar year (for the smoothed-indices table)
+    and the macd/smoothing buffers
+
+    Args:
+
+        year (int): year
+
+    Returns:
+
+        (tuple) start, end dates (inclusive)
+    """
+    start, end = growing_year(year)
+    jan1 = datetime(year=year, month=1, day=1)
+    dec31 = datetime(year=year, month=12, day=31)
+    start = min(start - MACD_BUFFER, jan1) - SMOOTHING_BUFFER
+    end = max(end + MACD_BUFFER, dec31) + SMOOTHING_BUFFER
+    return start, end
+
+
+def load_raw_data(year: int, columns: Sequence[str] = HEADER_COLS) -> pd.DataFrame:
+    """ load raw landsat (step-2) data for `data_window(<year>)`
+
+    Args:
+
+        year (int): year
+        columns (Sequence[str] = HEADER_COLS): columns to keep
+
+    Returns:
+
+        (pd.DataFrame) raw landsat rows (with datetime dates) in data-window
+    """
+    start, end = data_window(year)
+    ext = gcp.table_format(None)['file_format']
+    frames = []
+    for file_year in range(start.year, end.year + 1):
+        src = paths.gcs(
+            c.RAW_LANDSAT_FOLDER,
+            f'{c.RAW_LANDSAT_FILENAME}-{file_year}',
+            ext=ext)
+        try:
+            df = utils.read_dataframe(src)
+        except FileNotFoundError:
+            print('- src not found (skipping):', src)
+            continue
+        print('- src:', src, df.shape)
+        frames.append(df[list(columns)])
+    if not frames:
+        err = (
+            'spectral_trend_database.pipeline.load_raw_data: '
+            f'no raw landsat data found for year ({year})'
+        )
+        raise ValueError(err)
+    data = pd.concat(frames, ignore_index=True)
+    data[c.DATE_COLUMN] = pd.to_datetime(data[c.DATE_COLUMN])
+    data = data[(data[c.DATE_COLUMN] >= start) & (data[c.DATE_COLUMN] <= end)]
+    return data.reset_index(drop=True)
+
+
+def add_indices(
+        data: pd.DataFrame,
+        indices: Optional[dict[str, str]] = None) -> pd.DataFrame:
+    """ add spectral indices to raw landsat rows (for all samples at once)
+
+    Args:
+
+        data (pd.DataFrame): raw landsat rows
+        indices (Optional[dict[str, str]] = None):
+            spectral-index equations. if None use `spectral.index_config()`
+
+    Returns:
+
+        (pd.DataFrame) <data> with (sorted) index columns appended
+    """
+    if indices is None:
+        indices = spectral.index_config()
+    data = spectral.add_index_arrays(data.reset_index(drop=True), indices=indices)
+    header_cols = [n for n in HEADER_COLS if n in data.columns]
+    data_cols = sorted(n for n in data.columns if n not in HEADER_COLS)
+    return data[header_cols + data_cols]
+
+
+def process_sample(
+        rows: pd.DataFrame,
+        sample_id: str,
+        year: int,
+        data_vars: Optional[Sequence[str]] = None,
+        macd_vars: Sequence[str] = MACD_INDICES,
+        smoothed: bool = False,
+        windows: Optional[Sequence[dict]] = None) -> dict:
+    """ smoothing, stats and macd for a single sample
+
+    the smoothed series is computed once over the (buffered) data window and
+    sliced for each output.
+
+    Args:
+
+        rows (pd.DataFrame): rows (date, bands, indices) for sample. see `add_indices`
+        sample_id (str): sample id
+        year (int): year
+        data_vars (Optional[Sequence[str]] = None):
+            smoothed variables. if None all columns except sample_id, year, date
+        macd_vars (Sequence[str] = MACD_INDICES): variables for macd features
+        smoothed (bool = False): if true include smoothed-indices rows (for calendar <year>)
+        windows (Optional[Sequence[dict]] = None):
+            season windows for stats. if None use `aggregation.season_windows()`
+
+    Returns:
+
+        (dict) with keys sample_id, year, stats (list of stats datasets, one per
+        season window), macd (dataframe) and smoothed (dataframe or None).
+        on failure dict(sample_id, year, warning, error)
+    """
+    try:
+        if data_vars is None:
+            data_vars = [n for n in rows.columns if n not in HEADER_COLS[:3]]
+        data_vars = list(data_vars)
+        rows = rows[[c.DATE_COLUMN] + data_vars]
+        rows = rows[rows.ndvi > 0]
+        ds = rows.set_index(c.DATE_COLUMN).to_xarray()
+        ds = smoothing.savitzky_golay_processor(ds, **c.SG_CONFIG)
+        assert isinstance(ds, xr.Dataset)
+        start, end = growing_year(year)
+        # 1. smoothed indices (optional)
+        smoothed_rows = None
+        if smoothed:
+            smoothed_rows = _dataset_rows(
+                ds.sel(dict(date=slice(c.JAN1_TMPL.format(year), c.DEC31_TMPL.format(year)))),
+                sample_id=sample_id,
+                year=year)
+        # 2. stats
+        with warnings.catch_warnings():
+            warnings.filterwarnings('error')
+            try:
+                stats = [
+                    utils.xr_stats(
+                        ds.sel(dict(date=slice(*aggregation.window_dates(window, year)))),
+                        data_vars=data_vars,
+                        quantiles=c.STATS_QUANTILES)
+                    for window in aggregation.season_windows(windows)]
+            except Warning as w:
+                return dict(sample_id=sample_id, year=year, warning=str(w), error=None)
+        # 3. macd
+        ds_macd = ds[list(macd_vars)].sel(dict(date=slice(
+            start - MACD_BUFFER,
+            end + MACD_BUFFER - ONE_DAY)))
+        macd = smoothing.macd_processor(ds_macd, spans=MACD_SPANS)
+        assert isinstance(macd, xr.Dataset)
+        ds_macd = macd.sel(date=slice(start, end))
+        return dict(
+            sample_id=sample_id,
+            year=year,
+            stats=stats,
+            macd=_dataset_rows(ds_macd, sample_id=sample_id, year=year),
+            smoothed=smoothed_rows)
+    except Exception as e:
+        return dict(sample_id=sample_id, year=year, warning=None, error=str(e))
+
+
+def stats_row(
+        sample_id: str,
+        year: int,
+        ds: xr.Dataset,
+        replace_na: bool = False) -> dict:
+    """ stats dataset to (single) output row
+
+    Args:
+
+        sample_id (str): sample id
+        year (int): year
+        ds (xr.Dataset): stats dataset (see `utils.xr_stats`)
+        replace_na (bool = False): if true replace NaNs with "safe" values (for json)
+
+    Returns:
+
+        (dict) row
+    """
+    row = dict(sample_id=sample_id, year=year)
+    for name in ds.data_vars:
+        values = ds.data_vars[name].values
+        if replace_na:
+            row[str(name)] = utils.nan_to_safe_nan(values)
+        else:
+            row[str(name)] = values
+    return row
+
+
+def write_outputs(result: dict, sinks: dict[str, Any]) -> Union[dict, None]:
+    """ write `process_sample` outputs to sinks or return error
+
+    Args:
+
+        result (dict): `process_sample` result
+        sinks (dict[str, Any]):
+            output-name, sink pairs for `stats_outputs()`, MACD and (optionally)
+            SMOOTHED_INDICES. sinks must have a `write` method
+            (ie `utils.ShardedTableSink`)
+
+    Returns:
+
+        None on success, otherwise <result> (the error dict)
+    """
+    stats = result.pop('stats', None)
+    if stats is None:
+        return result
+    for name, ds in zip(stats_outputs(), stats):
+        sink = sinks[name]
+        replace_na = getattr(sink, 'file_format', None) == utils.JSON_FORMAT
+        sink.write(stats_row(result['sample_id'], result['year'], ds, replace_na=replace_na))
+    sinks[MACD].write(result['macd'])
+    if (result.get('smoothed') is not None) and (SMOOTHED_INDICES in sinks):
+        sinks[SMOOTHED_INDICES].write(result['smoothed'])
+    return None
+
+
+def process_year(
+        data: pd.DataFrame,
+        year: int,
+        sinks: dict[str, Any],
+        method: Optional[types.MAP_METHOD] = None,
+        max_processes: Optional[int] = None) -> list:
+    """ run fused pipeline for all samples in <data>
+
+    Args:
+
+        data (pd.DataFrame): rows with bands and indices (see `add_indices`)
+        year (int): year
+        sinks (dict[str, Any]): output-name, sink pairs (see `write_outputs`)
+        method (Optional[types.MAP_METHOD] = None):
+            map method (see `interface.map_samples`). if None use c.DEFAULT_MAP_METHOD
+        max_processes (Optional[int] = None):
+            max number of threads/processes. if None use `c.MAX_PROCESSES` (if set)
+
+    Returns:
+
+        (list) errors (None for successful samples)
+    """
+    data_vars = [n for n in data.columns if n not in HEADER_COLS[:3]]
+    return interface.map_samples(
+        process_sample,
+        data,
+        method=method or c.DEFAULT_MAP_METHOD,
+        max_processes=max_processes,
+        columns=[c.DATE_COLUMN] + data_vars,
+        on_result=lambda result: write_outputs(result, sinks),
+        year=year,
+        data_vars=data_vars,
+        smoothed=SMOOTHED_INDICES in sinks)
+
+
+def process_queued_year(
+        queue: workqueue.WorkQueue,
+        data: pd.DataFrame,
+        year: int,
+        outputs: dict[str, tuple[str, str, str]],
+        names: Sequence[str],
+        batch_size: Optional[int] = None) -> list:
+    """ run fused pipeline for <year> as one of the workers draining <queue>
+
+    the samples of <data> are added to the queue. batches of samples are then
+    claimed and processed until the queue is drained. each batch is written to
+    its own part files (see `workqueue.WorkQueue.part_path`). the worker that
+    claims finalisation merges the parts of all workers and uploads/loads the
+    tables.
+
+    Args:
+
+        queue (workqueue.WorkQueue): work queue
+        data (pd.DataFrame): rows with bands and indices (see `add_indices`)
+        year (int): year
+        outputs (dict[str, tuple[str, str, str]]): see `output_paths`
+        names (Sequence[str]): outputs to write (may include RAW_INDICES)
+        batch_size (Optional[int] = None):
+            samples per batch. if None use `c.WORK_QUEUE_BATCH_SIZE`
+
+    Returns:
+
+        (list) errors of the samples processed by this worker
+    """
+    step = JOB_NAME
+    print('- work queue:', queue.path, f'[{queue.worker}]')
+    data = interface.limit_samples(data, limit=c.LIMIT)
+    queue.add(step, year, data.sample_id.astype(str).unique())
+    errors: list = []
+    for sample_ids in queue.batches(step, year, batch_size=batch_size):
+        try:
+            batch = data[data.sample_id.astype(str).isin(sample_ids)]
+            dests = {
+                name: queue.part_path(step, year, outputs[name][1])
+                for name in names}
+            sinks = {
+                name: interface.output_sink(
+                    dests[name],
+                    outputs[name][0],
+                    dry_run=c.DRY_RUN,
+                    noisy=False)
+                for name in names if name != RAW_INDICES}
+            parts: dict[str, Optional[str]] = {}
+            if RAW_INDICES in names:
+                parts[RAW_INDICES] = utils.save_dataframe(
+                    _calendar_year(batch, year),
+                    dest=dests[RAW_INDICES],
+                    dry_run=c.DRY_RUN,
+                    noisy=False,
+                    **gcp.table_format(outputs[RAW_INDICES][0]))
+            batch_errors = process_year(batch, year, sinks)
+            for name, sink in sinks.items():
+                parts[name] = sink.close()
+        except Exception as e:
+            queue.fail(step, year, sample_ids, error=str(e))
+            print(f'- batch failed ({len(sample_ids)} samples):', e)
+            continue
+        if queue.complete(step, year, sample_ids, outputs=parts):
+            errors += batch_errors
+        else:
+            for part in parts.values():
+                if part:
+                    Path(part).unlink(missing_ok=True)
+    interface.print_errors(errors)
+    if queue.claim_finalize(step, year):
+        print('- work queue: finalize', queue.counts(step, year))
+        failed = queue.failed(step, year)
+        if failed:
+            print(f'- failed samples ({len(failed)}):', list(failed)[:10])
+        part_files = queue.outputs(step, year)
+        for name in names:
+            table_name, local_dest, gcs_dest = outputs[name]
+            if part_files.get(name):
+                Path(local_dest).parent.mkdir(parents=True, exist_ok=True)
+                utils.merge_table_files(part_files[name], local_dest)
+                interface.save_to_gcp(
+                    src=local_dest,
+                    gcs_dest=gcs_dest,
+                    dataset_name=c.DATASET_NAME,
+                    table_name=table_name,
+                    remove_src=True,
+                    dry_run=c.DRY_RUN,
+                    asynchronous=True)
+        queue.remove_outputs(step, year)
+    return errors
+
+
+def stats_outputs() -> list[str]:
+    """ output names of the season-window stats tables
+
+    STATS for the unsuffixed (growing year) table, otherwise `stats_<window-name>`
+    (ie STATS_OFF_SEASON, STATS_GROWING_SEASON for the default windows)
+    """
+    return [
+        f'{STATS}_{window["name"]}' if window['table_suffix'] else STATS
+        for window in aggregation.season_windows()]
+
+
+def output_paths(year: int) -> dict[str, tuple[str, str, str]]:
+    """ table names and local/gcs destinations of the step 3-6 tables for <year>
+
+    Args:
+
+        year (int): year
+
+    Returns:
+
+        (dict) output-name, (table_name, local_dest, gcs_dest) pairs
+    """
+    outputs = dict()
+    outputs[RAW_INDICES] = interface.table_name_and_paths(
+        c.RAW_INDICES_FOLDER,
+        table_name=c.RAW_INDICES_TABLE_NAME,
+        year=year)
+    outputs[SMOOTHED_INDICES] = interface.table_name_and_paths(
+        c.SMOOTHED_INDICES_FOLDER,
+        table_name=c.SMOOTHED_INDICES_TABLE_NAME,
+        year=year)
+    growing_year_ident = _period_ident(c.OFF_SEASON_START_YYMM, c.OFF_SEASON_START_YYMM)
+    table_name, local_dest, gcs_dest = interface.table_name_and_paths(
+        c.INDICES_STATS_FOLDER,
+        growing_year_ident,
+        table_name=c.INDICES_STATS_TABLE_NAME,
+        year=year)
+    for name, window in zip(stats_outputs(), aggregation.season_windows()):
+        ident = aggregation.window_ident(window)
+        outputs[name] = (
+            aggregation.window_table_name(table_name, window),
+            re.sub(growing_year_ident, ident, local_dest),
+            re.sub(growing_year_ident, ident, gcs_dest))
+    outputs[MACD] = interface.table_name_and_paths(
+        c.MACD_FOLDER,
+        table_name=c.MACD_TABLE_NAME,
+        year=year)
+    return outputs
+
+
+#
+# JOB
+#
+def run(config: dict = {}) -> None:
+    """ run fused pipeline for `c.YEARS`
+
+    Args:
+
+        config (dict = {}): config updates (see `runner.JobRunner`)
+    """
+    c.update(config)
+    intermediates = _intermediates(c.FUSED_INTERMEDIATES)
+    indices = spectral.index_config()
+    print('\nfused pipeline:')
+    print('- intermediates:', intermediates)
+    print('-' * 50)
+    for year in range(c.YEARS[0], c.YEARS[1] + 1):
+        print(f'\n- year: {year}')
+        # 1. paths/sinks
+        outputs = output_paths(year)
+        names = stats_outputs() + [MACD] + [n for n in intermediates if n != RAW_INDICES]
+        if sharding.merging():
+            for name in names + ([RAW_INDICES] if RAW_INDICES in intermediates else []):
+                table_name, local_dest, gcs_dest = outputs[name]
+                interface.merge_shards(
+                    local_dest,
+                    gcs_dest,
+                    dataset_name=c.DATASET_NAME,
+                    table_name=table_name,
+                    dry_run=c.DRY_RUN,
+                    asynchronous=True)
+            continue
+
+        # 2. load data and add indices
+        data = add_indices(sharding.select_shard(load_raw_data(year)), indices=indices)
+        print('- data shape:', data.shape)
+        if c.WORK_QUEUE_PATH:
+            process_queued_year(
+                workqueue.WorkQueue(),
+                data,
+                year,
+                outputs,
+                names + ([RAW_INDICES] if RAW_INDICES in intermediates else []))
+            continue
+        sinks = {
+            name: interface.output_sink(outputs[name][1], outputs[name][0], dry_run=c.DRY_RUN)
+            for name in names}
+        if RAW_INDICES in intermediates:
+            raw_table_name, raw_local_dest, raw_gcs_dest = outputs[RAW_INDICES]
+            utils.save_dataframe(
+                _calendar_year(data, year),
+                dest=raw_local_dest,
+                dry_run=c.DRY_RUN,
+                **gcp.table_format(raw_table_name))
+            interface.save_to_gcp(
+                src=raw_local_dest,
+                gcs_dest=raw_gcs_dest,
+                dataset_name=c.DATASET_NAME,
+                table_name=raw_table_name,
+                remove_src=True,
+                dry_run=c.DRY_RUN,
+                asynchronous=True)
+
+        # 3. run
+        errors = process_year(data, year, sinks)
+        for sink in sinks.values():
+            sink.close()
+
+        # 4. report on errors
+        interface.print_errors(errors)
+
+        # 5. save data (gcs, bq)
+        for name in names:
+            table_name, local_dest, gcs_dest = outputs[name]
+            interface.save_to_gcp(
+                src=local_dest,
+                gcs_dest=gcs_dest,
+                dataset_name=c.DATASET_NAME,
+                table_name=table_name,
+                remove_src=True,
+                dry_run=c.DRY_RUN,
+                asynchronous=True)
+
+    # wait for outstanding (asynchronous) uploads/table-loads
+    interface.wait_for_saves()
+
+
+#
+# INTERNAL
+#
+def _dataset_rows(ds: xr.Dataset, sample_id: str, year: int) -> pd.DataFrame:
+    rows = ds.to_dataframe().reset_index(drop=False)
+    rows.insert(0, 'year', year)
+    rows.insert(0, 'sample_id', sample_id)
+    return rows
+
+
+def _calendar_year(data: pd.DataFrame, year: int) -> pd.DataFrame:
+    jan1, dec31 = c.JAN1_TMPL.format(year), c.DEC31_TMPL.format(year)
+    return data[data.date.between(jan1, dec31)]
+
+
+def _period_ident(start_mmdd: str, end_mmdd: str) -> str:
+    return re.sub('-', '', '_'.join([start_mmdd, end_mmdd]))
+
+
+def _intermediates(value: Union[bool, str, Sequence[str], None]) -> list[str]:
+    if value is True:
+        return list(INTERMEDIATES)
+    elif not value:
+        return []
+    elif isinstance(value, str):
+        value = [value]
+    invalid = [v for v in value if v not in INTERMEDIATES]
+    if invalid:
+        err = (
+            'spectral_trend_database.pipeline.run: '
+            f'invalid FUSED_INTERMEDIATES ({invalid}) must be in {INTERMEDIATES}.'
+        )
+        raise ValueError(err)
+    return list(value)
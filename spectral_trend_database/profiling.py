@@ -0,0 +1,555 @@
+""" job/stage profiling
+
+DESCRIPTION:
+    records wall time, cpu time, peak rss, items processed and throughput for
+    jobs (see `runner.JobRunner`) and named stages inside jobs.
+
+    stages are recorded with the `stage` context manager. the library records
+    the main stages of the pipeline:
+
+        - query: `query.run` (items: rows)
+        - compute: `interface.map_samples` (items: samples)
+        - write: `utils.save_dataframe`, `utils.merge_table_files` (items: rows/files)
+        - upload: `interface.save_to_gcp` gcs upload (items: bytes)
+        - load: `interface.save_to_gcp` bigquery table load (items: tables)
+
+    stage records are collected per process. `profile_job` runs a job and
+    returns a record with the job totals and the stages aggregated by name.
+    stages may overlap (ie background uploads run while the next year is
+    computed) so stage times need not sum to the job time.
+
+    cpu time is the process cpu time (all threads) and peak rss is the
+    high-water mark of the process at the end of the stage/job.
+
+USAGE:
+    ```python
+    from spectral_trend_database import profiling
+
+    with profiling.stage('compute', unit='samples') as stage:
+        results = process(data)
+        stage.items = len(results)
+
+    result, record = profiling.profile_job('my-job', run, config)
+    profiling.print_summary([record])
+    profiling.save_report([record], 'profiles/report.json')
+    ```
+
+    code profilers (see `stdb profile`): `run_cprofile` runs a function
+    under cProfile (saved as a pstats file), `SamplingProfiler` samples the
+    python stacks of all threads at a fixed interval (saved in speedscope's
+    json format). `hot_functions` tabulates the hottest functions of either
+    grouped by `spectral_trend_database` module.
+
+    ```python
+    result, stats = profiling.run_cprofile(run, config, dest='profiles/run.pstats')
+    with profiling.SamplingProfiler(interval=0.005) as sampler:
+        run(config)
+    sampler.save_speedscope('profiles/run.speedscope.json')
+    print(profiling.hot_functions(stats))
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from typing import Any, Callable, Iterator, Optional, Sequence, Union
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from types import FrameType
+import pandas as pd
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None  # type: ignore[assignment]
+
+
+#
+# CONSTANTS
+#
+QUERY = 'query'
+COMPUTE = 'compute'
+WRITE = 'write'
+UPLOAD = 'upload'
+LOAD = 'load'
+BYTES_PER_MB = 2 ** 20
+# ru_maxrss is in bytes on macos and kilobytes on linux
+RSS_UNIT = 1 if sys.platform == 'darwin' else 2 ** 10
+SUMMARY_COLUMNS = [
+    'job',
+    'stage',
+    'calls',
+    'wall',
+    'cpu',
+    'peak_rss_mb',
+    'items',
+    'unit',
+    'throughput']
+CPROFILE = 'cprofile'
+SAMPLING = 'sampling'
+DEFAULT_SAMPLING_INTERVAL = 0.005
+ROOT_MODULE = 'spectral_trend_database'
+PACKAGE_DIR = Path(__file__).resolve().parent
+EXTERNAL_MODULE = '(external)'
+HOT_FUNCTION_COLUMNS = ['module', 'function', 'calls', 'self_time', 'total_time']
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+
+
+#
+# STATE
+#
+_LOCK = threading.Lock()
+_STAGES: list[dict] = []
+
+
+#
+# STAGES
+#
+class Stage(object):
+    """ measurements for a single stage (see `stage`) """
+    def __init__(self, name: str, items: Optional[int] = None, unit: Optional[str] = None) -> None:
+        self.name = name
+        self.items = items
+        self.unit = unit
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self.wall: Optional[float] = None
+        self.cpu: Optional[float] = None
+
+    def add(self, items: int) -> None:
+        """ increment number of items processed """
+        self.items = (self.items or 0) + items
+
+    def stop(self) -> dict:
+        """ stop timers and return record """
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        return dict(
+            name=self.name,
+            wall=self.wall,
+            cpu=self.cpu,
+            peak_rss_mb=peak_rss_mb(),
+            items=self.items,
+            unit=self.unit)
+
+
+@contextmanager
+def stage(name: str, items: Optional[int] = None, unit: Optional[str] = None) -> Iterator[Stage]:
+    """ record wall/cpu time, peak rss and items for a named stage
+
+    Args:
+
+        name (str): stage name (ie QUERY, COMPUTE, WRITE, UPLOAD, LOAD)
+        items (Optional[int] = None):
+            number of items processed. may be set (or incremented with `add`)
+            on the yielded `Stage`
+        unit (Optional[str] = None): name of item unit (ie 'rows')
+
+    Yields:
+
+        (Stage) stage
+    """
+    record = Stage(name, items=items, unit=unit)
+    try:
+        yield record
+    finally:
+        data = record.stop()
+        with _LOCK:
+            _STAGES.append(data)
+
+
+def collect(reset: bool = True) -> list[dict]:
+    """ stage records of the current process
+
+    Args:
+
+        reset (bool = True): if true clear records
+
+    Returns:
+
+        (list[dict]) stage records in order of completion
+    """
+    with _LOCK:
+        records = list(_STAGES)
+        if reset:
+            _STAGES.clear()
+    return records
+
+
+def aggregate_stages(records: Sequence[dict]) -> list[dict]:
+    """ aggregate stage records by name
+
+    Args:
+
+        records (Sequence[dict]): stage records (see `collect`)
+
+    Returns:
+
+        (list[dict]) one record per stage name (in order of first completion) with
+        summed wall, cpu and items, max peak_rss_mb, number of calls and throughput
+    """
+    stages: dict[str, dict] = {}
+    for record in records:
+        agg = stages.setdefault(record['name'], dict(
+            name=record['name'],
+            calls=0,
+            wall=0.0,
+            cpu=0.0,
+            peak_rss_mb=0.0,
+            items=None,
+            unit=record.get('unit')))
+        agg['calls'] += 1
+        agg['wall'] += record['wall']
+        agg['cpu'] += record['cpu']
+        agg['peak_rss_mb'] = max(agg['peak_rss_mb'], record['peak_rss_mb'] or 0)
+        if record.get('items') is not None:
+            agg['items'] = (agg['items'] or 0) + record['items']
+    for agg in stages.values():
+        agg['throughput'] = throughput(agg['items'], agg['wall'])
+    return list(stages.values())
+
+
+#
+# JOBS
+#
+def profile_job(name: str, func: Callable, *args, **kwargs) -> tuple[Any, dict]:
+    """ run function and record job totals and stages
+
+    Args:
+
+        name (str): job name
+        func (Callable): job function
+        *args, **kwargs: passed to <func>
+
+    Returns:
+
+        (tuple) <func> result, job record
+    """
+    collect(reset=True)
+    start = datetime.now()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = func(*args, **kwargs)
+    record = dict(
+        name=name,
+        start=start.isoformat(timespec='seconds'),
+        wall=time.perf_counter() - wall,
+        cpu=time.process_time() - cpu,
+        peak_rss_mb=peak_rss_mb(),
+        stages=aggregate_stages(collect(reset=True)))
+    return result, record
+
+
+def summary(jobs: Sequence[dict]) -> pd.DataFrame:
+    """ summary table of job records (one row per job and per job-stage)
+
+    Args:
+
+        jobs (Sequence[dict]): job records (see `profile_job`)
+
+    Returns:
+
+        (pd.DataFrame) summary table
+    """
+    rows = []
+    for job in jobs:
+        rows.append(dict(
+            job=job['name'],
+            stage='-',
+            calls=1,
+            wall=job['wall'],
+            cpu=job['cpu'],
+            peak_rss_mb=job['peak_rss_mb']))
+        for stage_record in job.get('stages', []):
+            rows.append(dict(job=job['name'], stage=stage_record['name'], **{
+                k: stage_record.get(k) for k in SUMMARY_COLUMNS[2:]}))
+    df = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+    df['items'] = df['items'].astype('Int64')
+    return df
+
+
+def print_summary(jobs: Sequence[dict]) -> None:
+    """ print summary table of job records """
+    df = summary(jobs)
+    if not df.empty:
+        df = df.round(2).astype(object).where(df.notna(), '')
+        print(df.to_string(index=False))
+
+
+def save_report(jobs: Sequence[dict], dest: str, **metadata) -> str:
+    """ save json report of job records
+
+    Args:
+
+        jobs (Sequence[dict]): job records (see `profile_job`)
+        dest (str): local destination
+        **metadata: additional top-level report values
+
+    Returns:
+
+        (str) <dest>
+    """
+    Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    report = dict(**metadata, jobs=list(jobs))
+    with open(dest, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    return dest
+
+
+#
+# CODE PROFILERS
+#
+def run_cprofile(
+        func: Callable,
+        *args,
+        dest: Optional[str] = None,
+        **kwargs) -> tuple[Any, pstats.Stats]:
+    """ run function under cProfile
+
+    Args:
+
+        func (Callable): function
+        *args, **kwargs: passed to <func>
+        dest (Optional[str] = None): if passed save stats (pstats format) to <dest>
+
+    Returns:
+
+        (tuple) <func> result, pstats.Stats
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        profiler.disable()
+    stats = pstats.Stats(profiler)
+    if dest:
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        stats.dump_stats(dest)
+    return result, stats
+
+
+class SamplingProfiler(object):
+    """ sampling profiler for python stacks of all threads
+
+    a background thread records the stack of every (other) thread each
+    <interval> seconds. overhead is independent of the number of function
+    calls, so unlike cProfile it does not distort numpy/xarray heavy code.
+
+    Usage:
+
+    ```python
+    with SamplingProfiler() as sampler:
+        run()
+    sampler.save_speedscope('run.speedscope.json')
+    ```
+    """
+    def __init__(self, interval: float = DEFAULT_SAMPLING_INTERVAL) -> None:
+        """
+        Args:
+
+            interval (float = DEFAULT_SAMPLING_INTERVAL): seconds between samples
+        """
+        self.interval = interval
+        self.frames: list[tuple[str, str, int]] = []
+        self.samples: dict[int, list[tuple[list[int], float]]] = {}
+        self.duration = 0.0
+        self._frame_index: dict[tuple[str, str, int], int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """ start sampling """
+        self._stop.clear()
+        self._start = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample, name='stdb-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """ stop sampling """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self._start
+
+    def speedscope(self, name: str = ROOT_MODULE) -> dict:
+        """ samples in speedscope's file format (one profile per thread) """
+        profiles = []
+        for thread_id, samples in self.samples.items():
+            profiles.append(dict(
+                type='sampled',
+                name=f'thread {thread_id}',
+                unit='seconds',
+                startValue=0,
+                endValue=sum(w for _, w in samples),
+                samples=[stack for stack, _ in samples],
+                weights=[w for _, w in samples]))
+        return {
+            '$schema': SPEEDSCOPE_SCHEMA,
+            'name': name,
+            'exporter': ROOT_MODULE,
+            'activeProfileIndex': 0,
+            'shared': dict(frames=[
+                dict(name=func, file=file, line=line)
+                for file, func, line in self.frames]),
+            'profiles': profiles}
+
+    def save_speedscope(self, dest: str, name: str = ROOT_MODULE) -> str:
+        """ save samples as speedscope json
+
+        Args:
+
+            dest (str): local destination
+            name (str = ROOT_MODULE): profile name
+
+        Returns:
+
+            (str) <dest>
+        """
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        with open(dest, 'w') as file:
+            json.dump(self.speedscope(name=name), file)
+        return dest
+
+    def __enter__(self) -> 'SamplingProfiler':
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            weight, last = now - last, now
+            for thread_id, current in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                frame: Optional[FrameType] = current
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(self._index((code.co_filename, code.co_name, code.co_firstlineno)))
+                    frame = frame.f_back
+                self.samples.setdefault(thread_id, []).append((stack[::-1], weight))
+
+    def _index(self, key: tuple[str, str, int]) -> int:
+        index = self._frame_index.get(key)
+        if index is None:
+            index = len(self.frames)
+            self._frame_index[key] = index
+            self.frames.append(key)
+        return index
+
+
+def hot_functions(
+        profile: Union[pstats.Stats, SamplingProfiler],
+        limit: int = 20,
+        external: bool = False,
+        sort_by: str = 'self_time') -> pd.DataFrame:
+    """ hottest functions grouped by `spectral_trend_database` module
+
+    Args:
+
+        profile (Union[pstats.Stats, SamplingProfiler]): cProfile stats or sampler
+        limit (int = 20): max number of functions
+        external (bool = False):
+            if true include functions outside of `spectral_trend_database` (module
+            EXTERNAL_MODULE). otherwise only package functions are listed
+        sort_by (str = 'self_time'): 'self_time' or 'total_time' (inclusive)
+
+    Returns:
+
+        (pd.DataFrame) module, function, calls (<NA> for samples), self_time and
+        total_time (seconds, summed over threads for samples). modules are ordered
+        by the sum of <sort_by> of their functions and functions by <sort_by>
+    """
+    if isinstance(profile, SamplingProfiler):
+        rows = _sampled_functions(profile)
+    else:
+        stats = profile.stats  # type: ignore[attr-defined]
+        rows = [
+            dict(
+                module=module_name(file),
+                function=f'{func}:{line}',
+                calls=nc,
+                self_time=tt,
+                total_time=ct)
+            for (file, line, func), (cc, nc, tt, ct, _) in stats.items()]
+    if sort_by not in ['self_time', 'total_time']:
+        err = (
+            'spectral_trend_database.profiling.hot_functions: '
+            f'sort_by ({sort_by}) must be one of [self_time, total_time]'
+        )
+        raise ValueError(err)
+    df = pd.DataFrame(rows, columns=HOT_FUNCTION_COLUMNS).astype({'calls': 'Int64'})
+    if not external:
+        df = df[df.module != EXTERNAL_MODULE]
+    df = df.sort_values(sort_by, ascending=False).head(limit)
+    module_time = df.groupby('module')[sort_by].transform('sum')
+    df = df.assign(_module_time=module_time).sort_values(
+        ['_module_time', 'module', sort_by],
+        ascending=[False, True, False])
+    return df.drop(columns='_module_time').reset_index(drop=True)
+
+
+def module_name(path: str) -> str:
+    """ `spectral_trend_database` module name for file path (or EXTERNAL_MODULE) """
+    try:
+        relative = Path(path).resolve().relative_to(PACKAGE_DIR)
+    except (ValueError, OSError):
+        return EXTERNAL_MODULE
+    parts = list(relative.with_suffix('').parts)
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join([ROOT_MODULE] + parts)
+
+
+#
+# MEASUREMENTS
+#
+def peak_rss_mb() -> Optional[float]:
+    """ peak resident set size of the current process in MB (None if unavailable) """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / BYTES_PER_MB
+
+
+def throughput(items: Optional[int], wall: Optional[float]) -> Optional[float]:
+    """ items per second """
+    if items is None or not wall:
+        return None
+    return items / wall
+
+
+#
+# INTERNAL
+#
+def _sampled_functions(sampler: SamplingProfiler) -> list[dict]:
+    self_time: defaultdict[int, float] = defaultdict(float)
+    total_time: defaultdict[int, float] = defaultdict(float)
+    for samples in sampler.samples.values():
+        for stack, weight in samples:
+            if stack:
+                self_time[stack[-1]] += weight
+            for index in set(stack):
+                total_time[index] += weight
+    rows = []
+    for index, total in total_time.items():
+        file, func, line = sampler.frames[index]
+        rows.append(dict(
+            module=module_name(file),
+            function=f'{func}:{line}',
+            calls=None,
+            self_time=self_time.get(index, 0.0),
+            total_time=total))
+    return rows
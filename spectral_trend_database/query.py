@@ -3,14 +3,25 @@
 License:
     BSD, see LICENSE.md
 """
-from typing import Optional, Union, Any, Sequence, TypeAlias, Literal
+from __future__ import annotations
+from typing import TYPE_CHECKING, Optional, Union, Any, Callable, Sequence, TypeAlias, Literal
+from typing import Iterator
 import re
 from copy import deepcopy
+from datetime import date, datetime
+import numpy as np
 import pandas as pd
-from google.cloud import bigquery as bq
+from spectral_trend_database import lazy
 from spectral_trend_database.config import config as c
 from spectral_trend_database import utils
+from spectral_trend_database import clients
+from spectral_trend_database import gcp
+from spectral_trend_database import profiling
 from spectral_trend_database import types
+if TYPE_CHECKING:
+    from google.cloud import bigquery as bq
+else:
+    bq = lazy.lazy_import('google.cloud.bigquery')
 
 
 #
@@ -19,6 +30,8 @@ from spectral_trend_database import types
 OPERATOR_SUFFIX: str = 'op'
 DEFAULT_OPERATOR: str = '='
 TABLE_KEYS: list[str] = ['table', 'join_table']
+DATE_PARAMETER_REGEX: str = r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$'
+STRING_PARAMETER_TYPE: str = 'STRING'
 
 
 #
@@ -192,7 +205,9 @@ class QueryConstructor(object):
             how: types.JOINS = 'LEFT',
             on: Optional[types.STRINGS] = None,
             using: Optional[types.STRINGS] = None,
-            uppercase_table: bool = True) -> None:
+            uppercase_table: bool = True,
+            parameterize: bool = False,
+            partitions: Optional[Union[dict[str, dict], Literal[False]]] = None) -> None:
         """
         Args:
 
@@ -215,8 +230,27 @@ class QueryConstructor(object):
             uppercase_table (bool = True):
                 if true apply `.upper()` to <table>. Note only used if <table>
                 is non-null.
+            parameterize (bool = False):
+                if true `where`/`where_in` values are replaced by named query
+                parameters (ie `WHERE year = @year_0`). the sql statement is then
+                independent of the values which are returned by `.parameters()`
+                and should be passed to `run(..., parameters=qc.parameters())`.
+            partitions (Optional[Union[dict[str, dict], Literal[False]]] = None):
+                table-name, partition-spec pairs (see `gcp.table_partitioning`).
+                if None use partition specs from `c.TABLE_PARTITIONS`. if False
+                do not add partition filters.
+
+                partition filters: if the spec of <table> contains a `date_field`
+                (integer-range partitions) or `year_field` (time partitions), where
+                statements on that field are converted to where statements on the
+                partition field. ie for `{field: year, start: ..., date_field: date}`
+
+                    WHERE date >= "2010-12-01" AND date < "2012-01-01"
+                    => ... AND year >= 2010 AND year <= 2011
         """
         self.reset()
+        self._parameterize = parameterize
+        self._partitions = partitions
         self._default_how = how
         self._default_on = self._as_list(on)
         self._default_using = self._as_list(using)
@@ -234,6 +268,8 @@ class QueryConstructor(object):
         self._order_cols: list = []
         self._append_list: list = []
         self._limit: Optional[int] = None
+        self._parameters: dict[str, Any] = {}
+        self._partition_parameters: dict[str, Any] = {}
 
     def select(self, *columns: str, table: Optional[str] = None, **columns_as) -> None:
         """ add select columns
@@ -293,7 +329,10 @@ class QueryConstructor(object):
         join_element = self._join_element(table, join_table, how, using, on)
         self._join_list.append(join_element)
 
-    def where(self, table: Optional[str] = None, **kwargs: Union[str, int, float]) -> None:
+    def where(
+            self,
+            table: Optional[str] = None,
+            **kwargs: Union[str, int, float, Sequence]) -> None:
         """ add where statement
 
         Sets where statement through key value pairs.
@@ -325,12 +364,8 @@ class QueryConstructor(object):
             (k, v) for k, v in kwargs.items()
             if not re.search(f'_{OPERATOR_SUFFIX}$', k)]
         for k, v in keys_values:
-            op = kwargs.get(f'{k}_{OPERATOR_SUFFIX}', DEFAULT_OPERATOR)
-            self._where_list.append({
-                'key': k,
-                'table': table,
-                'value': self._sql_query_value(v, op=op),
-                'operator': op})
+            op = str(kwargs.get(f'{k}_{OPERATOR_SUFFIX}', DEFAULT_OPERATOR))
+            self._add_where(table, k, v, op=op)
 
     def where_in(self,
             table: Optional[str] = None,
@@ -354,17 +389,23 @@ class QueryConstructor(object):
                     * if quote_escape=False it gives
 
                         WHERE year IN (2002, 2004, 2006)
+
+                    * if parameterize=True (see __init__) the values are passed as
+                      a single array parameter (<quote_escape> is ignored)
+
+                        WHERE year IN UNNEST(@year_0)
         """
+        table = self._table_name(table)
         for key, values in kwargs.items():
+            if self._parameterize:
+                self._add_where(table, key, list(values), op='IN')
+                continue
             if quote_escape:
                 values = [f"'{v}'" for v in values]
             else:
                 values = [str(v) for v in values]
             values_str = f'({", ".join(values)})'
-            self.where(**{
-                'table': table,
-                key: values_str,
-                f'{key}_op': 'IN'})
+            self._add_where(table, key, values_str, op='IN')
 
     def orderby(self, *columns: str, table: Optional[str] = None, asc: bool = True) -> None:
         """ order by columns
@@ -421,6 +462,18 @@ class QueryConstructor(object):
             self._sql = self._construct_sql()
         return self._sql
 
+    def parameters(self) -> dict[str, Any]:
+        """ get query parameters
+
+        Note: empty unless initialized with `parameterize=True`
+
+        Returns:
+
+            (dict) parameter-name, value pairs for sql statement
+        """
+        self.sql()
+        return {**self._parameters, **self._partition_parameters}
+
     #
     # INTERNAL (STATIC & CLASS)
     #
@@ -480,8 +533,9 @@ class QueryConstructor(object):
         if self._join_list:
             self._join = ' '.join(self._join_list)
             sql_statement += ' ' + self._join
-        if self._where_list:
-            where_statements = [self._process_where(**kw) for kw in self._where_list]
+        where_list = self._where_list + self._partition_filters()
+        if where_list:
+            where_statements = [self._process_where(**kw) for kw in where_list]
             self._where = ' AND '.join(where_statements)
             sql_statement += ' WHERE ' + self._where
         if self._append_list:
@@ -520,7 +574,7 @@ class QueryConstructor(object):
             raise ValueError('statement required')
         return _statement
 
-    def _process_where(self, table, key, value, operator) -> str:
+    def _process_where(self, table, key, value, operator, **kwargs) -> str:
         """ construct WHERE-statement part """
         return f'{table}.{key} {operator} {value}'
 
@@ -541,6 +595,66 @@ class QueryConstructor(object):
             raise ValueError(err)
         return f'{join_table}.{v1} = {table}.{v2}'
 
+    def _partition_filters(self) -> list[dict]:
+        """ partition-pruning where-statement parts (see `partitions` in __init__) """
+        self._partition_parameters = {}
+        if self._partitions is False:
+            return []
+        table_name = self._table.strip('`').split('.')[-1].upper()
+        if self._partitions is None:
+            partition = gcp.table_layout(table_name)['partition']
+        else:
+            partition = self._partitions.get(table_name)
+        if not partition:
+            return []
+        field = partition['field']
+        to_bound: Callable[[Any, str], Sequence[tuple[str, Union[str, int]]]]
+        if gcp.is_range_partition(partition):
+            src_field = partition.get('date_field')
+            to_bound = _date_to_year_bound
+        else:
+            src_field = partition.get('year_field')
+            to_bound = _year_to_date_bound
+        wheres = [w for w in self._where_list if w['table'] == self._table]
+        if (not src_field) or any(w['key'] == field for w in wheres):
+            return []
+        filters = []
+        for w in wheres:
+            if w['key'] == src_field:
+                for op, bound in to_bound(w['raw_value'], w['operator']):
+                    value: Union[str, int, float]
+                    if self._parameterize:
+                        name = f'{field}_partition_{len(self._partition_parameters)}'
+                        self._partition_parameters[name] = bound
+                        value = f'@{name}'
+                    else:
+                        value = self._sql_query_value(bound, op=op)
+                    filters.append(dict(table=self._table, key=field, value=value, operator=op))
+        return filters
+
+    def _add_where(self, table: Optional[str], key: str, value: Any, op: str) -> None:
+        """ append where-statement (<table> already processed by `_table_name`) """
+        self._where_list.append({
+            'key': key,
+            'table': table,
+            'value': self._where_value(key, value, op=op),
+            'operator': op,
+            'raw_value': value})
+
+    def _where_value(self, key: str, value: Any, op: str) -> Union[str, int, float]:
+        """ query value or (if parameterized) query parameter placeholder """
+        if self._parameterize:
+            name = re.sub(r'\W', '_', key)
+            nb_named = len([k for k in self._parameters if re.search(f'^{name}_[0-9]+$', k)])
+            name = f'{name}_{nb_named}'
+            self._parameters[name] = value
+            if op.lower() == 'in':
+                return f'UNNEST(@{name})'
+            else:
+                return f'@{name}'
+        else:
+            return self._sql_query_value(value, op=op)
+
     def _sql_query_value(self, value: Union[str, int, float], op: str) -> Union[str, int, float]:
         """ safe query value
         if value not int or float or "on"-operator return in quotes
@@ -818,11 +932,18 @@ def table_names(
         select: str = 'table_name',
         run_query: bool = True,
         to_list: bool = True,
-        to_dataframe: bool = True) -> Union[str, bq.QueryJob, pd.DataFrame]:
+        to_dataframe: bool = True,
+        backend: types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND,
+        client: Optional[types.QUERY_CLIENT] = None) -> Union[str, types.QUERY_RESULT]:
     sql = f"select {select} from `{project}.{database}.INFORMATION_SCHEMA.TABLES`"
     if run_query:
-        result = run(sql=sql, to_dataframe=to_dataframe or to_list)
+        result = run(
+            sql=sql,
+            to_dataframe=to_dataframe or to_list,
+            backend=backend,
+            client=client)
         if to_list:
+            assert isinstance(result, pd.DataFrame)
             return result.table_name.tolist()
         else:
             return result
@@ -837,13 +958,20 @@ def column_names(
         select: str = 'column_name',
         run_query: bool = True,
         to_list: bool = True,
-        to_dataframe: bool = True) -> Union[str, bq.QueryJob, pd.DataFrame]:
+        to_dataframe: bool = True,
+        backend: types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND,
+        client: Optional[types.QUERY_CLIENT] = None) -> Union[str, types.QUERY_RESULT]:
     sql = f"select {select} from `{project}.{database}.INFORMATION_SCHEMA.COLUMNS`"
     if table.upper() not in ['*', 'ALL']:
         sql += f' WHERE table_name = "{table}"'
     if run_query:
-        result = run(sql=sql, to_dataframe=to_dataframe or to_list)
+        result = run(
+            sql=sql,
+            to_dataframe=to_dataframe or to_list,
+            backend=backend,
+            client=client)
         if to_list:
+            assert isinstance(result, pd.DataFrame)
             return result.column_name.tolist()
         else:
             return result
@@ -860,14 +988,19 @@ def run(
         sql: Optional[str] = None,
         print_sql: bool = False,
         project: Optional[str] = None,
-        client: Optional[bq.Client] = None,
+        client: Optional[types.QUERY_CLIENT] = None,
         to_dataframe: bool = True,
-        **values) -> Union[bq.QueryJob, pd.DataFrame]:
+        backend: types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND,
+        parameters: Optional[dict[str, Any]] = None,
+        **values) -> types.QUERY_RESULT:
     """ queries bigquery
 
     Executes a bigquery query either through an explicit sql string, using the
     `sql` arg, or by creating a sql-string using the `named_sql` method above.
 
+    Note: with `backend='duckdb'` the (bigquery) sql is executed locally against
+    a parquet mirror of the database (see `spectral_trend_database.duckdb_client`).
+
     Args:
 
         name (Optional[str]): name of preconfigured config file
@@ -885,18 +1018,23 @@ def run(
         sql (str=None): if <name> not provided, explicit sql command to use in query
         print_sql (bool = False): if true print sql-string before executing query
         project (str=None): gcp project name
-        client (bq.Client=None):
-            instance of bigquery client
-            if None a new one will be instantiated
+        client (types.QUERY_CLIENT=None):
+            instance of bigquery (or duckdb_client.DuckDBClient) client
+            if None use the shared client for <backend> (see `clients.query_client`)
+        to_dataframe (bool = True): if true return result as a pd.DataFrame
+        backend (types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND):
+            one of 'bigquery' or 'duckdb'. only used if <client> is None
+        parameters (Optional[dict[str, Any]] = None):
+            named query parameters for <sql> (ie `QueryConstructor.parameters()`)
         **values:
             values for where clause (see usage above)
 
     Returns:
 
-        (str) sql command
+        (types.QUERY_RESULT) query-job or dataframe
     """
     if client is None:
-        client = bq.Client(project=project)
+        client = clients.query_client(backend=backend, project=project)
     if sql and limit:
         sql += f' LIMIT {limit}'
     elif name or table:
@@ -910,16 +1048,206 @@ def run(
     assert sql is not None
     if print_sql:
         utils.message(sql, 'query', 'run')
-    resp = client.query(sql)
-    if to_dataframe:
-        return resp.to_dataframe()
+    with profiling.stage(profiling.QUERY, unit='rows') as stage:
+        resp = client.query(sql, job_config=query_job_config(parameters))
+        if to_dataframe:
+            df = resp.to_dataframe()
+            stage.items = len(df)
+            return df
+        else:
+            return resp
+
+
+def iter_groups(
+        sql: str,
+        key: str = 'sample_id',
+        order_by: Optional[types.STRINGS] = None,
+        page_size: int = c.DEFAULT_PAGE_SIZE,
+        print_sql: bool = False,
+        project: Optional[str] = None,
+        client: Optional[types.QUERY_CLIENT] = None,
+        backend: types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND,
+        parameters: Optional[dict[str, Any]] = None) -> Iterator[
+            tuple[Any, pd.DataFrame]]:
+    """ stream query results one group (ie sample) at a time
+
+    Orders the results of <sql> by <key> (and <order_by>) and pages through the
+    results yielding the rows for each distinct <key> value as soon as all of its
+    rows have been downloaded. Memory is proportional to <page_size> rather than
+    to the full query result.
+
+    Usage:
+
+    ```python
+    qc = QueryConstructor('SMOOTHED_INDICES_V1', table_prefix=...)
+    qc.where(year=2010)
+    for sample_id, rows in iter_groups(qc.sql(), key='sample_id', order_by='date'):
+        process(rows)
+    ```
+
+    Args:
+
+        sql (str): sql statement
+        key (str = 'sample_id'): column to group rows by
+        order_by (Optional[types.STRINGS] = None):
+            column, or list of columns, to order rows by within a group
+        page_size (int = c.DEFAULT_PAGE_SIZE): number of rows per page
+        print_sql (bool = False): if true print sql-string before executing query
+        project (str=None): gcp project name
+        client (types.QUERY_CLIENT=None):
+            instance of bigquery (or duckdb_client.DuckDBClient) client
+            if None use the shared client for <backend> (see `clients.query_client`)
+        backend (types.QUERY_BACKEND = c.DEFAULT_QUERY_BACKEND):
+            one of 'bigquery' or 'duckdb'. only used if <client> is None
+        parameters (Optional[dict[str, Any]] = None):
+            named query parameters for <sql> (ie `QueryConstructor.parameters()`)
+
+    Yields:
+
+        (tuple) <key> value, dataframe of rows for <key> value
+    """
+    if client is None:
+        client = clients.query_client(backend=backend, project=project)
+    order_cols = [key] + (QueryConstructor._as_list(order_by) or [])
+    sql = f'SELECT * FROM ({sql}) ORDER BY {", ".join(order_cols)}'
+    if print_sql:
+        utils.message(sql, 'query', 'iter_groups')
+    job = client.query(sql, job_config=query_job_config(parameters))
+    pages = job.result(page_size=page_size).to_dataframe_iterable()
+    remainder = None
+    for page in pages:
+        if remainder is not None:
+            page = pd.concat([remainder, page], ignore_index=True)
+        starts, ends = utils.group_offsets(page[key])
+        for start, end in zip(starts[:-1], ends[:-1]):
+            yield page[key].iat[start], page.iloc[start:end].reset_index(drop=True)
+        if len(starts):
+            remainder = page.iloc[starts[-1]:]
+    if remainder is not None:
+        yield remainder[key].iat[0], remainder.reset_index(drop=True)
+
+
+def query_job_config(parameters: Optional[dict[str, Any]] = None) -> Optional[bq.QueryJobConfig]:
+    """ bigquery job-config for named query parameters
+
+    Args:
+
+        parameters (Optional[dict[str, Any]] = None): parameter-name, value pairs
+
+    Returns:
+
+        (bq.QueryJobConfig) job-config with query parameters or None if <parameters> is empty
+    """
+    if parameters:
+        return bq.QueryJobConfig(query_parameters=[
+            query_parameter(k, v) for k, v in parameters.items()])
+    else:
+        return None
+
+
+def query_parameter(
+        name: str,
+        value: Any) -> Union[bq.ScalarQueryParameter, bq.ArrayQueryParameter]:
+    """ bigquery query parameter
+
+    the parameter type is inferred from <value>:
+
+        - bool => BOOL
+        - int => INT64
+        - float => FLOAT64
+        - datetime => TIMESTAMP
+        - date or str formatted as YYYY-MM-DD => DATE
+        - str => STRING
+        - list, tuple, np.ndarray => ARRAY of the (inferred) type of the first element
+
+    Args:
+
+        name (str): parameter name
+        value (Any): parameter value
+
+    Returns:
+
+        (bq.ScalarQueryParameter|bq.ArrayQueryParameter) query parameter
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        values = [_parameter_value(v) for v in value]
+        if values:
+            value_type = _parameter_type(values[0])
+        else:
+            value_type = STRING_PARAMETER_TYPE
+        return bq.ArrayQueryParameter(name, value_type, values)
     else:
-        return resp
+        value = _parameter_value(value)
+        return bq.ScalarQueryParameter(name, _parameter_type(value), value)
 
 
 #
 # INTERNAL
 #
+def _parameter_value(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        value = value.item()
+    return value
+
+
+def _parameter_type(value: Any) -> str:
+    if isinstance(value, bool):
+        return 'BOOL'
+    elif isinstance(value, int):
+        return 'INT64'
+    elif isinstance(value, float):
+        return 'FLOAT64'
+    elif isinstance(value, datetime):
+        return 'TIMESTAMP'
+    elif isinstance(value, date):
+        return 'DATE'
+    elif isinstance(value, str) and re.search(DATE_PARAMETER_REGEX, value):
+        return 'DATE'
+    else:
+        return STRING_PARAMETER_TYPE
+
+
+def _date_to_year_bound(value: Any, op: str) -> list[tuple[str, int]]:
+    """ year where-statement parts (operator, value) for date where-statement part """
+    try:
+        value = pd.Timestamp(value)
+    except:
+        return []
+    if op in ['>', '>=']:
+        return [('>=', value.year)]
+    elif op == '<=':
+        return [('<=', value.year)]
+    elif op == '<':
+        if (value.month == 1) and (value.day == 1) and (value == value.normalize()):
+            return [('<=', value.year - 1)]
+        else:
+            return [('<=', value.year)]
+    elif op == '=':
+        return [('=', value.year)]
+    else:
+        return []
+
+
+def _year_to_date_bound(value: Any, op: str) -> list[tuple[str, str]]:
+    """ date where-statement parts (operator, value) for year where-statement part """
+    try:
+        year = int(value)
+    except:
+        return []
+    if op == '>=':
+        return [('>=', c.JAN1_TMPL.format(year))]
+    elif op == '>':
+        return [('>', c.DEC31_TMPL.format(year))]
+    elif op == '<=':
+        return [('<=', c.DEC31_TMPL.format(year))]
+    elif op == '<':
+        return [('<', c.JAN1_TMPL.format(year))]
+    elif op == '=':
+        return [('>=', c.JAN1_TMPL.format(year)), ('<=', c.DEC31_TMPL.format(year))]
+    else:
+        return []
+
+
 def _safe_prepend_keys(prefix, value, keys=TABLE_KEYS):
     if isinstance(value, dict):
         for key in keys:
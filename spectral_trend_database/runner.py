@@ -1,7 +1,27 @@
+import importlib
 import importlib.util
 import sys
+import time
+import multiprocessing as mp
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from copy import deepcopy
+from datetime import timedelta
 from spectral_trend_database import utils
+from spectral_trend_database import profiling
+
+
+#
+# CONSTANTS
+#
+# pre-defined jobs (run for jobs without a `file`): job-name => module with `run(config)`
+STDB_JOBS = {
+    'fused_pipeline': 'spectral_trend_database.pipeline'
+}
+DEFAULT_MAX_PARALLEL = 1
+# each parallel job runs in a fresh (spawned) process so jobs never share config state
+MP_CONTEXT = 'spawn'
+# json profiling report (see `profiling`). false disables the report file
+DEFAULT_PROFILE_REPORT = 'profiles/stdb-profile.{timestamp}.json'
 
 
 #
@@ -15,6 +35,103 @@ def import_module(path):
     return module
 
 
+def stdb_job_module(name):
+    """ module for pre-defined job <name> (see STDB_JOBS) """
+    module_name = STDB_JOBS.get(name)
+    if not module_name:
+        err = (
+            'spectral_trend_database.runner.stdb_job_module: '
+            f'pre-defined job "{name}" not found in {list(STDB_JOBS)}'
+        )
+        raise ValueError(err)
+    return importlib.import_module(module_name)
+
+
+def job_interface(name, file=None, job=None):
+    """ module (with a `run(config)` method) for job """
+    if file:
+        return import_module(utils.full_path(file, ext='py'))
+    else:
+        return stdb_job_module(job or name)
+
+
+def job_dependencies(job):
+    """ list of job names from job's (optional) `depends_on` (str or list) """
+    depends_on = job.get('depends_on') or []
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    return list(depends_on)
+
+
+def dependency_graph(jobs):
+    """ job-name => names of (selected) jobs it depends on
+
+    dependencies on jobs that are not in <jobs> (ie not selected for this
+    run) are treated as complete.
+    """
+    names = [j['name'] for j in jobs]
+    return {
+        j['name']: [n for n in job_dependencies(j) if n in names]
+        for j in jobs}
+
+
+def topological_order(jobs):
+    """ job names ordered so that every job follows its dependencies
+
+    jobs without dependencies between them keep their config order
+    """
+    graph = dependency_graph(jobs)
+    order = []
+    remaining = [j['name'] for j in jobs]
+    while remaining:
+        ready = [n for n in remaining if all(d in order for d in graph[n])]
+        if not ready:
+            err = (
+                'spectral_trend_database.runner.topological_order: '
+                f'circular job dependencies {remaining}'
+            )
+            raise ValueError(err)
+        order += ready
+        remaining = [n for n in remaining if n not in ready]
+    return order
+
+
+def critical_path(durations, graph):
+    """ longest (in duration) chain of dependent jobs
+
+    Args:
+
+        durations (dict): job-name => duration in seconds
+        graph (dict): job-name => dependencies (see `dependency_graph`)
+
+    Returns:
+
+        (tuple) list of job names on the critical path, total duration in seconds
+    """
+    finish = {}
+    previous = {}
+    for name in topological_order([dict(name=n, depends_on=graph[n]) for n in graph]):
+        deps = [d for d in graph[name] if d in durations]
+        prev = max(deps, key=lambda d: finish[d], default=None)
+        previous[name] = prev
+        finish[name] = durations.get(name, 0) + (finish[prev] if prev else 0)
+    if not finish:
+        return [], 0
+    name = max(finish, key=lambda n: finish[n])
+    total = finish[name]
+    path = []
+    while name:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], total
+
+
+def _run_job_process(name, file, job, config):
+    """ run job (in a worker process) and return its profiling record """
+    _, record = profiling.profile_job(name, job_interface(name, file=file, job=job).run, config)
+    return record
+
+
 #
 # MAIN
 #
@@ -40,48 +157,179 @@ class JobRunner(object):
     c. update with "job config" from a job in the per job configs contained
        in a job from the jobs-list mentioned in (1)
     d. update with any user-passed config BLAH=123 in the cli
+
+    jobs may declare `depends_on` (a job name or list of job names). jobs
+    run in dependency order. if max_parallel (`jr.run(max_parallel=...)` or
+    `max_parallel` in the config) is greater than 1, jobs whose dependencies
+    are complete run concurrently, each in its own process. the critical
+    path (longest chain of dependent jobs) is reported at the end of the run.
+
+    each job (and the query/compute/write/upload/load stages inside it) is
+    profiled (see `profiling`). a summary table is printed at the end of the
+    run and a json report is saved to `profile_report` (config or
+    `jr.run(profile_report=...)`, default DEFAULT_PROFILE_REPORT).
+
+    ```yaml
+    max_parallel: 2
+    jobs:
+        - name: cdl
+          file: scripts/step-1.export_cdl_corn_soy.py
+        - name: landsat
+          file: scripts/step-2.export_landsat_data.py
+        - name: indices
+          file: scripts/step-3.raw_spectral_indices.py
+          depends_on: landsat
+    ```
     """
     def __init__(self, config):
         _config = utils.process_config(config)
         self.config = utils.process_config(_config.get('shared_config', {}))
         self.jobs = _config['jobs']
+        self.max_parallel = _config.get('max_parallel', DEFAULT_MAX_PARALLEL)
+        self.profile_report = _config.get('profile_report', DEFAULT_PROFILE_REPORT)
         self.timer = utils.Timer()
+        self._check_dependencies()
 
-    def run(self, name=None, start_index=None, end_index=None, run_config={}):
+    def run(
+            self,
+            name=None,
+            start_index=None,
+            end_index=None,
+            run_config={},
+            max_parallel=None,
+            profile_report=None):
         self.run_config = utils.process_config(run_config)
+        if profile_report is None:
+            profile_report = self.profile_report
+        max_parallel = int(max_parallel or self.max_parallel or DEFAULT_MAX_PARALLEL)
         jobs = self._select_jobs(name, start_index, end_index)
+        graph = dependency_graph(jobs)
         print('- start:', self.timer.start())
-        print('- run jobs:', [j['name'] for j in jobs])
+        print('- run jobs:', topological_order(jobs))
+        print('- max_parallel:', max_parallel)
         print('-' * 100)
-        for job in jobs:
-            self.run_job(**job)
+        if max_parallel > 1:
+            durations, records = self._run_parallel(jobs, max_parallel)
+        else:
+            durations, records = self._run_sequential(jobs)
         print('-' * 100)
+        path, total = critical_path(durations, graph)
+        print(f'- critical path [{timedelta(seconds=round(total))}]:', ' -> '.join(path))
         end_time = self.timer.stop()
         duration = self.timer.delta()
+        print('- profile:')
+        profiling.print_summary(records)
+        if profile_report:
+            dest = profiling.save_report(
+                records,
+                profile_report.format(timestamp=self.timer.timestamp()),
+                start=self.timer.start_datetime,
+                end=self.timer.end_datetime,
+                max_parallel=max_parallel,
+                critical_path=path)
+            print('- profile report:', dest)
         print(f'- complete [{duration}]: {end_time}')
 
-    def run_job(self, name, file=None, config={}):
-        """
-        TODO: FIX DOC STRINGS
-        each job must have name + optional file and/or doc string
+    def run_job(self, name, file=None, config={}, job=None, depends_on=None):
+        """ run a single job (with its config) and profile it
+
+        Args:
+
+            name (str): job name
+            file (Optional[str] = None):
+                path of a script with a `run(config)` method. if None run the
+                pre-defined job <job> (or <name> if <job> is None) from STDB_JOBS
+            config (dict = {}): job specific config (see `_process_job_config`)
+            job (Optional[str] = None): name of pre-defined job (see STDB_JOBS)
+            depends_on (Optional[Union[str, list[str]]] = None):
+                names of jobs that must complete first. unused here, the order of
+                jobs is determined in `run` (see `topological_order`)
+
+        Returns:
+
+            (dict) the job's profiling record (see `profiling.profile_job`)
         """
         print()
         print(f'{name} [start]:', self.timer.now())
         job_config = self._process_job_config(name, config)
-        if file:
-            path =  utils.full_path(file, ext='py')
-        else:
-            # raise NotImplementedError('TODO: stdb jobs if no file')
-            print('TODO: stdb jobs if no file')
-            return
-        job_interface = import_module(path)
-        job_interface.run(job_config)
+        _, record = profiling.profile_job(
+            name,
+            job_interface(name, file=file, job=job).run,
+            job_config)
         print(f'{name} [complete]:', self.timer.now())
         print()
+        return record
 
     #
     # INTERNAL
     #
+    def _run_sequential(self, jobs):
+        jobs_by_name = {j['name']: j for j in jobs}
+        durations = {}
+        records = []
+        for name in topological_order(jobs):
+            start = time.time()
+            records.append(self.run_job(**jobs_by_name[name]))
+            durations[name] = time.time() - start
+        return durations, records
+
+    def _run_parallel(self, jobs, max_parallel):
+        jobs_by_name = {j['name']: j for j in jobs}
+        graph = dependency_graph(jobs)
+        pending = topological_order(jobs)
+        completed = set()
+        running = {}
+        starts = {}
+        durations = {}
+        records = []
+        with ProcessPoolExecutor(
+                max_workers=max_parallel,
+                mp_context=mp.get_context(MP_CONTEXT),
+                max_tasks_per_child=1) as executor:
+            while pending or running:
+                ready = [n for n in pending if all(d in completed for d in graph[n])]
+                for name in ready[:max_parallel - len(running)]:
+                    job = jobs_by_name[name]
+                    pending.remove(name)
+                    print(f'{name} [start]:', self.timer.now())
+                    starts[name] = time.time()
+                    future = executor.submit(
+                        _run_job_process,
+                        name,
+                        job.get('file'),
+                        job.get('job'),
+                        self._process_job_config(name, job.get('config', {})))
+                    running[future] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        records.append(future.result())
+                    except Exception as e:
+                        for other in running:
+                            other.cancel()
+                        err = (
+                            'spectral_trend_database.JobRunner._run_parallel: '
+                            f'job "{name}" failed ({e})'
+                        )
+                        raise RuntimeError(err) from e
+                    durations[name] = time.time() - starts[name]
+                    completed.add(name)
+                    print(f'{name} [complete]:', self.timer.now())
+        return durations, records
+
+    def _check_dependencies(self):
+        names = [j.get('name') for j in self.jobs]
+        for job in self.jobs:
+            missing = [n for n in job_dependencies(job) if n not in names]
+            if missing:
+                err = (
+                    'spectral_trend_database.JobRunner._check_dependencies: '
+                    f'job "{job.get("name")}" depends on unknown jobs {missing}'
+                )
+                raise ValueError(err)
+        topological_order(self.jobs)
+
     def _select_jobs(self, name, start_index, end_index):
         jobs = self.jobs
         if name:
@@ -0,0 +1,235 @@
+""" deterministic sample sharding
+
+DESCRIPTION:
+    partitions samples across machines so a year's work can be fanned out
+    over several VMs (`stdb job <name> --shard i/n`).
+
+    a sample belongs to shard `hash(<key>) % n` where the hash is a stable
+    (blake2b) hash of the string value of the `c.SHARD_KEY` column (default
+    'sample_id'). use a coarse location column (ie an h3 parent cell) as the
+    key to keep neighbouring samples on the same machine. shard indices are
+    zero-based (`0/4`, `1/4`, `2/4`, `3/4`).
+
+    when `c.SHARD` is set:
+
+        - `interface.map_samples` (and the step scripts) only process the
+          samples of the shard
+        - `interface.table_name_and_paths` returns shard-specific destinations
+          (`<name>.shard-<i>-of-<n>.<ext>`)
+        - `interface.save_to_gcp` uploads the shard file but defers the
+          bigquery load
+        - checkpoint manifests keep separate entries per shard
+
+    once all shards are uploaded, run the job again with `--merge_shards n`
+    (`c.MERGE_SHARDS`). the step scripts then skip processing and, for each
+    output, download and merge the shard files and upload/load the merged
+    table (see `interface.merge_shards`).
+
+USAGE:
+    ```bash
+    # on each of 4 machines
+    stdb job step-4 --shard 0/4
+    ...
+    stdb job step-4 --shard 3/4
+    # once all shards are complete
+    stdb job step-4 --merge_shards 4
+    ```
+
+    ```python
+    from spectral_trend_database import sharding
+
+    shard = sharding.parse_shard('1/4')
+    data = sharding.select_shard(data, shard=shard)
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from typing import Optional, Sequence, Union
+import hashlib
+import re
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from spectral_trend_database.config import config as c
+
+
+#
+# CONSTANTS
+#
+SHARD_SEP = '/'
+SHARD_TMPL = '{stem}.shard-{index}-of-{count}{suffix}'
+LABEL_TMPL = '{name}.shard-{index}-of-{count}'
+HASH_DIGEST_SIZE = 8
+URI_REGEX = r'^[a-z]+://'
+
+
+#
+# TYPES
+#
+SHARD = Union[str, Sequence[int], None]
+
+
+#
+# CONFIG
+#
+def parse_shard(shard: SHARD) -> Optional[tuple[int, int]]:
+    """ (index, count) from 'i/n' string or (i, n) pair
+
+    Args:
+
+        shard (SHARD): 'i/n', (i, n) or None
+
+    Returns:
+
+        (Optional[tuple[int, int]]) zero-based shard index and number of shards
+        or None if <shard> is falsy
+    """
+    if not shard:
+        return None
+    try:
+        if isinstance(shard, str):
+            index, count = [int(v.strip()) for v in shard.split(SHARD_SEP)]
+        else:
+            index, count = [int(v) for v in shard]
+    except ValueError:
+        index, count = -1, -1
+    if not (0 <= index < count):
+        err = (
+            'spectral_trend_database.sharding.parse_shard: '
+            f'shard ({shard}) must be "i/n" with 0 <= i < n'
+        )
+        raise ValueError(err)
+    return index, count
+
+
+def current_shard() -> Optional[tuple[int, int]]:
+    """ shard from `c.SHARD` (None if not sharded) """
+    return parse_shard(c.SHARD)
+
+
+def merge_count() -> Optional[int]:
+    """ number of shards to merge from `c.MERGE_SHARDS` (None if not merging) """
+    count = c.MERGE_SHARDS
+    if not count:
+        return None
+    if c.SHARD:
+        err = (
+            'spectral_trend_database.sharding.merge_count: '
+            'SHARD and MERGE_SHARDS are mutually exclusive'
+        )
+        raise ValueError(err)
+    return int(count)
+
+
+def merging() -> bool:
+    """ true if the current run merges shards (see `c.MERGE_SHARDS`) """
+    return merge_count() is not None
+
+
+#
+# PARTITIONING
+#
+def shard_hash(values: Union[Sequence, np.ndarray, pd.Series]) -> np.ndarray:
+    """ stable (across processes, machines and python versions) uint64 hashes
+
+    Args:
+
+        values (Union[Sequence, np.ndarray, pd.Series]): values (hashed as strings)
+
+    Returns:
+
+        (np.ndarray) uint64 hash for each value
+    """
+    uniques, inverse = np.unique(np.asarray(values).astype(str), return_inverse=True)
+    hashes = np.array(
+        [_hash(value) for value in uniques],
+        dtype=np.uint64)
+    return hashes[inverse.reshape(-1)]
+
+
+def shard_mask(
+        values: Union[Sequence, np.ndarray, pd.Series],
+        shard: SHARD) -> np.ndarray:
+    """ boolean mask of <values> that belong to <shard> """
+    index, count = parse_shard(shard) or (0, 1)
+    return (shard_hash(values) % np.uint64(count)) == np.uint64(index)
+
+
+def select_shard(
+        data: pd.DataFrame,
+        shard: SHARD = None,
+        key: Optional[str] = None) -> pd.DataFrame:
+    """ rows of <data> that belong to <shard>
+
+    Args:
+
+        data (pd.DataFrame): data
+        shard (SHARD = None): 'i/n' or (i, n). if None use `c.SHARD`
+        key (Optional[str] = None): column to hash. if None use `c.SHARD_KEY`
+
+    Returns:
+
+        (pd.DataFrame) rows of shard (<data> if not sharded)
+    """
+    shard = parse_shard(shard) or current_shard()
+    if shard is None:
+        return data
+    key = key or c.SHARD_KEY
+    if key not in data.columns:
+        err = (
+            'spectral_trend_database.sharding.select_shard: '
+            f'shard key ({key}) not in data columns'
+        )
+        raise ValueError(err)
+    return data[shard_mask(data[key], shard)]
+
+
+#
+# PATHS
+#
+def shard_path(path: str, shard: SHARD = None) -> str:
+    """ shard specific path (ie a/b-2010.shard-1-of-4.parquet)
+
+    Args:
+
+        path (str): local path or uri
+        shard (SHARD = None): 'i/n' or (i, n). if None use `c.SHARD`
+
+    Returns:
+
+        (str) shard path (<path> if not sharded)
+    """
+    shard = parse_shard(shard) or current_shard()
+    if shard is None:
+        return path
+    match = re.match(URI_REGEX, path)
+    prefix = match.group(0) if match else ''
+    parts = Path(path[len(prefix):])
+    name = SHARD_TMPL.format(
+        stem=parts.stem,
+        index=shard[0],
+        count=shard[1],
+        suffix=parts.suffix)
+    return f'{prefix}{parts.with_name(name)}'
+
+
+def shard_paths(path: str, count: int) -> list[str]:
+    """ paths of all <count> shards of <path> """
+    return [shard_path(path, (index, count)) for index in range(count)]
+
+
+def shard_label(name: str, shard: SHARD = None) -> str:
+    """ shard specific name (ie for checkpoint steps). if not sharded return <name> """
+    shard = parse_shard(shard) or current_shard()
+    if shard is None:
+        return name
+    return LABEL_TMPL.format(name=name, index=shard[0], count=shard[1])
+
+
+#
+# INTERNAL
+#
+def _hash(value: str) -> int:
+    digest = hashlib.blake2b(value.encode(), digest_size=HASH_DIGEST_SIZE).digest()
+    return int.from_bytes(digest, 'big')
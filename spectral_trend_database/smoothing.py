@@ -10,19 +10,27 @@ The main method, `smooth(...)`, takes a number of steps:
 License:
     BSD, see LICENSE.md
 """
-from typing import Callable, Union, Optional, Literal, TypeAlias, Sequence, Any
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Union, Optional, Literal, TypeAlias, Sequence, Any
 import warnings
 from copy import deepcopy
 import numpy as np
-import xarray as xr
-import dask.array
 from numpy.lib.stride_tricks import sliding_window_view
-from scipy.interpolate import interp1d  # type: ignore[import-untyped]
-import scipy.signal as sig  # type: ignore[import-untyped]
 from datetime import timedelta
+from spectral_trend_database import lazy
 from spectral_trend_database import utils
 from spectral_trend_database.npxr import npxr, sequencer
 from spectral_trend_database import types
+if TYPE_CHECKING:
+    import xarray as xr
+    import dask.array
+    from scipy import interpolate  # type: ignore[import-untyped]
+    import scipy.signal as sig  # type: ignore[import-untyped]
+else:
+    xr = lazy.lazy_import('xarray')
+    dask = lazy.lazy_import('dask', submodules=['array'])
+    interpolate = lazy.lazy_import('scipy.interpolate')
+    sig = lazy.lazy_import('scipy.signal')
 
 
 #
@@ -206,7 +214,7 @@ def interpolate_na(
     indices = np.arange(utils.npxr_shape(data)[0])
     if extrapolate:
         kwargs['fill_value'] = 'extrapolate'
-    _interp_func = interp1d(
+    _interp_func = interpolate.interp1d(
         indices[~is_nan],
         data[~is_nan],
         kind=method,
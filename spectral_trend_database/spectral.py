@@ -110,7 +110,7 @@ def add_index_arrays(
         assert isinstance(name, str)
         indices = index_config(name)
     index_cols = pd.Index(indices.keys())
-    index_arr = data.eval(list(indices.values()))
+    index_arr = np.asarray(data.eval(list(indices.values())))
     index_df = pd.DataFrame(index_arr.T, columns=index_cols)
     if include:
         data = data[include]
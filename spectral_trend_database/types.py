@@ -1,9 +1,12 @@
 from typing import Callable, Union, Optional, Literal, TypeAlias, Sequence, Any
 import typing
 import numpy as np
-import dask.array
-import xarray as xr
-from google.cloud import bigquery as bq
+import pandas as pd
+if typing.TYPE_CHECKING:
+    import dask.array
+    import xarray as xr
+    from google.cloud import bigquery as bq
+    from spectral_trend_database.duckdb_client import DuckDBClient, DuckDBQueryJob
 
 
 #
@@ -16,10 +19,12 @@ def type_args(dtype) -> list:
 #
 # DATA UNION TYPES
 #
-XR: TypeAlias = Union[xr.Dataset, xr.DataArray]
+# xarray, dask and bigquery are referenced by name so they are only imported
+# when used (see `lazy`)
+XR: TypeAlias = Union['xr.Dataset', 'xr.DataArray']
 NPXR: TypeAlias = Union[XR, np.ndarray]
-NPD: TypeAlias = Union[np.ndarray, dask.array.Array]
-NPDXR_ARRAY: TypeAlias = Union[xr.DataArray, NPD]
+NPD: TypeAlias = Union[np.ndarray, 'dask.array.Array']
+NPDXR_ARRAY: TypeAlias = Union['xr.DataArray', NPD]
 NPDXR: TypeAlias = Union[XR, NPD]
 
 
@@ -69,17 +74,31 @@ JOINS: TypeAlias = Literal[
     'right',
     'inner',
     'outer']
+QUERY_BACKEND: TypeAlias = Literal[
+    'bigquery',
+    'duckdb']
+TABLE_FORMAT: TypeAlias = Literal[
+    'json',
+    'parquet']
+FLOAT_TYPE: TypeAlias = Literal[
+    'float32',
+    'float64']
 CONV_MODE_ARGS: list[Any] = type_args(CONV_MODE)
 FILL_METHOD_ARGS: list[Any] = type_args(FILL_METHOD)
 INTERPOLATE_METHOD_ARGS: list[Any] = type_args(INTERPOLATE_METHOD)
 XR_INTERPOLATE_METHOD_ARGS: list[Any] = type_args(XR_INTERPOLATE_METHOD)
 MAP_METHOD_ARGS: list[Any] = type_args(MAP_METHOD)
+QUERY_BACKEND_ARGS: list[Any] = type_args(QUERY_BACKEND)
+TABLE_FORMAT_ARGS: list[Any] = type_args(TABLE_FORMAT)
+FLOAT_TYPE_ARGS: list[Any] = type_args(FLOAT_TYPE)
 
 
 #
 # REPEATED ARG TYPES
 #
-DICTABLE = Union[dict, bq.table.Row]
+DICTABLE = Union[dict, 'bq.table.Row']
+QUERY_CLIENT: TypeAlias = Union['bq.Client', 'DuckDBClient']
+QUERY_RESULT: TypeAlias = Union['bq.QueryJob', 'DuckDBQueryJob', pd.DataFrame]
 PATH_PARTS = Union[str, int, None, Literal[False]]
 ARGS_KWARGS: TypeAlias = Union[Sequence, dict, Literal[False], None]
 STRINGS: TypeAlias = Union[str, Sequence[Union[str, None]]]
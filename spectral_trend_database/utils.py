@@ -3,8 +3,12 @@
 License:
     BSD, see LICENSE.md
 """
-from typing import Any, Union, Optional, Callable, Iterable, Sequence, Literal
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Union, Optional, Callable, Iterable, Sequence, Literal
 import re
+import shutil
+import threading
+import warnings
 from pathlib import Path
 from datetime import datetime
 from copy import deepcopy
@@ -12,25 +16,47 @@ from zipfile import ZipFile
 import json
 import pandas as pd
 import numpy as np
-import xarray as xr
-import requests
-import dask.array
-from scipy import stats  # type: ignore[import-untyped]
-import yaml
+import pyarrow as pa  # type: ignore[import-untyped]
+import pyarrow.parquet as pq  # type: ignore[import-untyped]
+from spectral_trend_database import lazy
 from spectral_trend_database import constants
+from spectral_trend_database import profiling
 from spectral_trend_database import types
+if TYPE_CHECKING:
+    import xarray as xr
+    import requests
+    import dask.array
+    import yaml
+else:
+    xr = lazy.lazy_import('xarray')
+    requests = lazy.lazy_import('requests')
+    dask = lazy.lazy_import('dask', submodules=['array'])
+    yaml = lazy.lazy_import('yaml')
 
 
 #
 # CONSTANTS
 #
 DEFAULT_ACTION: Literal['prefix', 'suffix', 'replace'] = 'replace'
-LIST_LIKE_TYPES: tuple = (list, tuple, np.ndarray, xr.DataArray, pd.Series)
+# xr.DataArray values are list-like as well (see `_is_list_like`)
+LIST_LIKE_TYPES: tuple = (list, tuple, np.ndarray, pd.Series)
 DATE_FMT: str = '%Y-%m-%d'
 FULL_PATH_PREFIXES: list[str] = ['~', '/']
 YAML_REGEX: list[str] = r'\.(yml|yaml)$'
 YAML_EXT: str = 'yaml'
+JSON_FORMAT: str = 'json'
+PARQUET_FORMAT: str = 'parquet'
+DEFAULT_FLOAT_TYPE: types.FLOAT_TYPE = 'float64'
+DEFAULT_SINK_BYTES: int = 2**26
+SHARD_TMPL: str = '{stem}.shard-{index:04d}{suffix}'
+PART_TMPL: str = '{stem}.part-{index:04d}{suffix}'
 FALSEY: list[str] = ['None', 'none', 'null', 'false', 'False', '0']
+MOMENT_BLOCK_SIZE: int = 4096
+PRECISION_EPS: float = float(np.finfo(np.float64).eps)
+PRECISION_WARNING: str = (
+    'Precision loss occurred in moment calculation due to catastrophic cancellation. '
+    'This occurs when the data are nearly identical. Results may be unreliable.')
+EMPTY_WARNING: str = 'Mean of empty slice'
 
 
 #
@@ -167,6 +193,523 @@ def dataframe_to_ldjson(
     return dest
 
 
+def dataframe_to_parquet(
+        df: pd.DataFrame,
+        dest: str,
+        date_column: Optional[str] = 'date',
+        float_type: types.FLOAT_TYPE = DEFAULT_FLOAT_TYPE,
+        dry_run: bool = False,
+        create_dirs: bool = True,
+        noisy: bool = True) -> Union[str, None]:
+    """ save dataframe locally as parquet with an explicit schema
+
+    see `dataframe_to_arrow` for a description of the schema
+
+    Args:
+
+        df (pd.DataFrame): source dataframe
+        dest (str): local dest
+        date_column (Optional[str] = 'date'): name of (scalar or list valued) DATE column
+        float_type (types.FLOAT_TYPE = 'float64'): one of 'float32' or 'float64'
+        dry_run (bool = True): if true print message but don't save
+        create_dirs (bool = True): if true create local parent dirs if needed
+
+    Returns:
+
+        if not dry_run return destination otherwise None
+    """
+    if dry_run:
+        if noisy:
+            print('- dry_run [local]:', dest)
+        return None
+    else:
+        if noisy:
+            print('- local:', dest)
+        if create_dirs:
+            Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        pq.write_table(
+            dataframe_to_arrow(df, date_column=date_column, float_type=float_type),
+            dest)
+        return dest
+
+
+def save_dataframe(
+        df: pd.DataFrame,
+        dest: str,
+        file_format: Optional[types.TABLE_FORMAT] = None,
+        date_column: Optional[str] = 'date',
+        float_type: types.FLOAT_TYPE = DEFAULT_FLOAT_TYPE,
+        dry_run: bool = False,
+        create_dirs: bool = True,
+        noisy: bool = True) -> Union[str, None]:
+    """ save dataframe locally as parquet or line-deliminated JSON
+
+    Args:
+
+        df (pd.DataFrame): source dataframe
+        dest (str): local dest
+        file_format (Optional[types.TABLE_FORMAT] = None):
+            one of 'json' or 'parquet'. if None use file extension of <dest>
+        date_column (Optional[str] = 'date'): name of date column
+        float_type (types.FLOAT_TYPE = 'float64'): float type for parquet files
+        dry_run (bool = True): if true print message but don't save
+        create_dirs (bool = True): if true create local parent dirs if needed
+
+    Returns:
+
+        if not dry_run return destination otherwise None
+    """
+    if file_format is None:
+        file_format = file_format_from_path(dest)
+    with profiling.stage(profiling.WRITE, items=len(df), unit='rows'):
+        if file_format == PARQUET_FORMAT:
+            return dataframe_to_parquet(
+                df,
+                dest=dest,
+                date_column=date_column,
+                float_type=float_type,
+                dry_run=dry_run,
+                create_dirs=create_dirs,
+                noisy=noisy)
+        else:
+            return dataframe_to_ldjson(
+                df,
+                dest=dest,
+                date_column=date_column,
+                dry_run=dry_run,
+                create_dirs=create_dirs,
+                noisy=noisy)
+
+
+def read_dataframe(
+        src: str,
+        file_format: Optional[types.TABLE_FORMAT] = None,
+        date_column: Optional[str] = 'date') -> pd.DataFrame:
+    """ read (local or gcs) parquet or line-deliminated JSON as dataframe
+
+    Args:
+
+        src (str): local path or gcs uri
+        file_format (Optional[types.TABLE_FORMAT] = None):
+            one of 'json' or 'parquet'. if None use file extension of <src>
+        date_column (Optional[str] = 'date'):
+            name of (scalar) date column to convert to datetime
+
+    Returns:
+
+        (pd.DataFrame) data
+    """
+    if file_format is None:
+        file_format = file_format_from_path(src)
+    if file_format == PARQUET_FORMAT:
+        df = pd.read_parquet(src)
+        if date_column and (date_column in df.columns):
+            if not _is_list_like(df[date_column].iloc[0] if len(df) else None):
+                df[date_column] = pd.to_datetime(df[date_column])
+    else:
+        df = pd.read_json(src, lines=True)
+    return df
+
+
+def file_format_from_path(path: str) -> types.TABLE_FORMAT:
+    """ 'parquet' for paths with a parquet extension otherwise 'json' """
+    if Path(str(path)).suffix == f'.{PARQUET_FORMAT}':
+        return PARQUET_FORMAT  # type: ignore[return-value]
+    else:
+        return JSON_FORMAT  # type: ignore[return-value]
+
+
+def dataframe_to_arrow(
+        df: pd.DataFrame,
+        date_column: Optional[str] = 'date',
+        float_type: types.FLOAT_TYPE = DEFAULT_FLOAT_TYPE) -> pa.Table:
+    """ convert dataframe to arrow table with an explicit schema
+
+    Unlike json (where bigquery must autodetect the schema):
+
+    - <date_column> is stored as DATE (or list of DATE)
+    - float columns are stored as <float_type> with NaN stored as NULL
+    - list valued columns are stored as lists (bigquery: REPEATED). since
+      bigquery arrays can not contain NULLs, NaN elements are kept as NaN
+      rather than being replaced with constants.SAFE_NAN_VALUE
+
+    Args:
+
+        df (pd.DataFrame): source dataframe
+        date_column (Optional[str] = 'date'): name of (scalar or list valued) DATE column
+        float_type (types.FLOAT_TYPE = 'float64'): one of 'float32' or 'float64'
+
+    Returns:
+
+        (pa.Table) arrow table
+    """
+    arrays = [
+        _arrow_array(values, is_date=(name == date_column), float_type=float_type)
+        for name, values in df.items()]
+    return pa.Table.from_arrays(arrays, names=[str(n) for n in df.columns])
+
+
+class TableSink(object):
+    """ buffered (thread-safe) columnar writer
+
+    Rows are converted to arrow record batches (see `dataframe_to_arrow`) and
+    accumulated in memory. Once the buffer exceeds <max_bytes> it is written to
+    <dest> as a single parquet row group. If <dest> (or <file_format>) is json
+    the buffered dataframes are appended to a line-deliminated json file instead.
+
+    The parquet schema is taken from the first written batch. If a column of
+    that batch is all-null (arrow type `null`) and a later batch has values
+    for it, the sink continues in a new part file with the promoted schema and
+    the parts are merged into <dest> on close (see `merge_table_files`).
+
+    Usage:
+
+    ```python
+    with TableSink('data/smoothed.parquet') as sink:
+        for sample_id, rows in groups:
+            sink.write(rows, sample_id=sample_id, year=2010)
+    ```
+    """
+    def __init__(
+            self,
+            dest: str,
+            file_format: Optional[types.TABLE_FORMAT] = None,
+            float_type: types.FLOAT_TYPE = DEFAULT_FLOAT_TYPE,
+            date_column: Optional[str] = 'date',
+            max_bytes: int = DEFAULT_SINK_BYTES,
+            dry_run: bool = False,
+            create_dirs: bool = True,
+            noisy: bool = True) -> None:
+        """
+        Args:
+
+            dest (str): local dest
+            file_format (Optional[types.TABLE_FORMAT] = None):
+                one of 'json' or 'parquet'. if None use file extension of <dest>
+            float_type (types.FLOAT_TYPE = 'float64'): float type for parquet files
+            date_column (Optional[str] = 'date'): name of date column
+            max_bytes (int = DEFAULT_SINK_BYTES): flush buffer once it exceeds <max_bytes>
+            dry_run (bool = True): if true print message but don't save
+            create_dirs (bool = True): if true create local parent dirs if needed
+        """
+        if file_format is None:
+            file_format = file_format_from_path(dest)
+        self.dest = dest
+        self.file_format = file_format
+        self.float_type = float_type
+        self.date_column = date_column
+        self.max_bytes = max_bytes
+        self.dry_run = dry_run
+        self.noisy = noisy
+        self.nb_rows = 0
+        self._buffer: list = []
+        self._buffer_bytes = 0
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._schema: Optional[pa.Schema] = None
+        self._parts: list[str] = []
+        self._lock = threading.Lock()
+        if noisy:
+            if dry_run:
+                print('- dry_run [local]:', dest)
+            else:
+                print('- local:', dest)
+        if create_dirs and (not dry_run):
+            Path(dest).parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, data: Union[pd.DataFrame, list[dict], dict], **shared) -> None:
+        """ buffer rows
+
+        Args:
+
+            data (Union[pd.DataFrame, list[dict], dict]): rows to write
+            **shared: constant valued columns added (first) to each row
+        """
+        if self.dry_run:
+            return None
+        df = records_to_dataframe(data, **shared)
+        if df.empty:
+            return None
+        if self.file_format == PARQUET_FORMAT:
+            batch = dataframe_to_arrow(
+                df,
+                date_column=self.date_column,
+                float_type=self.float_type)
+            nbytes = batch.nbytes
+        else:
+            batch = df
+            nbytes = int(df.memory_usage(deep=False).sum())
+        with self._lock:
+            self._buffer.append(batch)
+            self._buffer_bytes += nbytes
+            self.nb_rows += len(df)
+            if self._buffer_bytes >= self.max_bytes:
+                self._flush()
+
+    def flush(self) -> None:
+        """ write buffered rows to <dest> """
+        with self._lock:
+            self._flush()
+
+    def close(self) -> Union[str, None]:
+        """ flush buffer and close file
+
+        Returns:
+
+            <dest> if any rows have been written otherwise None
+        """
+        with self._lock:
+            self._flush()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            if self._parts:
+                merge_table_files(self._parts, self.dest, file_format=self.file_format)
+                for part in self._parts:
+                    Path(part).unlink()
+                self._parts = []
+        if self.nb_rows and (not self.dry_run):
+            return self.dest
+        else:
+            return None
+
+    def __enter__(self) -> 'TableSink':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return None
+        if self.file_format == PARQUET_FORMAT:
+            table = pa.concat_tables(self._buffer, promote_options='default')
+            if (self._writer is None) or (self._schema is None):
+                self._schema = table.schema
+                self._writer = pq.ParquetWriter(self.dest, self._schema)
+            elif table.schema.names == self._schema.names:
+                if _promotes_nulls(self._schema, table.schema):
+                    self._next_part(table.schema)
+                table = table.cast(self._schema)
+            else:
+                err = (
+                    'spectral_trend_database.utils.TableSink: '
+                    f'columns ({table.schema.names}) do not match '
+                    f'previously written columns ({self._schema.names}).'
+                )
+                raise ValueError(err)
+            writer: pq.ParquetWriter = self._writer
+            writer.write_table(table, row_group_size=table.num_rows)
+        else:
+            dataframe_to_ldjson(
+                pd.concat(self._buffer, ignore_index=True),
+                dest=self.dest,
+                date_column=self.date_column,
+                create_dirs=False,
+                noisy=False,
+                mode='a')
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def _next_part(self, schema: pa.Schema) -> None:
+        """ continue writing in a new part file with <schema> promoted into the schema """
+        assert (self._writer is not None) and (self._schema is not None)
+        self._writer.close()
+        if not self._parts:
+            self._parts.append(_part_path(self.dest, 0))
+            Path(self.dest).rename(self._parts[0])
+        self._parts.append(_part_path(self.dest, len(self._parts)))
+        self._schema = pa.unify_schemas([self._schema, schema], promote_options='default')
+        self._writer = pq.ParquetWriter(self._parts[-1], self._schema)
+
+
+class ShardedTableSink(object):
+    """ per-thread `TableSink` shards merged into a single file on close
+
+    Each thread writing to the sink gets its own shard file, so concurrent
+    workers (ie `mproc.map_with_threadpool`) never contend on, or interleave
+    lines in, the same file. `close` merges the shards into <dest> (see
+    `merge_table_files`).
+
+    Usage:
+
+    ```python
+    sink = ShardedTableSink('data/smoothed.parquet')
+    mproc.map_with_threadpool(lambda s: sink.write(process(s), sample_id=s), sample_ids)
+    sink.close()
+    ```
+    """
+    def __init__(
+            self,
+            dest: str,
+            file_format: Optional[types.TABLE_FORMAT] = None,
+            float_type: types.FLOAT_TYPE = DEFAULT_FLOAT_TYPE,
+            date_column: Optional[str] = 'date',
+            max_bytes: int = DEFAULT_SINK_BYTES,
+            dry_run: bool = False,
+            create_dirs: bool = True,
+            noisy: bool = True,
+            remove_shards: bool = True) -> None:
+        """
+        Args:
+
+            dest (str): local dest of merged file
+            file_format (Optional[types.TABLE_FORMAT] = None):
+                one of 'json' or 'parquet'. if None use file extension of <dest>
+            float_type (types.FLOAT_TYPE = 'float64'): float type for parquet files
+            date_column (Optional[str] = 'date'): name of date column
+            max_bytes (int = DEFAULT_SINK_BYTES): per-shard buffer size (see `TableSink`)
+            dry_run (bool = True): if true print message but don't save
+            create_dirs (bool = True): if true create local parent dirs if needed
+            remove_shards (bool = True): if true delete shard files after merge
+        """
+        if file_format is None:
+            file_format = file_format_from_path(dest)
+        self.dest = dest
+        self.file_format = file_format
+        self.float_type = float_type
+        self.date_column = date_column
+        self.max_bytes = max_bytes
+        self.dry_run = dry_run
+        self.noisy = noisy
+        self.remove_shards = remove_shards
+        self.shards: list[TableSink] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if noisy:
+            if dry_run:
+                print('- dry_run [local]:', dest)
+            else:
+                print('- local:', dest)
+        if create_dirs and (not dry_run):
+            Path(dest).parent.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def nb_rows(self) -> int:
+        return sum(shard.nb_rows for shard in self.shards)
+
+    def write(self, data: Union[pd.DataFrame, list[dict], dict], **shared) -> None:
+        """ buffer rows in current thread's shard (see `TableSink.write`) """
+        if not self.dry_run:
+            self._shard().write(data, **shared)
+
+    def close(self) -> Union[str, None]:
+        """ close shards and merge into <dest>
+
+        Returns:
+
+            <dest> if any rows have been written otherwise None
+        """
+        with self._lock:
+            closed = [shard.close() for shard in self.shards]
+            srcs = [src for src in closed if src is not None]
+            self.shards = []
+            self._local = threading.local()
+        if srcs:
+            merge_table_files(srcs, self.dest, file_format=self.file_format)
+            if self.remove_shards:
+                for src in srcs:
+                    Path(src).unlink()
+            return self.dest
+        else:
+            return None
+
+    def __enter__(self) -> 'ShardedTableSink':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _shard(self) -> TableSink:
+        shard = getattr(self._local, 'sink', None)
+        if shard is None:
+            with self._lock:
+                shard = TableSink(
+                    shard_path(self.dest, len(self.shards)),
+                    file_format=self.file_format,
+                    float_type=self.float_type,
+                    date_column=self.date_column,
+                    max_bytes=self.max_bytes,
+                    create_dirs=False,
+                    noisy=False)
+                self.shards.append(shard)
+            self._local.sink = shard
+        return shard
+
+
+def shard_path(dest: str, index: int) -> str:
+    """ path of <index>-th shard of <dest> (ie `a/b.parquet` => `a/b.shard-0003.parquet`) """
+    path = Path(dest)
+    return str(path.parent / SHARD_TMPL.format(stem=path.stem, index=index, suffix=path.suffix))
+
+
+def merge_table_files(
+        srcs: Sequence[str],
+        dest: str,
+        file_format: Optional[types.TABLE_FORMAT] = None) -> str:
+    """ merge parquet or line-deliminated json files
+
+    Parquet files are copied row group by row group (cast to the unified schema
+    of <srcs>) so memory use is bounded by the largest row group. Json files
+    are concatenated.
+
+    Args:
+
+        srcs (Sequence[str]): local source files
+        dest (str): local dest
+        file_format (Optional[types.TABLE_FORMAT] = None):
+            one of 'json' or 'parquet'. if None use file extension of <dest>
+
+    Returns:
+
+        (str) dest
+    """
+    if file_format is None:
+        file_format = file_format_from_path(dest)
+    with profiling.stage(profiling.WRITE, items=len(srcs), unit='files'):
+        if file_format == PARQUET_FORMAT:
+            schema = pa.unify_schemas(
+                [pq.read_schema(src) for src in srcs],
+                promote_options='default')
+            with pq.ParquetWriter(dest, schema) as writer:
+                for src in srcs:
+                    parquet_file = pq.ParquetFile(src)
+                    for i in range(parquet_file.num_row_groups):
+                        table = parquet_file.read_row_group(i).select(schema.names)
+                        writer.write_table(table.cast(schema))
+        else:
+            with open(dest, 'wb') as dest_file:
+                for src in srcs:
+                    with open(src, 'rb') as src_file:
+                        shutil.copyfileobj(src_file, dest_file)
+    return dest
+
+
+def records_to_dataframe(data: Union[pd.DataFrame, list[dict], dict], **shared) -> pd.DataFrame:
+    """ dataframe from dataframe, record or list of records
+
+    Args:
+
+        data (Union[pd.DataFrame, list[dict], dict]): rows
+        **shared: constant valued columns added (first) to each row
+
+    Returns:
+
+        (pd.DataFrame) rows
+    """
+    if isinstance(data, dict):
+        data = [data]
+    if isinstance(data, pd.DataFrame):
+        df = data.reset_index(drop=True)
+    else:
+        df = pd.DataFrame(data)
+    if shared:
+        df = df.drop(columns=[k for k in shared if k in df.columns])
+        df = pd.concat([
+            pd.DataFrame({k: [v] * len(df) for k, v in shared.items()}),
+            df], axis=1)
+    return df
+
+
 def download_and_extract_zip(
         url: str,
         path: Optional[str] = None,
@@ -497,17 +1040,27 @@ def xr_coord_name(
 def xr_stats(
         dataset: xr.Dataset,
         data_vars: Optional[Sequence[str]] = None,
-        axis: Optional[int] = -1,
-        skew_kurtosis: bool = True) -> xr.Dataset:
+        axis: int = -1,
+        skew_kurtosis: bool = True,
+        skipna: bool = True,
+        quantiles: Optional[Sequence[float]] = None) -> xr.Dataset:
     """ compute stats for dataset
 
+        count, mean and the central moments (for skew/kurtosis) are computed in
+        a single pass (see `moments`), the median (and <quantiles>) by partitioning
+        (see `nan_quantiles`). as with `scipy.stats`, a RuntimeWarning is raised
+        if there are no values or if values are (nearly) identical.
+
         Args:
 
             dataset (xr.Dataset): dataset on which to compute stats
             data_vars (Optional[Sequence[str]] = None):
                 data_vars to compute stats on. if none use all data_vars
-            axis (Optional[int] = -1): axis along which to compute stats
+            axis (int = -1): axis along which to compute stats
             skew_kurtosis (bool = True): if true also include skew, kurtosis in stats
+            skipna (bool = True): if true skip NaNs, otherwise NaNs propagate
+            quantiles (Optional[Sequence[float]] = None):
+                additional quantiles (in [0, 1]) named <var>_q<percent> (see `quantile_name`)
 
         Returns:
 
@@ -515,34 +1068,155 @@ def xr_stats(
     """
     if data_vars is None:
         data_vars = list(dataset.data_vars)
-    arr = dataset_to_ndarray(dataset)
+    arr = dataset_to_ndarray(dataset, data_vars=data_vars).astype(np.float64)
+    mmts = moments(arr, axis=axis)
+    quantiles = list(quantiles or [])
+    quantile_values = nan_quantiles(arr, [0.5] + quantiles, axis=axis)
     stat_values = [
-        arr.mean(axis=axis),
-        np.median(arr, axis=axis),
-        arr.min(axis=axis),
-        arr.max(axis=axis)
-    ]
-    dvar_names = [
-        [f'{n}_mean' for n in data_vars],
-        [f'{n}_median' for n in data_vars],
-        [f'{n}_min' for n in data_vars],
-        [f'{n}_max' for n in data_vars]
-    ]
-    dvar_names = [
-        _suffix_list(data_vars, 'mean'),
-        _suffix_list(data_vars, 'median'),
-        _suffix_list(data_vars, 'min'),
-        _suffix_list(data_vars, 'max')]
+        ('mean', mmts['mean']),
+        ('median', quantile_values[0]),
+        ('min', nan_reduce(np.nanmin, arr, axis=axis)),
+        ('max', nan_reduce(np.nanmax, arr, axis=axis))]
     if skew_kurtosis:
-        stat_values += [stats.skew(arr, axis=axis), stats.kurtosis(arr, axis=axis)]
-        dvar_names += [_suffix_list(data_vars, 'skew'), _suffix_list(data_vars, 'kurtosis')]
-    datasets = []
-    for names, values in zip(dvar_names, stat_values):
-        datasets.append(
-            xr.Dataset(data_vars={
-                n: ([], v)
-                for (n, v) in zip(names, values)}))
-    return xr.combine_by_coords(datasets, join='exact')  # type: ignore[return-value]
+        skew, kurtosis = skew_kurtosis_from_moments(mmts)
+        stat_values += [('skew', skew), ('kurtosis', kurtosis)]
+    for q, values in zip(quantiles, quantile_values[1:]):
+        stat_values.append((quantile_name(q), values))
+    checked: np.ndarray = np.ones(mmts['count'].shape, dtype=bool)
+    if not skipna:
+        checked = np.asarray(~np.isnan(arr).any(axis=axis))
+        stat_values = [(n, np.where(checked, v, np.nan)) for n, v in stat_values]
+    if (mmts['count'][checked] == 0).any():
+        warnings.warn(EMPTY_WARNING, RuntimeWarning)
+    elif skew_kurtosis:
+        stat_dict = dict(stat_values)
+        loss = precision_loss(mmts['count'], mmts['mean'], stat_dict['min'], stat_dict['max'])
+        if loss[checked].any():
+            warnings.warn(PRECISION_WARNING, RuntimeWarning)
+    data: dict[str, tuple] = dict()
+    for stat_name, values in stat_values:
+        for name, value in zip(_suffix_list(data_vars, stat_name), values):
+            data[name] = ([], value)
+    return xr.Dataset(data_vars=data)
+
+
+def moments(
+        values: np.ndarray,
+        axis: int = -1,
+        block_size: int = MOMENT_BLOCK_SIZE) -> dict[str, np.ndarray]:
+    """ NaN-skipping count, mean and central moment sums in a single pass
+
+    <values> are read once, in blocks of <block_size> along <axis>. the moments
+    of each block are merged into the running moments with the pairwise update
+    of Chan et al. (extended to third and fourth moments by Pebay), which is
+    numerically stable (unlike power sums) and never holds more than one
+    block of deviations in memory.
+
+    Args:
+
+        values (np.ndarray): values
+        axis (int = -1): axis along which to compute moments
+        block_size (int = MOMENT_BLOCK_SIZE): number of values per block
+
+    Returns:
+
+        (dict[str, np.ndarray]) count, mean, m2, m3, m4, where m<k> is the sum of
+        k-th powers of deviations from the mean (divide by count for the k-th
+        central moment). mean and m<k> are NaN where count is 0
+    """
+    values = np.moveaxis(np.asarray(values, dtype=np.float64), axis, -1)
+    result = None
+    for start in range(0, max(values.shape[-1], 1), block_size):
+        block = _block_moments(values[..., start:start + block_size])
+        result = block if result is None else _merge_moments(result, block)
+    return result  # type: ignore[return-value]
+
+
+def skew_kurtosis_from_moments(mmts: dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """ (biased) skew and (fisher) kurtosis from `moments`
+
+    matches `scipy.stats.skew` and `scipy.stats.kurtosis` (with default arguments):
+    values are NaN where there are no values or values are (nearly) identical
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m2 = mmts['m2'] / mmts['count']
+        m3 = mmts['m3'] / mmts['count']
+        m4 = mmts['m4'] / mmts['count']
+        zero = ~(m2 > (PRECISION_EPS * mmts['mean']) ** 2)
+        skew = np.where(zero, np.nan, m3 / m2 ** 1.5)
+        kurtosis = np.where(zero, np.nan, m4 / m2 ** 2 - 3)
+    return skew, kurtosis
+
+
+def precision_loss(
+        count: np.ndarray,
+        mean: np.ndarray,
+        minimum: np.ndarray,
+        maximum: np.ndarray) -> np.ndarray:
+    """ true where values are (nearly) identical (skew/kurtosis are unreliable or NaN)
+
+    the test of `scipy.stats` (which raises a precision-loss RuntimeWarning):
+    more than one value and max(|value - mean|) < 10 * eps * |mean|
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        deviation = np.maximum(maximum - mean, mean - minimum)
+        return (deviation / np.abs(mean) < 10 * PRECISION_EPS) & (count > 1)
+
+
+def nan_quantiles(
+        values: np.ndarray,
+        quantiles: Sequence[float],
+        axis: int = -1) -> np.ndarray:
+    """ NaN-skipping quantiles (linear interpolation, as `np.nanquantile`) by partitioning
+
+    instead of sorting, <values> are partitioned (`np.partition`) around the
+    (few) ranks needed for <quantiles>
+
+    Args:
+
+        values (np.ndarray): values
+        quantiles (Sequence[float]): quantiles in [0, 1]
+        axis (int = -1): axis along which to compute quantiles
+
+    Returns:
+
+        (np.ndarray) array with a leading quantile axis (NaN where there are no values)
+    """
+    values = np.moveaxis(np.asarray(values, dtype=np.float64), axis, -1)
+    if not values.shape[-1]:
+        return np.full((len(quantiles),) + values.shape[:-1], np.nan)
+    is_nan = np.isnan(values)
+    count = values.shape[-1] - is_nan.sum(axis=-1, keepdims=True)
+    if is_nan.any():
+        values = np.where(is_nan, np.inf, values)
+    positions = [np.asarray(q, dtype=np.float64) * (count - 1) for q in quantiles]
+    lows = [np.floor(p).astype(int) for p in positions]
+    highs = [np.ceil(p).astype(int) for p in positions]
+    ranks = np.unique(np.concatenate([r[count > 0].ravel() for r in lows + highs]))
+    if ranks.size:
+        values = np.partition(values, ranks, axis=-1)
+    result = []
+    for position, low, high in zip(positions, lows, highs):
+        low_values = np.take_along_axis(values, np.clip(low, 0, None), axis=-1)
+        high_values = np.take_along_axis(values, np.clip(high, 0, None), axis=-1)
+        with np.errstate(invalid='ignore'):
+            quantile = low_values + (high_values - low_values) * (position - low)
+        result.append(np.where(count > 0, quantile, np.nan)[..., 0])
+    return np.stack(result)
+
+
+def nan_reduce(func: Callable, values: np.ndarray, axis: int = -1) -> np.ndarray:
+    """ nan-reduction (ie np.nanmin) that returns NaN (without warning) for empty slices """
+    if not values.shape[axis]:
+        return np.full(np.delete(values.shape, axis), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(values, axis=axis)
+
+
+def quantile_name(quantile: float) -> str:
+    """ stat name for quantile (ie 0.25 => 'q25', 0.025 => 'q2_5') """
+    return 'q' + f'{quantile * 100:g}'.replace('.', '_')
 
 
 def npxr_shape(
@@ -804,6 +1478,35 @@ def infinite_along_axis(arr: np.ndarray, axis: int = 0):
     return (~np.isfinite(arr)).any(axis=axis)
 
 
+def group_offsets(values: Union[Sequence, np.ndarray, pd.Series]) -> tuple[np.ndarray, np.ndarray]:
+    """ start/end offsets of contiguous runs of equal values
+
+    Usage:
+
+    ```python
+    starts, ends = group_offsets(['a', 'a', 'b', 'c', 'c', 'c'])
+    # starts => [0, 2, 3], ends => [2, 3, 6]
+    ```
+
+    Args:
+
+        values (Union[Sequence, np.ndarray, pd.Series]):
+            grouping values. values are expected to be contiguous (ie sorted)
+
+    Returns:
+
+        (tuple) arrays of start (inclusive) and end (exclusive) indices for each group
+    """
+    values = np.asarray(values)
+    nb_values = values.shape[0]
+    if not nb_values:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    changes = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.concatenate([[0], changes])
+    ends = np.concatenate([changes, [nb_values]])
+    return starts, ends
+
+
 def filter_list_valued_columns(
         row: pd.Series,
         test: Callable,
@@ -891,12 +1594,110 @@ def _name_value(
     return value
 
 
+def _block_moments(values: np.ndarray) -> dict[str, np.ndarray]:
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, values, 0).sum(axis=-1) / count
+        deviations = np.where(valid, values - mean[..., None], 0)
+    squared = deviations ** 2
+    empty = count == 0
+    return dict(
+        count=count,
+        mean=mean,
+        m2=np.where(empty, np.nan, squared.sum(axis=-1)),
+        m3=np.where(empty, np.nan, (squared * deviations).sum(axis=-1)),
+        m4=np.where(empty, np.nan, (squared ** 2).sum(axis=-1)))
+
+
+def _merge_moments(a: dict[str, np.ndarray], b: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    na, nb = a['count'], b['count']
+    n = na + nb
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(nb > 0, b['mean'], 0) - np.where(na > 0, a['mean'], 0)
+        delta = np.where((na > 0) & (nb > 0), delta, 0)
+        mean = np.where(na > 0, a['mean'], 0) + delta * nb / n
+        mean = np.where(na > 0, mean, b['mean'])
+        a2, b2 = np.nan_to_num(a['m2']), np.nan_to_num(b['m2'])
+        a3, b3 = np.nan_to_num(a['m3']), np.nan_to_num(b['m3'])
+        a4, b4 = np.nan_to_num(a['m4']), np.nan_to_num(b['m4'])
+        m2 = a2 + b2 + delta ** 2 * na * nb / n
+        m3 = a3 + b3 + delta ** 3 * na * nb * (na - nb) / n ** 2
+        m3 += 3 * delta * (na * b2 - nb * a2) / n
+        m4 = a4 + b4 + delta ** 4 * na * nb * (na ** 2 - na * nb + nb ** 2) / n ** 3
+        m4 += 6 * delta ** 2 * (na ** 2 * b2 + nb ** 2 * a2) / n ** 2
+        m4 += 4 * delta * (na * b3 - nb * a3) / n
+    empty = n == 0
+    return dict(
+        count=n,
+        mean=np.where(empty, np.nan, mean),
+        m2=np.where(empty, np.nan, m2),
+        m3=np.where(empty, np.nan, m3),
+        m4=np.where(empty, np.nan, m4))
+
+
 def _suffix_list(values: Sequence[str], suffix: str, sep: str = '_') -> list[str]:
     return [f'{v}{sep}{suffix}' for v in values]
 
 
-def _alignable(ref_list: list, value: Any) -> bool:
+def _part_path(dest: str, index: int) -> str:
+    path = Path(dest)
+    return str(path.parent / PART_TMPL.format(stem=path.stem, index=index, suffix=path.suffix))
+
+
+def _promotes_nulls(schema: pa.Schema, other: pa.Schema) -> bool:
+    """ true if null-typed fields of <schema> are typed in <other> """
+    return any(
+        pa.types.is_null(field.type) and not pa.types.is_null(other.field(field.name).type)
+        for field in schema)
+
+
+def _arrow_array(
+        values: pd.Series,
+        is_date: bool = False,
+        float_type: types.FLOAT_TYPE = DEFAULT_FLOAT_TYPE) -> pa.Array:
+    """ convert series to arrow array (see `dataframe_to_arrow`) """
+    valid = values.dropna()
+    first = valid.iloc[0] if valid.size else None
+    if _is_list_like(first):
+        lists = [np.asarray(v if _is_list_like(v) else []) for v in values]
+        offsets = np.concatenate([[0], np.cumsum([v.size for v in lists])])
+        if offsets[-1]:
+            flat = np.concatenate(lists)
+        else:
+            flat = np.array([], dtype=float)
+        arr = pa.ListArray.from_arrays(
+            pa.array(offsets, type=pa.int32()),
+            _arrow_values(flat, is_date=is_date, float_type=float_type, from_pandas=False))
+    else:
+        arr = _arrow_values(values, is_date=is_date, float_type=float_type, from_pandas=True)
+    return arr
+
+
+def _arrow_values(
+        values: Union[np.ndarray, pd.Series],
+        is_date: bool,
+        float_type: types.FLOAT_TYPE,
+        from_pandas: bool) -> pa.Array:
+    if is_date:
+        dates = pd.to_datetime(pd.Series(values)).to_numpy().astype('datetime64[D]')
+        return pa.array(dates, type=pa.date32(), from_pandas=True)
+    else:
+        arr = pa.array(values, from_pandas=from_pandas)
+        if pa.types.is_floating(arr.type):
+            arr = arr.cast(pa.from_numpy_dtype(np.dtype(float_type)))
+        return arr
+
+
+def _is_list_like(value: Any) -> bool:
     if isinstance(value, LIST_LIKE_TYPES):
+        return True
+    # if xarray has not been imported <value> can not be a DataArray
+    return lazy.is_loaded('xarray') and isinstance(value, xr.DataArray)
+
+
+def _alignable(ref_list: list, value: Any) -> bool:
+    if _is_list_like(value):
         return len(ref_list) == len(value)
     else:
         return False
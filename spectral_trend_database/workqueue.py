@@ -0,0 +1,486 @@
+""" work queue of (year, sample_id) units shared by cooperating workers
+
+DESCRIPTION:
+    static sharding (see `sharding`) assigns samples to machines up-front, so
+    a shard with slow samples (ie many scenes) leaves the other machines idle.
+    with a work queue each worker repeatedly claims a small batch of units,
+    processes it and marks it as completed, so any number of `stdb job`
+    processes (on any number of machines) drain a year together.
+
+    the queue is a sqlite database (`c.WORK_QUEUE_PATH`). to share it between
+    machines put it (and its part files) on a shared filesystem. claims are
+    leases: a worker renews the leases of its current batch in a background
+    thread (see `WorkQueue.batches`). if a worker dies its leases expire and
+    the units are claimed again (at most `c.WORK_QUEUE_MAX_ATTEMPTS` times,
+    after which they are marked as failed). lease expiry uses wall-clock time,
+    so worker clocks must be (roughly) synchronised.
+
+    each completed batch records its output files (parts). once no units are
+    pending or leased, exactly one worker wins `claim_finalize` and merges
+    the parts (ie into the tables uploaded to gcs/bigquery).
+
+USAGE:
+    ```python
+    from spectral_trend_database import workqueue
+
+    queue = workqueue.WorkQueue('/shared/stdb/queue.db')
+    queue.add('fused_pipeline', 2010, sample_ids)
+    for batch in queue.batches('fused_pipeline', 2010, batch_size=50):
+        dest = queue.part_path('fused_pipeline', 2010, 'macd.parquet')
+        ... process samples in <batch> and write rows to <dest> ...
+        queue.complete('fused_pipeline', 2010, batch, outputs=dict(macd=dest))
+    if queue.claim_finalize('fused_pipeline', 2010):
+        parts = queue.outputs('fused_pipeline', 2010)['macd']
+        ... merge <parts> ...
+    ```
+
+License:
+    BSD, see LICENSE.md
+"""
+from typing import Any, Iterator, Optional, Sequence
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from spectral_trend_database.config import config as c
+
+
+#
+# CONSTANTS
+#
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATUSES = [PENDING, LEASED, DONE, FAILED]
+SQLITE_TIMEOUT = 60
+RENEW_FRACTION = 3
+MAX_POLL_INTERVAL = 10
+PARTS_DIR = 'parts'
+PART_TMPL = '{stem}.part-{token}{suffix}'
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS units (
+        queue TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        sample_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        worker TEXT,
+        lease_expires REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (queue, year, sample_id))
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS units_status ON units (queue, year, status)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS outputs (
+        queue TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        path TEXT NOT NULL,
+        worker TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (queue, year, name, path))
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS finalized (
+        queue TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        worker TEXT NOT NULL,
+        finalized_at TEXT NOT NULL,
+        PRIMARY KEY (queue, year))
+    """
+]
+
+
+#
+# QUEUE
+#
+class WorkQueue(object):
+    """ sqlite work queue with leased claims """
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            lease_seconds: Optional[float] = None,
+            max_attempts: Optional[int] = None,
+            worker: Optional[str] = None) -> None:
+        """
+        Args:
+
+            path (Optional[str] = None): path to sqlite database. if None use `c.WORK_QUEUE_PATH`
+            lease_seconds (Optional[float] = None):
+                lease duration. if None use `c.WORK_QUEUE_LEASE_SECONDS`
+            max_attempts (Optional[int] = None):
+                max number of claims per unit. if None use `c.WORK_QUEUE_MAX_ATTEMPTS`
+            worker (Optional[str] = None): worker id. if None use <hostname>-<pid>-<token>
+        """
+        path = path or c.WORK_QUEUE_PATH
+        if not path:
+            err = (
+                'spectral_trend_database.workqueue.WorkQueue: '
+                'path or c.WORK_QUEUE_PATH required'
+            )
+            raise ValueError(err)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = str(path)
+        self.lease_seconds = float(lease_seconds or c.WORK_QUEUE_LEASE_SECONDS)
+        self.max_attempts = int(max_attempts or c.WORK_QUEUE_MAX_ATTEMPTS)
+        self.worker = worker or worker_id()
+        self.poll_interval = min(self.lease_seconds / RENEW_FRACTION, MAX_POLL_INTERVAL)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path,
+            timeout=SQLITE_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False)
+        with self._transaction() as cursor:
+            for sql in SCHEMA:
+                cursor.execute(sql)
+
+    def add(self, queue: str, year: int, sample_ids: Sequence[str]) -> int:
+        """ add pending units (existing units are left unchanged)
+
+        Args:
+
+            queue (str): queue name (ie the job or step name)
+            year (int): year
+            sample_ids (Sequence[str]): sample ids
+
+        Returns:
+
+            (int) number of units added
+        """
+        now = _now()
+        with self._transaction() as cursor:
+            cursor.executemany(
+                'INSERT OR IGNORE INTO units '
+                '(queue, year, sample_id, status, attempts, updated_at) '
+                'VALUES (?, ?, ?, ?, 0, ?)',
+                [(queue, year, str(s), PENDING, now) for s in sample_ids])
+            return cursor.rowcount
+
+    def claim(self, queue: str, year: int, batch_size: Optional[int] = None) -> list[str]:
+        """ lease up to <batch_size> pending (or expired) units
+
+        Args:
+
+            queue (str): queue name
+            year (int): year
+            batch_size (Optional[int] = None):
+                max number of units. if None use `c.WORK_QUEUE_BATCH_SIZE`
+
+        Returns:
+
+            (list[str]) claimed sample ids (empty if nothing can be claimed)
+        """
+        batch_size = int(batch_size or c.WORK_QUEUE_BATCH_SIZE)
+        now = time.time()
+        with self._transaction() as cursor:
+            self._expire(cursor, queue, year, now)
+            rows = cursor.execute(
+                'SELECT sample_id FROM units WHERE queue = ? AND year = ? '
+                'AND (status = ? OR (status = ? AND lease_expires < ?)) '
+                'ORDER BY attempts, sample_id LIMIT ?',
+                (queue, year, PENDING, LEASED, now, batch_size)).fetchall()
+            sample_ids = [row[0] for row in rows]
+            cursor.executemany(
+                'UPDATE units SET status = ?, worker = ?, lease_expires = ?, '
+                'attempts = attempts + 1, updated_at = ? '
+                'WHERE queue = ? AND year = ? AND sample_id = ?',
+                [
+                    (LEASED, self.worker, now + self.lease_seconds, _now(), queue, year, s)
+                    for s in sample_ids])
+        return sample_ids
+
+    def renew(self, queue: str, year: int, sample_ids: Sequence[str]) -> int:
+        """ extend leases of this worker's units
+
+        Returns:
+
+            (int) number of leases renewed (leases that have expired and been
+            claimed by another worker are not renewed)
+        """
+        expires = time.time() + self.lease_seconds
+        with self._transaction() as cursor:
+            cursor.executemany(
+                'UPDATE units SET lease_expires = ? '
+                'WHERE queue = ? AND year = ? AND sample_id = ? AND worker = ? AND status = ?',
+                [(expires, queue, year, str(s), self.worker, LEASED) for s in sample_ids])
+            return cursor.rowcount
+
+    def complete(
+            self,
+            queue: str,
+            year: int,
+            sample_ids: Sequence[str],
+            outputs: Optional[dict[str, Optional[str]]] = None) -> bool:
+        """ mark units as done and record their output files
+
+        all or nothing: if any of the leases has been lost (expired and claimed
+        by another worker) nothing is recorded, since the other worker will
+        write the rows of these units again.
+
+        Args:
+
+            queue (str): queue name
+            year (int): year
+            sample_ids (Sequence[str]): sample ids (claimed by this worker)
+            outputs (Optional[dict[str, Optional[str]]] = None):
+                output-name, part-file pairs holding the rows of the units.
+                None values (ie nothing written) are ignored
+
+        Returns:
+
+            (bool) true if the units were completed
+        """
+        sample_ids = [str(s) for s in sample_ids]
+        now = _now()
+        with self._transaction() as cursor:
+            if self._held(cursor, queue, year, sample_ids) < len(sample_ids):
+                return False
+            cursor.executemany(
+                'UPDATE units SET status = ?, lease_expires = NULL, error = NULL, updated_at = ? '
+                'WHERE queue = ? AND year = ? AND sample_id = ?',
+                [(DONE, now, queue, year, s) for s in sample_ids])
+            cursor.executemany(
+                'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (queue, year, name, str(path), self.worker, now)
+                    for name, path in (outputs or {}).items() if path])
+        return True
+
+    def fail(self, queue: str, year: int, sample_ids: Sequence[str], error: str) -> None:
+        """ release this worker's units for retry (or mark them as failed)
+
+        units that have been claimed `max_attempts` times are marked as failed,
+        others are returned to the queue.
+        """
+        now = _now()
+        with self._transaction() as cursor:
+            cursor.executemany(
+                'UPDATE units SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                'worker = NULL, lease_expires = NULL, error = ?, updated_at = ? '
+                'WHERE queue = ? AND year = ? AND sample_id = ? AND worker = ? AND status = ?',
+                [
+                    (self.max_attempts, FAILED, PENDING, error, now,
+                        queue, year, str(s), self.worker, LEASED)
+                    for s in sample_ids])
+
+    def counts(self, queue: str, year: int) -> dict[str, int]:
+        """ number of units for each status """
+        rows = self._fetch(
+            'SELECT status, COUNT(*) FROM units WHERE queue = ? AND year = ? GROUP BY status',
+            (queue, year))
+        counts = {status: 0 for status in STATUSES}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+    def failed(self, queue: str, year: int) -> dict[str, str]:
+        """ sample-id, error pairs of failed units """
+        rows = self._fetch(
+            'SELECT sample_id, error FROM units WHERE queue = ? AND year = ? AND status = ?',
+            (queue, year, FAILED))
+        return {sample_id: error for sample_id, error in rows}
+
+    def is_drained(self, queue: str, year: int) -> bool:
+        """ true if no units are pending or leased """
+        counts = self.counts(queue, year)
+        return (counts[PENDING] + counts[LEASED]) == 0
+
+    def outputs(self, queue: str, year: int) -> dict[str, list[str]]:
+        """ output-name, (existing) part-files pairs for queue/year """
+        rows = self._fetch(
+            'SELECT name, path FROM outputs WHERE queue = ? AND year = ? ORDER BY path',
+            (queue, year))
+        outputs: dict[str, list[str]] = {}
+        for name, path in rows:
+            if Path(path).is_file():
+                outputs.setdefault(name, []).append(path)
+        return outputs
+
+    def claim_finalize(self, queue: str, year: int) -> bool:
+        """ claim finalisation (ie merging the outputs) of queue/year
+
+        Returns:
+
+            (bool) true for exactly one worker, once the queue/year is drained
+        """
+        with self._transaction() as cursor:
+            self._expire(cursor, queue, year, time.time())
+            active = cursor.execute(
+                'SELECT COUNT(*) FROM units WHERE queue = ? AND year = ? AND status IN (?, ?)',
+                (queue, year, PENDING, LEASED)).fetchone()[0]
+            if active:
+                return False
+            cursor.execute(
+                'INSERT OR IGNORE INTO finalized VALUES (?, ?, ?, ?)',
+                (queue, year, self.worker, _now()))
+            return cursor.rowcount == 1
+
+    def is_finalized(self, queue: str, year: int) -> bool:
+        """ true if a worker has claimed finalisation of queue/year """
+        rows = self._fetch(
+            'SELECT 1 FROM finalized WHERE queue = ? AND year = ?',
+            (queue, year))
+        return bool(rows)
+
+    def part_path(self, queue: str, year: int, dest: str) -> str:
+        """ unique part-file path for (a batch of) <dest>
+
+        parts are kept next to the queue database (so they are shared with it):
+        `<queue-dir>/parts/<queue>/<year>/<stem>.part-<token><suffix>`
+        """
+        path = Path(dest)
+        name = PART_TMPL.format(stem=path.stem, token=secrets.token_hex(8), suffix=path.suffix)
+        return str(Path(self.path).parent / PARTS_DIR / queue / str(year) / name)
+
+    def remove_outputs(self, queue: str, year: int) -> None:
+        """ delete part-files of queue/year """
+        for paths in self.outputs(queue, year).values():
+            for path in paths:
+                Path(path).unlink(missing_ok=True)
+
+    def reset(self, queue: str, year: Optional[int] = None) -> None:
+        """ remove units, outputs and finalisation for queue (and year) """
+        if year is None:
+            where, args = 'queue = ?', (queue,)
+        else:
+            where, args = 'queue = ? AND year = ?', (queue, year)  # type: ignore[assignment]
+        with self._transaction() as cursor:
+            for table in ['units', 'outputs', 'finalized']:
+                cursor.execute(f'DELETE FROM {table} WHERE {where}', args)
+
+    def batches(
+            self,
+            queue: str,
+            year: int,
+            batch_size: Optional[int] = None,
+            wait: bool = True) -> Iterator[list[str]]:
+        """ claim batches until the queue/year is drained
+
+        leases are renewed in a background thread while the caller processes a
+        batch. the caller must `complete` (or `fail`) each batch before the
+        next iteration.
+
+        Args:
+
+            queue (str): queue name
+            year (int): year
+            batch_size (Optional[int] = None):
+                max number of units. if None use `c.WORK_QUEUE_BATCH_SIZE`
+            wait (bool = True):
+                if true, when nothing can be claimed but other workers hold leases,
+                poll until their units are done (or their leases expire and can be
+                claimed). otherwise stop once nothing can be claimed
+
+        Yields:
+
+            (list[str]) claimed sample ids
+        """
+        while True:
+            sample_ids = self.claim(queue, year, batch_size=batch_size)
+            if sample_ids:
+                with self.renewing(queue, year, sample_ids):
+                    yield sample_ids
+            elif wait and (not self.is_drained(queue, year)):
+                time.sleep(self.poll_interval)
+            else:
+                return
+
+    @contextmanager
+    def renewing(self, queue: str, year: int, sample_ids: Sequence[str]) -> Iterator[None]:
+        """ renew leases of <sample_ids> in a background thread """
+        stop = threading.Event()
+        interval = self.lease_seconds / RENEW_FRACTION
+
+        def _renew() -> None:
+            while not stop.wait(interval):
+                try:
+                    renewed = self.renew(queue, year, sample_ids)
+                except sqlite3.Error as e:
+                    warnings.warn(f'workqueue: lease renewal failed ({e})')
+                    continue
+                if renewed < len(sample_ids):
+                    warnings.warn(
+                        f'workqueue: {len(sample_ids) - renewed} leases lost '
+                        f'[{queue}, {year}]')
+                    return
+
+        thread = threading.Thread(target=_renew, name='workqueue_renew', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def close(self) -> None:
+        """ close sqlite connection """
+        with self._lock:
+            self._connection.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        # BEGIN IMMEDIATE takes the database write lock up-front, so concurrent
+        # claims (from other processes) never select the same units
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            else:
+                cursor.execute('COMMIT')
+            finally:
+                cursor.close()
+
+    def _expire(self, cursor: sqlite3.Cursor, queue: str, year: int, now: float) -> None:
+        cursor.execute(
+            'UPDATE units SET status = ?, worker = NULL, error = ?, updated_at = ? '
+            'WHERE queue = ? AND year = ? AND status = ? AND lease_expires < ? '
+            'AND attempts >= ?',
+            (FAILED, 'lease expired', _now(), queue, year, LEASED, now, self.max_attempts))
+
+    def _held(
+            self,
+            cursor: sqlite3.Cursor,
+            queue: str,
+            year: int,
+            sample_ids: Sequence[str]) -> int:
+        held = 0
+        for sample_id in sample_ids:
+            held += cursor.execute(
+                'SELECT COUNT(*) FROM units WHERE queue = ? AND year = ? AND sample_id = ? '
+                'AND worker = ? AND status = ?',
+                (queue, year, sample_id, self.worker, LEASED)).fetchone()[0]
+        return held
+
+    def _fetch(self, sql: str, args: tuple) -> list[Any]:
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+
+#
+# HELPERS
+#
+def worker_id() -> str:
+    """ unique worker id: <hostname>-<pid>-<token> """
+    return f'{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}'
+
+
+#
+# INTERNAL
+#
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')